@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Compare the backends of `rnadnatools table evaluate` on the test evaluation schemas.
+
+The test table is tiled to the requested number of rows and each schema is evaluated
+with every backend, checking that the results are identical.
+
+Example usage:
+`python benchmarks/evaluate_backends.py -n 10000000 tests/data/test_evaluation_scheme.tsv`
+"""
+import os.path as op
+import time
+
+import click
+import pandas as pd
+import pyarrow as pa
+
+from rnadnatools.lib import expressions
+
+TEST_TABLE = op.join(op.dirname(__file__), "..", "tests", "data", "test_table.tsv")
+
+
+@click.command()
+@click.argument("schemas", nargs=-1, type=click.Path(exists=True))
+@click.option("-n", "--nrows", default=10_000_000, type=int, show_default=True)
+@click.option("-r", "--repeats", default=3, type=int, show_default=True)
+def benchmark(schemas, nrows, repeats):
+    df = pd.read_csv(TEST_TABLE, sep="\t")
+    df = pd.concat([df] * (nrows // len(df) + 1), ignore_index=True).iloc[:nrows]
+    table = pa.Table.from_pandas(df, preserve_index=False).combine_chunks()
+
+    for column_schema in schemas:
+        schema = expressions.read_schema(column_schema)
+        graph = expressions.SchemaGraph(schema, table.column_names)
+        results = {}
+        for backend in expressions.backends:
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                results[backend] = graph.evaluate(
+                    lambda column: table[column], "PARQUET", backend=backend
+                )
+                timings.append(time.perf_counter() - start)
+            print(
+                f"{op.basename(column_schema)}\t{backend}\t{nrows} rows\t"
+                f"best of {repeats}: {min(timings):.3f} s"
+            )
+
+        reference = results[expressions.backends[0]]
+        for backend, result in results.items():
+            for column_name, column in result.items():
+                assert column.equals(reference[column_name]), (
+                    f"Backend {backend} differs for column {column_name}"
+                )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -9,4 +9,4 @@ def genome():
     pass
 
 
-from . import renzymes_recsites
+from . import renzymes_recsites, index_sites, index
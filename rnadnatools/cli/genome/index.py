@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import click
+import click_log
+
+# Set up logging:
+from .. import get_logger
+
+logger = get_logger(__name__)
+
+from . import genome
+
+from ...lib import fasta
+
+# Read the arguments:
+@genome.command()
+@click.argument("genome_path", type=click.Path(exists=True))
+@click.option(
+    "-o",
+    "--output-path",
+    help="Output index. Default is GENOME_PATH.fai, where it is found by other commands.",
+    default=None,
+    type=click.Path(exists=False),
+)
+def index(genome_path, output_path):
+    """
+    Create samtools-compatible .fai index of FASTA genome.
+
+    With the index, the sequences are memory-mapped and read directly
+    from any position of the genome (e.g. by 'genome renzymes-recsites')
+    without parsing the whole FASTA.
+    Lines of each sequence should have the same length, except for the last one.
+    """
+    records = fasta.build_fai(genome_path)
+    fasta.write_fai(output_path or genome_path + ".fai", records)
+
+    logger.info(
+        f"Indexed {len(records)} sequences of total length "
+        f"{sum(record.length for record in records)}."
+    )
+
+    return 0
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import click
+import click_log
+
+# Set up logging:
+from .. import get_logger
+
+logger = get_logger(__name__)
+
+from . import genome
+
+from ...lib import utils
+from ...lib import sites
+
+import pandas as pd
+
+# Read the arguments:
+@genome.command()
+@click.argument("sites_file", metavar="RSITES_REFERENCE", type=click.Path(exists=True))
+@click.argument("output_path", type=click.Path(exists=False))
+@click.option(
+    "-r",
+    "--ref-format",
+    help="Type of RSITES_REFERENCE.",
+    type=click.Choice(["TSV", "CSV", "PARQUET", "HDF5", "AUTO"], case_sensitive=False),
+    required=False,
+    default="auto",
+)
+@click.option(
+    "--ref-columns", "--ref-colnames",
+    help="IDs of the columns in RSITES_REFERENCE with chrom-start-strand. "
+         "Can be either string or integer. "
+         "Defaults to the columns of 'genome renzymes-recsites' output.",
+    default='0,1,5',
+    type=str,
+    show_default=True,
+)
+@click.option(
+    "--ref-header/--no-ref-header",
+    help="Flag for the header in reference table. Used for TSV/CSV input.",
+    default=False,
+    show_default=True,
+)
+def index_sites(sites_file, output_path, ref_format, ref_columns, ref_header):
+    """
+    Create binary index of restriction sites (or any other genome annotation)
+    for 'segment get-closest-sites'.
+
+    The index keeps the sorted starts of sites for each chromosome, separately for
+    plus strand, minus strand and both strands. It is memory-mapped by
+    'segment get-closest-sites' instead of reading and sorting the sites table,
+    pages of the index are shared by all concurrent jobs using it.
+    """
+
+    if ref_format.upper() == "AUTO":
+        ref_format = utils.guess_format(sites_file)
+
+    ref_columns = [int(x) if x.isdigit() else x for x in ref_columns.split(',')]
+    if len(ref_columns) != 3:
+        raise ValueError("Please, provide 3 reference columns for chrom, start, strand.")
+
+    stream = utils.load_table(
+        sites_file,
+        ref_format,
+        usecols=ref_columns,
+        chunksize=None,
+        header=0 if ref_header else None,
+    )
+    rsites = pd.concat(list(stream), ignore_index=True)
+    rsites.columns = ["chrom", "start", "strand"]
+
+    partitions = sites.index_sites(
+        rsites.chrom.values, rsites.start.values, rsites.strand.values
+    )
+    sites.write_index(output_path, partitions)
+
+    logger.info(
+        "Indexed sites: "
+        + ", ".join(f"{len(index)} on strand '{name}'" for name, index in partitions.items())
+    )
+
+    return 0
@@ -9,12 +9,17 @@ logger = get_logger(__name__)
 
 from . import genome
 
-# from ...lib import *
+from ...lib import utils
+from ...lib import fasta
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
 import numpy as np
 import pandas as pd
 
 import Bio.Restriction as biorst
+from Bio.Seq import Seq
 from Bio.SeqIO import parse
 
 # Read the arguments:
@@ -22,55 +27,218 @@ from Bio.SeqIO import parse
 @click.argument("genome_path", type=click.Path(exists=True))
 @click.argument("restriction_enzyme", type=str)
 @click.argument("output_path", type=click.Path(exists=False))
-def renzymes_recsites(genome_path, restriction_enzyme, output_path):
+@click.option(
+    "-p",
+    "--nproc",
+    help="Number of processes for scanning chromosomes.",
+    default=1,
+    type=int,
+    show_default=True,
+)
+def renzymes_recsites(genome_path, restriction_enzyme, output_path, nproc):
     """
     Detect recognition sites of restriction enzymes (start, end) and report strand
     This is not the same as restriction sites, see http://biopython.org/DIST/docs/cookbook/Restriction.html#mozTocId447698
 
     Note that we report formal end of restriction recognition site to comply with BED format.
+
+    Sites of enzymes with a single cut and non-degenerate recognition sequence
+    (with N allowed) are found by a vectorized search over the memory-mapped FASTA
+    on both strands, other enzymes are searched with Biopython.
+
+    Multiple comma-separated enzymes are searched in a single pass over the genome,
+    then OUTPUT_PATH should contain "{enzyme}" placeholder for enzyme name,
+    e.g. `rnadnatools genome renzymes-recsites hg38.fa DpnII,MboI {enzyme}.bed`
     """
 
-    fasta_records = parse(genome_path, "fasta")
-    enzyme = getattr(biorst, restriction_enzyme)
-
-    rsites = []
-    for seq_record in fasta_records:
-        chrom = seq_record.id
-        enzyme.search(seq_record.seq)
-        if enzyme.is_palindromic():
-            rsites.append(
-                pd.DataFrame({"chrom": chrom, "site": enzyme.results, "strand": "+"})
-            )
+    enzymes = restriction_enzyme.split(",")
+    for name in enzymes:
+        if not isinstance(getattr(biorst, name, None), biorst.Restriction.RestrictionType):
+            raise ValueError(f"Unknown restriction enzyme: {name}")
+    if len(enzymes) > 1 and "{enzyme}" not in output_path:
+        raise ValueError(
+            'Provide output path with "{enzyme}" placeholder for multiple enzymes.'
+        )
+
+    # Chromosomes are read from the memory-mapped FASTA by the workers,
+    # with the index read or built once by the main process:
+    try:
+        with fasta.FastaFile(genome_path) as fasta_file:
+            chroms, index = fasta_file.names, fasta_file.records
+        fasta_records = ((chrom, None, enzymes, genome_path) for chrom in chroms)
+    except ValueError as e:
+        logger.warning(f"Cannot index {genome_path} ({e}), reading it with Biopython.")
+        index = None
+        fasta_records = (
+            (seq_record.id, str(seq_record.seq), enzymes, genome_path)
+            for seq_record in parse(genome_path, "fasta")
+        )
+
+    # Sites of each enzyme, as lists of per-chromosome arrays:
+    rsites = {name: {"chrom": [], "site": [], "strand": []} for name in enzymes}
+    if nproc > 1:
+        pool = ProcessPoolExecutor(
+            nproc, initializer=_open_fasta, initargs=(genome_path, index)
+        )
+    else:
+        pool = nullcontext()
+    with pool:
+        if nproc > 1:
+            results = utils.imap_ordered(pool, _search_record, fasta_records, 2 * nproc)
         else:
-            minus = enzyme.on_minus
-            rsites.append(pd.DataFrame({"chrom": chrom, "site": minus, "strand": "-"}))
-            plus = np.setdiff1d(enzyme.results, minus)
-            rsites.append(pd.DataFrame({"chrom": chrom, "site": plus, "strand": "+"}))
+            _open_fasta(genome_path, index)
+            results = map(_search_record, fasta_records)
+
+        for chrom, found in results:
+            for name, (site, strand) in found.items():
+                rsites[name]["chrom"].append(np.full(len(site), chrom, dtype=object))
+                rsites[name]["site"].append(site)
+                rsites[name]["strand"].append(strand)
+
+    for name in enzymes:
+        _write_sites(
+            rsites[name], getattr(biorst, name), name, output_path.format(enzyme=name)
+        )
+        logger.info(f"Found {sum(map(len, rsites[name]['site']))} sites of {name}.")
+
+    return 0
+
 
-    rsites = pd.concat(rsites).sort_values(["chrom", "site"]).reset_index(drop=True)
+# FASTA files opened by the process:
+_fasta_files = {}
 
-    def detect_recognition_start(row):
-        if row.strand == "+":
-            return row.site - enzyme.fst5 - 1
+
+def _open_fasta(genome_path, index):
+    """Open FASTA file in the process with the index of the main process (if indexed)."""
+    if index is not None and genome_path not in _fasta_files:
+        _fasta_files[genome_path] = fasta.FastaFile(genome_path, records=index)
+
+
+def _search_record(args):
+    """
+    Search the sites of the enzymes in a chromosome.
+
+    Returns
+    -------
+    (chrom, dict with enzyme name as key and (sites, strands) tuple of numpy arrays as value)
+    """
+    chrom, seq, enzymes, genome_path = args
+    if seq is None:
+        seq = _fasta_files[genome_path].fetch(chrom)
+    else:
+        seq = np.frombuffer(seq.encode(), dtype=np.uint8)
+
+    # Biopython search raises errors for sequences with invalid characters:
+    upper = fasta.to_upper(seq)
+    is_valid = np.all((upper >= ord("A")) & (upper <= ord("Z")))
+
+    found = {}
+    for name in enzymes:
+        enzyme = getattr(biorst, name)
+        if is_valid and _is_simple(enzyme):
+            found[name] = _search_fast(upper, enzyme)
         else:
-            return row.site + enzyme.fst3 - 1
-
-    # Retrieving actual position of recognition site
-    idx_pos = rsites.strand == "+"
-    rsites.loc[idx_pos, "start"] = rsites.loc[idx_pos, "site"] - enzyme.fst5 - 1
-    idx_neg = rsites.strand == "-"
-    rsites.loc[idx_neg, "start"] = rsites.loc[idx_neg, "site"] + enzyme.fst3 - 1
-
-    rsites.loc[:, "end"] = rsites.start.astype(int)
-    rsites.loc[:, "name"] = [f"{restriction_enzyme}_{idx+1}" for idx in rsites.index]
-    rsites.loc[:, "foo"] = "."
-
-    rsites.to_csv(
-        output_path,
-        sep="\t",
-        columns=["chrom", "start", "end", "name", "foo", "strand"],
-        header=False,
-        index=False,
+            found[name] = _search_biopython(Seq(seq.tobytes()), enzyme)
+    return chrom, found
+
+
+def _is_simple(enzyme):
+    """Check whether the enzyme has a single cut and non-degenerate site (N allowed)."""
+    return (
+        enzyme.cut_once()
+        and not enzyme.is_unknown()
+        and set(enzyme.site) <= set("ACGTN")
     )
 
-    return 0
+
+def _search_biopython(seq, enzyme):
+    """Search the sites of the enzyme with Biopython, see _search_record."""
+    results = np.asarray(enzyme.search(seq), dtype=np.int64)
+    if enzyme.is_palindromic():
+        return results, np.full(len(results), "+", dtype=object)
+    minus = np.asarray(enzyme.on_minus, dtype=np.int64)
+    plus = np.setdiff1d(results, minus)
+    return (
+        np.concatenate([minus, plus]),
+        np.array(["-"] * len(minus) + ["+"] * len(plus), dtype=object),
+    )
+
+
+def _search_fast(seq, enzyme):
+    """
+    Search the sites of the enzyme in the upper-case sequence bytes, reproducing
+    the coordinates of Biopython search (_search_biopython), including the cuts
+    dropped at the ends of linear sequence.
+    """
+    length = len(seq)
+
+    def drop(cuts):
+        return cuts[
+            (1 < cuts) & (cuts <= length)
+            & (1 < cuts - enzyme.ovhg) & (cuts - enzyme.ovhg <= length)
+        ]
+
+    forward = _find_site(seq, enzyme.site)
+    if enzyme.is_palindromic():
+        results = drop(forward + enzyme.fst5)
+        return results, np.full(len(results), "+", dtype=object)
+
+    # Reverse complement matches (forward match takes precedence at the same position):
+    reverse = _find_site(seq, str(Seq(enzyme.site).reverse_complement()))
+    reverse = np.setdiff1d(reverse, forward)
+    minus = reverse - enzyme.fst3
+    plus = np.setdiff1d(drop(forward + enzyme.fst5), minus)
+    return (
+        np.concatenate([minus, plus]),
+        np.array(["-"] * len(minus) + ["+"] * len(plus), dtype=object),
+    )
+
+
+def _find_site(seq, site):
+    """
+    Find all (overlapping) occurences of the site in sequence bytes, N matches any letter.
+
+    Returns
+    -------
+    np.array with one-based starts of the matches
+    """
+    site = np.frombuffer(site.encode(), dtype=np.uint8)
+    size = len(site)
+    if len(seq) < size:
+        return np.empty(0, dtype=np.int64)
+    fixed = np.flatnonzero(site != ord("N"))
+    if len(fixed) == 0:
+        return np.arange(1, len(seq) - size + 2, dtype=np.int64)
+
+    # Filter candidate positions by one nucleotide at a time:
+    first = fixed[0]
+    candidates = np.flatnonzero(seq[first : len(seq) - size + 1 + first] == site[first])
+    for i in fixed[1:]:
+        candidates = candidates[seq[candidates + i] == site[i]]
+    return candidates.astype(np.int64) + 1
+
+
+def _write_sites(rsites, enzyme, name, output_path):
+    """Sort the sites by chromosome and position, and write them in BED format."""
+    chrom = np.concatenate(rsites["chrom"]) if rsites["chrom"] else np.empty(0, dtype=object)
+    site = np.concatenate(rsites["site"]) if rsites["site"] else np.empty(0, dtype=np.int64)
+    strand = np.concatenate(rsites["strand"]) if rsites["strand"] else np.empty(0, dtype=object)
+
+    order = np.lexsort((site, chrom.astype(str)))
+    chrom, site, strand = chrom[order], site[order], strand[order]
+
+    # Retrieving actual position of recognition site:
+    start = np.where(
+        strand == "+", site - enzyme.fst5 - 1, site + enzyme.fst3 - 1
+    ).astype(float)
+
+    pd.DataFrame(
+        {
+            "chrom": chrom,
+            "start": start,
+            "end": start.astype(int),
+            "name": [f"{name}_{idx+1}" for idx in range(len(site))],
+            "foo": ".",
+            "strand": strand,
+        }
+    ).to_csv(output_path, sep="\t", header=False, index=False)
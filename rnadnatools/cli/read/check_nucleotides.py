@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-## TODO: add output formats
-
 import click
 import click_log
 
@@ -12,9 +10,16 @@ logger = get_logger(__name__)
 
 from . import read
 
-# from ...lib import *
+from ...lib import utils
+from ...lib import tables
+from ...lib import streams
+
+import io
+from itertools import zip_longest
 
 import numpy as np
+import pyarrow as pa
+from pyarrow import csv
 
 # Read the arguments:
 @read.command()
@@ -27,8 +32,9 @@ import numpy as np
 @click.argument("output_file", type=click.Path(exists=False), metavar="OUTPUT_TABLE")
 @click.option(
     "--oligo",
-    help="Sequence of oligo.",
-    required=True,
+    help="Sequence of oligo. Required if --spec-file is not provided.",
+    required=False,
+    default=None,
 )
 @click.option(
     "--oligo-name",
@@ -85,6 +91,40 @@ import numpy as np
     type=int,
     show_default=True,
 )
+@click.option(
+    "-c",
+    "--chunksize",
+    help="Number of reads checked at once.",
+    default=1_000_000,
+    type=int,
+    show_default=True,
+)
+@click.option(
+    "--spec-file",
+    help="Tab-separated file with oligo, oligo name, reference column (name or index) "
+    "and shift per line, for checking multiple oligos in a single pass over the tables. "
+    "Cannot be together with --oligo.",
+    default=None,
+    type=click.Path(exists=True),
+)
+@click.option(
+    "-i",
+    "--in-format",
+    help="Type of FASTQ_TABLE and REFERENCE_TABLE. TSV tables can have a header "
+    "starting with '#', columns of PARQUET and HDF5 tables are loaded by names.",
+    type=click.Choice(["TSV", "PARQUET", "HDF5"], case_sensitive=False),
+    default="TSV",
+    show_default=True,
+)
+@click.option(
+    "-o",
+    "--out-format",
+    help="Type of OUTPUT_TABLE. Same as input for 'auto'. "
+    "Checks are stored as int8 columns in PARQUET and HDF5.",
+    type=click.Choice(["TSV", "CSV", "PARQUET", "HDF5", "AUTO"], case_sensitive=False),
+    default="auto",
+    show_default=True,
+)
 # @click.option('--fastq-table-header/--no-fastq-table-header',
 #               help="Flag for the header in fastq table.",
 #               default=True)
@@ -104,6 +144,10 @@ def check_nucleotides(
     ref_colname,
     ref_column,
     shift,
+    chunksize,
+    spec_file,
+    in_format,
+    out_format,
     # fastq_table_header,
     # position_table_header
 ):
@@ -116,8 +160,19 @@ def check_nucleotides(
 
     This approach is used in original RedC paper, where we checked GA nucleotides at the end of bridge adaptor.
 
+    Tables are read by chunks of --chunksize reads, and the oligo is compared
+    with the sequences of the whole chunk at once.
+
+    Multiple oligos, reference columns and shifts can be checked in a single pass
+    over the tables with --spec-file, each producing its own output column.
+
+    Tables can be also PARQUET or HDF5 (--in-format), then only the required columns
+    are loaded, and the output can be written as PARQUET table ready for 'table merge'.
+    TSV tables can be compressed (gzip, bgzip or zstd), the output is compressed
+    by its extension (.gz, .bgz, .zst).
+
     Example usage:
-    `rnadnatools read check-nucleotides --oligo GA -o tmp.txt --readid-colname readID --seq-colname R1 --reference-colname start_hit__bridge_forward_R1 --shift 35 tests/data/test-sample.table.tsv tests/data/test-sample.oligos.tsv`
+    `rnadnatools read check-nucleotides --oligo GA --readid-colname readID --seq-colname R1 --ref-colname start_hit__bridge_forward_R1 --shift 35 tests/data/test-sample.table.tsv tests/data/test-sample.oligos.tsv tmp.txt`
     """
 
     # Checks the input parameters:
@@ -131,17 +186,133 @@ def check_nucleotides(
     if (seq_colname is not None) and (seq_column is not None):
         raise ValueError("--seq-colname and --seq-column cannot work together.")
 
-    if (ref_colname is None) and (ref_column is None):
-        raise ValueError("Please, provide either --ref-colname or --ref-column.")
-    if (ref_colname is not None) and (ref_column is not None):
-        raise ValueError("--ref-colname and --ref-column cannot work together.")
+    if spec_file is not None:
+        if oligo is not None:
+            raise ValueError("--oligo and --spec-file cannot work together.")
+        specs = read_specs(spec_file)
+    else:
+        if oligo is None:
+            raise ValueError("Please, provide either --oligo or --spec-file.")
+        if (ref_colname is None) and (ref_column is None):
+            raise ValueError("Please, provide either --ref-colname or --ref-column.")
+        if (ref_colname is not None) and (ref_column is not None):
+            raise ValueError("--ref-colname and --ref-column cannot work together.")
+        specs = [
+            (
+                oligo,
+                oligo if oligo_name is None else oligo_name,
+                ref_column if ref_colname is None else ref_colname,
+                shift,
+            )
+        ]
+
+    if out_format.upper() == "AUTO":
+        out_format = in_format
+
+    if in_format.upper() == "TSV":
+        seq_column, readid_column, specs = _find_text_columns(
+            input_fastq_table,
+            input_ref_table,
+            seq_column if seq_colname is None else seq_colname,
+            readid_column if readid_colname is None else readid_colname,
+            specs,
+        )
+        # Note that readID is taken from the reference table:
+        chunks = _iter_text_chunks(
+            input_fastq_table,
+            input_ref_table,
+            seq_column,
+            readid_column,
+            [spec[2] for spec in specs],
+            chunksize,
+        )
+    else:
+        seq_colnames = utils.get_colnames(input_fastq_table, in_format)
+        ref_colnames = utils.get_colnames(input_ref_table, in_format)
+        seq_column = _find_column(seq_column, seq_colname, seq_colnames)
+        # Note that readID is taken from the reference table, as for TSV tables:
+        readid_index = seq_colnames.index(
+            _find_column(readid_column, readid_colname, seq_colnames)
+        )
+        if readid_index >= len(ref_colnames):
+            raise ValueError(
+                f"Column {readid_index} of readID is not found in {input_ref_table}"
+            )
+        readid_column = ref_colnames[readid_index]
+        specs = [
+            (x[0], x[1], _find_column(x[2], x[2], ref_colnames), x[3]) for x in specs
+        ]
+        chunks = _iter_columnar_chunks(
+            input_fastq_table,
+            input_ref_table,
+            in_format,
+            seq_column,
+            readid_column,
+            [spec[2] for spec in specs],
+            chunksize,
+        )
+
+    if spec_file is None:
+        header = [f"#entry_index_{specs[0][1]}"]
+    else:
+        header = ["#entry_index"]
+    header += [f"oligo_{name}_at_{shift}" for _, name, _, shift in specs]
+
+    n_reads = 0
+    with streams.open_output(output_file) if out_format.upper() == "TSV" else tables.TableWriter(
+        output_file, out_format
+    ) as outf:
+        if out_format.upper() == "TSV":
+            outf.write(("\t".join(header) + "\n").encode())
+        for seqs, readids, positions in chunks:
+            dump = {header[0]: readids}
+            for (spec_oligo, _, spec_column, spec_shift), name in zip(specs, header[1:]):
+                dump[name] = _check_oligo(
+                    seqs,
+                    positions[spec_column] + spec_shift,
+                    np.frombuffer(spec_oligo.encode(), dtype=np.uint8),
+                )
+            n_reads += len(readids)
+
+            if out_format.upper() == "TSV":
+                # Formatted chunk is compressed in background for .gz/.bgz/.zst output:
+                sink = pa.BufferOutputStream()
+                csv.write_csv(
+                    pa.table(dump),
+                    sink,
+                    csv.WriteOptions(
+                        include_header=False, delimiter="\t", quoting_style="none"
+                    ),
+                )
+                outf.write(sink.getvalue())
+            else:
+                dump = {
+                    name.lstrip("#"): (
+                        column.to_numpy(zero_copy_only=False)
+                        if name == header[0]
+                        else column.astype(np.int8)
+                    )
+                    for name, column in dump.items()
+                }
+                outf.write(dump)
 
-    if oligo_name is None:
-        oligo_name = oligo
+    logger.info(f"Checked {n_reads} reads for {', '.join(header[1:])}.")
 
+    return 0
+
+
+def _find_text_columns(input_fastq_table, input_ref_table, seq_column, readid_column, specs):
+    """
+    Find indices of the columns of text tables by names in the headers starting with '#'.
+    Integer columns are kept as indices.
+
+    Returns
+    -------
+    (seq_column, readid_column, specs) with column indices
+    """
     # Sniff for headers:
-    if seq_colname is not None or readid_colname is not None:
-        seqfile_header = open(input_fastq_table, "r").readline().strip()
+    if isinstance(seq_column, str) or isinstance(readid_column, str):
+        seqfile_header = _read_header(input_fastq_table)
         if not seqfile_header.startswith("#"):
             logger.warning(
                 "Are you sure sequence table has header? Header line does not start with '#'."
@@ -150,7 +321,8 @@ def check_nucleotides(
             seqfile_header = seqfile_header[1:]
         header = seqfile_header.split()
 
-        if seq_colname is not None:
+        if isinstance(seq_column, str):
+            seq_colname = seq_column
             seq_column = np.where(np.array(header) == seq_colname)[0]
             if len(seq_column) > 1:
                 logger.warning(
@@ -158,7 +330,8 @@ def check_nucleotides(
                 )
             seq_column = seq_column[0]
 
-        if readid_colname is not None:
+        if isinstance(readid_column, str):
+            readid_colname = readid_column
             readid_column = np.where(np.array(header) == readid_colname)[0]
             if len(readid_column) > 1:
                 logger.warning(
@@ -166,8 +339,9 @@ def check_nucleotides(
                 )
             readid_column = readid_column[0]
 
-    if ref_colname is not None:
-        posfile_header = open(input_ref_table, "r").readline().strip()
+    # Reference columns can be names in the header of REFERENCE_TABLE:
+    if any(isinstance(spec[2], str) for spec in specs):
+        posfile_header = _read_header(input_ref_table)
         if not posfile_header.startswith("#"):
             logger.warning(
                 "Are you sure sequence table has header? Header line does not start with '#'."
@@ -175,48 +349,178 @@ def check_nucleotides(
         else:
             posfile_header = posfile_header[1:]
         header = posfile_header.split()
-        ref_column = np.where(np.array(header) == ref_colname)[0]
-        if len(ref_column) > 1:
-            logger.warning(f"Mupltiple {ref_colname} columns in input sequence table")
-        ref_column = ref_column[0]
-
-    # Read the tables, check oligonucleotides and write output:
-    with open(output_file, "w") as outf:
-        outf.write(f"#entry_index_{oligo_name}\toligo_{oligo_name}_at_{shift}\n")
-        with open(input_fastq_table, "r") as in_f:
-            with open(input_ref_table, "r") as hits_f:
-                fastq_table_line = in_f.readline()
-                hits_table_line = hits_f.readline()
-
-                if fastq_table_line.startswith("#"):
-                    fastq_table_line = in_f.readline()
-                if hits_table_line.startswith("#"):
-                    hits_table_line = hits_f.readline()
-
-                while len(fastq_table_line) > 0:
-
-                    # Full read sequence:
-                    read = fastq_table_line.split()[seq_column]
-                    # Start position of the oligo in the read:
-                    oligo_position_start = int(hits_table_line.split()[ref_column])
-                    # ID of the read in the table with hits:
-                    idx = hits_table_line.split()[readid_column]
-
-                    # Checking presence:
-                    start_corrected = oligo_position_start + shift
-                    end_corrected = oligo_position_start + shift + len(oligo)
-                    # if the rightmost position of the oligo is out of the read, then no need to check at all:
-                    if (end_corrected > len(read)) or (start_corrected < 0):
-                        ret = 0
-                    else:
-                        if read[start_corrected:end_corrected] == oligo:
-                            ret = 1
-                        else:
-                            ret = 0
-                    outf.write("{}\t{}\n".format(idx, ret))
-
-                    # Continue to the next read:
-                    hits_table_line = hits_f.readline()
-                    fastq_table_line = in_f.readline()
 
-    return 0
+        for i, (spec_oligo, spec_name, spec_column, spec_shift) in enumerate(specs):
+            if not isinstance(spec_column, str):
+                continue
+            ref_column = np.where(np.array(header) == spec_column)[0]
+            if len(ref_column) == 0:
+                raise ValueError(f"Column {spec_column} is not found in {input_ref_table}")
+            if len(ref_column) > 1:
+                logger.warning(f"Mupltiple {spec_column} columns in input sequence table")
+            specs[i] = (spec_oligo, spec_name, int(ref_column[0]), spec_shift)
+
+    return int(seq_column), int(readid_column), specs
+
+
+def _read_header(in_path):
+    """First line of the (compressed) text table."""
+    with io.TextIOWrapper(streams.open_input(in_path)) as infile:
+        return infile.readline().strip()
+
+
+def _find_column(column, colname, colnames):
+    """Find name of the column of PARQUET/HDF5 table by either its name or index."""
+    if isinstance(colname, str):
+        if colname not in colnames:
+            raise ValueError(f"Column {colname} is not found, available: {colnames}")
+        return colname
+    return colnames[column]
+
+
+def _iter_text_chunks(
+    input_fastq_table, input_ref_table, seq_column, readid_column, ref_columns, chunksize
+):
+    """
+    Iterate over the chunks of text tables.
+
+    Returns
+    -------
+    iterator with (sequences, readIDs, dict of positions by reference column) tuples
+    """
+    seq_stream = _iter_columns(
+        input_fastq_table, {seq_column: pa.string()}, chunksize
+    )
+    columns = {readid_column: pa.string()}
+    columns.update({x: pa.int64() for x in ref_columns})
+    ref_stream = _iter_columns(input_ref_table, columns, chunksize)
+
+    # Tables should have the same number of rows, as in utils.iter_chunks:
+    for seqs, refs in zip_longest(seq_stream, ref_stream):
+        if seqs is None or refs is None or seqs.num_rows != refs.num_rows:
+            raise ValueError("Input tables have different number of rows.")
+        yield (
+            seqs.column(0),
+            refs.column(f"f{readid_column}"),
+            {x: refs.column(f"f{x}").to_numpy() for x in ref_columns},
+        )
+
+
+def _iter_columnar_chunks(
+    input_fastq_table,
+    input_ref_table,
+    in_format,
+    seq_column,
+    readid_column,
+    ref_columns,
+    chunksize,
+):
+    """
+    Iterate over the chunks of PARQUET or HDF5 tables, loading only the required columns.
+    readID is loaded from the reference table, as for text tables.
+
+    Returns
+    -------
+    iterator with (sequences, readIDs, dict of positions by reference column) tuples
+    """
+    chunks = utils.iter_chunks(
+        [input_fastq_table, input_ref_table],
+        in_format,
+        chunksize=chunksize,
+        columns=[[seq_column], [readid_column] + list(ref_columns)],
+    )
+    for seqs, refs in chunks:
+        yield (
+            seqs[seq_column],
+            refs[readid_column],
+            {x: np.asarray(refs[x]).astype(np.int64) for x in ref_columns},
+        )
+
+
+def read_specs(spec_file):
+    """
+    Read file with tab-separated oligo, oligo_name, reference column and shift,
+    one check per line. Lines starting with '#' are skipped.
+
+    Returns
+    -------
+    list of (oligo, oligo_name, reference column, shift) tuples,
+    reference column is int for column index and str for column name
+    """
+    specs = []
+    with open(spec_file, "r") as input_file:
+        for line in input_file.readlines():
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) != 4:
+                raise ValueError(
+                    f"Spec should contain oligo, oligo name, reference column and shift, "
+                    f"not: {line.strip()}"
+                )
+            spec_oligo, spec_name, spec_column, spec_shift = fields
+            spec_column = int(spec_column) if spec_column.isdigit() else spec_column
+            specs.append((spec_oligo, spec_name, spec_column, int(spec_shift)))
+    if len(specs) == 0:
+        raise ValueError(f"No oligos in {spec_file}")
+    return specs
+
+
+def _iter_columns(in_path, columns, chunksize):
+    """
+    Read the columns of tab-separated table by chunks of chunksize rows.
+    The first line is skipped if it is a header starting with '#'.
+    Compressed tables (gzip, bgzip, zstd) are decompressed by the reader ahead of parsing.
+
+    Parameters
+    ----------
+    in_path: input file
+    columns: dict with column index as key and pyarrow type as value
+    chunksize: number of rows in a chunk
+
+    Returns
+    -------
+    iterator with pa.Table chunks, columns are named f0, f1, ...
+    """
+    has_header = _read_header(in_path).startswith("#")
+    with streams.open_input(in_path) as infile:
+        reader = csv.open_csv(
+            infile,
+            read_options=csv.ReadOptions(
+                skip_rows=1 if has_header else 0, autogenerate_column_names=True
+            ),
+            parse_options=csv.ParseOptions(delimiter="\t", quote_char=False),
+            convert_options=csv.ConvertOptions(
+                column_types={f"f{i}": t for i, t in columns.items()},
+                include_columns=[f"f{i}" for i in columns],
+            ),
+        )
+        yield from tables._rebatch(reader, chunksize)
+
+
+def _check_oligo(seqs, starts, oligo):
+    """
+    Check that sequences contain oligo at the start positions.
+    Sequences are compared as a single byte buffer indexed by offsets of arrow array.
+
+    Returns
+    -------
+    np.array with 1 for the sequences with oligo and 0 otherwise
+    (also if the oligo is out of the sequence)
+    """
+    if isinstance(seqs, pa.ChunkedArray):
+        seqs = seqs.combine_chunks()
+    seqs = seqs.cast(pa.large_string())
+    offsets = np.frombuffer(seqs.buffers()[1], dtype=np.int64)[
+        seqs.offset : seqs.offset + len(seqs) + 1
+    ]
+    data = seqs.buffers()[2]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.zeros(1, np.uint8)
+    lengths = np.diff(offsets)
+
+    # if the rightmost position of the oligo is out of the read, then no need to check at all:
+    ret = (starts >= 0) & (starts + len(oligo) <= lengths)
+    positions = np.where(ret, offsets[:-1] + starts, 0)
+    for i, nucleotide in enumerate(oligo):
+        ret &= data[np.minimum(positions + i, len(data) - 1)] == nucleotide
+    return ret.astype(np.int64)
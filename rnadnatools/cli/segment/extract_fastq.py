@@ -10,12 +10,13 @@ logger = get_logger(__name__)
 from . import segment
 
 from ...lib import utils
+from ...lib import expressions
+from ...lib import fastq
+from ...lib import streams
+
+from contextlib import ExitStack
 
-import pyarrow as pa
-import pyarrow.parquet as pq
 import numpy as np
-import pandas as pd
-import ast
 
 # Read the arguments:
 @segment.command()
@@ -71,6 +72,53 @@ import ast
     help="Are the positions of start and end zero-based or one-based?",
     default=True,
 )
+@click.option(
+    "-b",
+    "--backend",
+    help="Backend for evaluation of the selection expression, see 'table evaluate'.",
+    type=click.Choice(expressions.backends, case_sensitive=False),
+    default="numpy",
+    show_default=True,
+)
+@click.option(
+    "-z",
+    "--compression",
+    help="Compression of the output: gzip, bgzip (blocked gzip, indexable), zstd or none. "
+    "Guessed from the extension of output file for 'auto' "
+    "(.gz for gzip, .bgz for bgzip, .zst for zstd). "
+    "Compression runs in background, bgzip and zstd blocks are compressed in parallel.",
+    type=click.Choice(["auto"] + fastq.compressions, case_sensitive=False),
+    default="auto",
+    show_default=True,
+)
+@click.option(
+    "-c",
+    "--chunksize",
+    help="Number of rows read, filtered and written at once. "
+    "Bounds the memory usage by the chunk size.",
+    default=1_000_000,
+    type=int,
+    show_default=True,
+)
+@click.option(
+    "--segment",
+    "segments",
+    help="Segment of the reads written into a separate output, as NAME:START,END,SEQ,QUAL "
+    "column names (START and END can be empty for the whole sequences), "
+    "e.g. 'rna:rna_start,rna_end,R1,Q1'. Can be repeated, then OUTPUT_FILE should contain "
+    "'{segment}' placeholder for segment name. If not set, a single segment is given "
+    "by --key-start, --key-end, --key-seq and --key-qual.",
+    multiple=True,
+)
+@click.option(
+    "-n",
+    "--shards",
+    help="Split each output into N files, with the records distributed round-robin. "
+    "OUTPUT_FILE should contain '{shard}' placeholder for the shard number (from 0).",
+    default=1,
+    type=int,
+    show_default=True,
+)
 def extract_fastq(
     in_paths,
     output_file,
@@ -81,77 +129,148 @@ def extract_fastq(
     key_readid,
     key_seq,
     key_qual,
-    zero_based
+    zero_based,
+    backend,
+    compression,
+    chunksize,
+    segments,
+    shards,
 ):
     """Convert table to fastq file.
     The result of evaluation should be a vector of type column_format with the number of entries equal to the input size of array columns.
 
+    The input tables are read by aligned chunks of --chunksize rows (parquet row groups,
+    HDF5 slices or TSV/CSV chunks), the selection is evaluated for each chunk
+    and the selected records are appended to the output.
+
+    Multiple segments (e.g. RNA and DNA parts of the reads, or R1 and R2 mates)
+    are extracted in a single pass over the input tables with --segment,
+    and each output can be split into shards for parallel mapping downstream.
+    The outputs are compressed in background, and the input TSV/CSV tables
+    can be compressed (gzip, bgzip or zstd).
+
     Example usage:
     `rnadnatools segment extract-fastq -s "dna_end-dna_start>14" -i PARQUET tmp.fq test-sample_01.fragments.pq test-sample_01.table.tsv.pq`
-    """
 
-    import numpy as np  # Import is within the function to guarantee the visibility in vars()
+    `rnadnatools segment extract-fastq --segment rna:rna_start,rna_end,R1,Q1 --segment dna:dna_start,dna_end,R1,Q1 -n 4 {segment}.{shard}.fq.gz test-sample_01.fragments.pq`
+    """
 
-    input_tables = utils.load_tables(in_paths, in_format)
+    if segments:
+        segments = [_parse_segment(x) for x in segments]
+    else:
+        segments = [(key_seq, key_start, key_end, key_seq, key_qual)]
+    if len(segments) > 1 and "{segment}" not in output_file:
+        raise ValueError(
+            'Provide output path with "{segment}" placeholder for multiple segments.'
+        )
+    if shards > 1 and "{shard}" not in output_file:
+        raise ValueError('Provide output path with "{shard}" placeholder for shards.')
+    if shards < 1:
+        raise ValueError(f"Number of shards should be positive, got: {shards}")
 
     if selection_expression is not None:
-        syntax_tree = ast.parse(selection_expression)
-        additional_vars = [
-            node.id for node in ast.walk(syntax_tree) if type(node) is ast.Name
-        ]
+        additional_vars = expressions.get_variables(selection_expression)
     else:
         additional_vars = []
 
-    loaded_ids = []
-
-    for k in [key_start, key_end, key_readid, key_seq, key_qual] + additional_vars:
-        is_found = False
-        for table in input_tables:
-            if in_format.upper() == "PARQUET":
-                if k in table.column_names:
-                    vars()[k] = table[k].to_numpy()
-                    is_found = True
-            elif in_format.upper() == "HDF5":
-                if k in table.keys():
-                    vars()[k] = table[k].values()
-                    is_found = True
-            else:
-                if k in table.columns:
-                    vars()[k] = table.loc[:, k]
-                    is_found = True
-            if is_found:
-                loaded_ids.append(str(k))
-                break
-        if not is_found:
-            if in_format.upper() == "PARQUET":
-                avail_colnames = [list(table.column_names) for table in input_tables]
-            elif in_format.upper() == "HDF5":
-                avail_colnames = [list(table.keys()) for table in input_tables]
+    # Load each column from the first table containing it:
+    input_colnames = [utils.get_colnames(x, in_format) for x in in_paths]
+    segment_columns = [k for segment in segments for k in segment[1:] if k is not None]
+    chunks = utils.iter_columns(
+        in_paths,
+        in_format,
+        chunksize,
+        utils.project_columns(input_colnames, [key_readid] + segment_columns + additional_vars),
+    )
+
+    # Writer for each shard of each segment,
+    # only the placeholders are substituted (paths can contain other braces):
+    output_files = [
+        [
+            output_file.replace("{segment}", segment[0]).replace("{shard}", str(shard))
+            for shard in range(shards)
+        ]
+        for segment in segments
+    ]
+
+    n_written = 0
+    with ExitStack() as stack:
+        writers = [
+            [
+                stack.enter_context(
+                    fastq.FastqWriter(path, compression=_get_compression(path, compression))
+                )
+                for path in paths
+            ]
+            for paths in output_files
+        ]
+
+        # Columns are kept as arrow, text columns are formatted without conversion:
+        for loaded in chunks:
+            if selection_expression is not None:
+                mask = expressions.evaluate_expression(
+                    selection_expression,
+                    {k: np.asarray(loaded[k]) for k in additional_vars},
+                    backend=backend.lower(),
+                )
+                selected = np.where(np.asarray(mask))[0]
             else:
-                avail_colnames = [list(table.columns) for table in input_tables]
-            raise ValueError(
-                f"Variable {k} is not available from input/created pyarrow file. "
-                f"List of variables that can be loaded:\n{str(avail_colnames)}"
-            )
+                selected = np.arange(len(loaded[key_readid]))
 
-    if selection_expression is not None:
-        mask = eval(selection_expression)
-    else:
-        mask = np.ones(len(vars()[key_readid]))
-    selected = np.where(mask)[0]
-
-    with open(output_file, "w") as outf:
-        readIDs = vars()[key_readid]
-        seqs = vars()[key_seq]
-        quals = vars()[key_qual]
-        starts = vars()[key_start] - (1 if not zero_based else 0)
-        ends = vars()[key_end] - (1 if not zero_based else 0)
-        for i in selected:
-            outf.write("@" + readIDs[i] + "\n")  # Sequence name
-            outf.write(seqs[i][starts[i] : ends[i]] + "\n")  # Sequence
-            outf.write("+\n")
-            outf.write(quals[i][starts[i] : ends[i]] + "\n")  # Qualities
-
-    logger.info(f"Done writing {len(selected)} sequences into {output_file} !")
+            # Round-robin over the shards, continued from the previous chunk:
+            shard_ids = (n_written + np.arange(len(selected))) % shards
+            readIDs = fastq._as_binary(loaded[key_readid])
+
+            for (name, key_start, key_end, key_seq, key_qual), segment_writers in zip(
+                segments, writers
+            ):
+                starts, ends = [
+                    None if k is None
+                    else np.asarray(loaded[k]).astype(np.int64) - (1 if not zero_based else 0)
+                    for k in [key_start, key_end]
+                ]
+                seqs = fastq._as_binary(loaded[key_seq])
+                quals = fastq._as_binary(loaded[key_qual])
+                for shard, writer in enumerate(segment_writers):
+                    idx = selected[shard_ids == shard] if shards > 1 else selected
+                    writer.write(
+                        fastq.format_fastq(
+                            readIDs.take(idx),
+                            seqs.take(idx),
+                            quals.take(idx),
+                            starts[idx] if starts is not None else None,
+                            ends[idx] if ends is not None else None,
+                        )
+                    )
+            n_written += len(selected)
+
+    logger.info(
+        f"Done writing {n_written} sequences into {', '.join(x for paths in output_files for x in paths)} !"
+    )
 
     return 0
+
+
+def _parse_segment(spec):
+    """
+    Parse segment specification NAME:START,END,SEQ,QUAL.
+
+    Returns
+    -------
+    (name, start, end, seq, qual) tuple of column names, start and end are None if empty
+    """
+    name, _, columns = spec.rpartition(":")
+    columns = columns.split(",")
+    if not name or len(columns) != 4 or not columns[2] or not columns[3]:
+        raise ValueError(
+            f"Segment should be given as NAME:START,END,SEQ,QUAL, got: {spec}"
+        )
+    return (name,) + tuple(x if x else None for x in columns)
+
+
+def _get_compression(path, compression):
+    """Compression of the output, guessed from the extension for 'auto'."""
+    if compression == "auto":
+        return streams.get_compression(path)
+    return compression
+
@@ -10,8 +10,12 @@ logger = get_logger(__name__)
 from . import segment
 
 from ...lib import *
+from ...lib import sites
+
+import os.path as op
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-import numpy as np
 import pandas as pd
 
 
@@ -81,11 +85,20 @@ import pandas as pd
 @click.option(
     '-c',
     "--chunksize",
-    help="Chunksize for loading the input (not supported for HDF5 and PARQUET for now).",
+    help="Chunksize for loading the input.",
     default=1_000_000,
     type=int,
     show_default=True,
 )
+@click.option(
+    "-p",
+    "--nproc",
+    help="Number of processes for the chunks of input. "
+         "Processes share the memory-mapped index of sites.",
+    default=1,
+    type=int,
+    show_default=True,
+)
 @click.option(
     "--input-header/--no-input-header",
     help="Flag for the header in input table. Used for TSV/CSV input.",
@@ -108,6 +121,7 @@ def get_closest_sites(
         strand,
         output_columns,
         chunksize,
+        nproc,
         input_header,
         ref_header
 ):
@@ -116,7 +130,9 @@ def get_closest_sites(
     Input:
      1) BED table (note that is should be are already aligned by the key)
      2) table with restriction sites (or any other genome annotation) with no header,
-        with the columns: ["chrom", "start", "end", "name", "_", "strand"]
+        with the columns: ["chrom", "start", "end", "name", "_", "strand"],
+        or binary index of sites created by 'genome index-sites'
+        (reference format and columns are ignored then)
     Output file format: tsv file with fields:
     read id,
     distance to the closest site (strand-specific) to the read start from the left,
@@ -130,8 +146,6 @@ def get_closest_sites(
     # Guess format if not specified:
     if in_format.upper() == "AUTO":
         in_format = utils.guess_format(input_file)
-    if ref_format.upper() == "AUTO":
-        ref_format = utils.guess_format(reference_file)
     if out_format.upper() == "AUTO":
         out_format = in_format
 
@@ -155,73 +169,112 @@ def get_closest_sites(
                                     chunksize=chunksize,
                                     header=0 if input_header else None)
 
-    # Define reference stream:
+    # Sorted sites of all chromosomes with chromosome offsets:
+    if sites.is_index(reference_file):
+        index = sites.load_index(reference_file, strand)
+    else:
+        index = _index_reference(
+            reference_file, ref_format, ref_columns, ref_header, strand
+        )
+    logger.info(
+        f"Indexed {len(index)} sites on {len(index.chromosomes)} chromosomes."
+    )
+
+    if nproc > 1:
+        chunks = _map_processes(
+            input_stream, reference_file, index, strand, output_columns, nproc
+        )
+    else:
+        chunks = (
+            _get_distances(df_bed, index, output_columns) for df_bed in input_stream
+        )
+
+    with tables.TableWriter(output_file, out_format) as writer:
+        for dump in chunks:
+            writer.write(dump)
+
+    return 0
+
+
+def _get_distances(df_bed, index, output_columns):
+    """Get distances to the closest sites for the chunk of input."""
+    df_bed.columns = ["chrom", "start", "end"]
+
+    # Convert dataframe to more effective numpy arrays:
+    codes = index.get_codes(df_bed.chrom.values)
+    bgn = df_bed.start.values.astype(int)
+    end = df_bed.end.values.astype(int)
+
+    # Single lookup for all chromosomes:
+    dct = {}
+    dct["start_left"], dct["start_right"] = index.closest(codes, bgn)
+    dct["end_left"], dct["end_right"] = index.closest(codes, end)
+
+    dump = pd.DataFrame(dct)
+    dump = dump.loc[:, ["start_left", "start_right", "end_left", "end_right"]]  # preserve order
+    dump = dump.astype(int)  # preserve data type
+
+    if output_columns:  # Add ned names of columns:
+        dump.columns = output_columns
+
+    return dump
+
+
+# Index of the worker process:
+_worker_index = None
+
+
+def _init_worker(index_path, strand):
+    global _worker_index
+    _worker_index = sites.load_index(index_path, strand)
+
+
+def _get_distances_worker(args):
+    df_bed, output_columns = args
+    return _get_distances(df_bed, _worker_index, output_columns)
+
+
+def _map_processes(input_stream, reference_file, index, strand, output_columns, nproc):
+    """
+    Get distances for the chunks of input in the pool of processes.
+    Workers memory-map the binary index of sites, the index is written
+    to temporary file if the reference is a table.
+
+    Returns
+    -------
+    iterator with the results for each chunk, in the order of input
+    """
+    with tempfile.TemporaryDirectory(prefix="rnadnatools_sites_") as tmp:
+        if sites.is_index(reference_file):
+            index_path = reference_file
+        else:
+            index_path = op.join(tmp, "sites.idx")
+            sites.write_index(index_path, {strand: index})
+
+        with ProcessPoolExecutor(
+            nproc, initializer=_init_worker, initargs=(index_path, strand)
+        ) as pool:
+            yield from utils.imap_ordered(
+                pool,
+                _get_distances_worker,
+                ((df_bed, output_columns) for df_bed in input_stream),
+                max_pending=2 * nproc,
+            )
+
+
+def _index_reference(reference_file, ref_format, ref_columns, ref_header, strand):
+    """Load the table with sites and index the sites on the strand."""
+    if ref_format.upper() == "AUTO":
+        ref_format = utils.guess_format(reference_file)
+
     reference_stream = utils.load_table(reference_file,
                                         ref_format,
                                         usecols=ref_columns,
                                         chunksize=None,
                                         header=0 if ref_header else None)
-    rsites = reference_stream
+    rsites = pd.concat(list(reference_stream), ignore_index=True)
     rsites.columns = ["chrom", "start", "strand"]
     if strand != "b":
-        rsites = rsites.loc[rsites.strand == strand, :].sort_values(["chrom", "start"])
-    else:
-        rsites = rsites.sort_values(["chrom", "start"])
-    rsited_dct = {} # Dictionary easy to access
-    for name, gr in rsites.groupby("chrom"):
-        rsited_dct[name] = {}
-        for k in gr.columns:
-            rsited_dct[name][k] = gr[k].values
-
-    mode = 'w'
-    for df_bed in input_stream:
-        df_bed.columns = ["chrom", "start", "end"]
-
-        # Convert dataframe to more effective numpy arrays:
-        chs = df_bed.chrom.values.astype(str)
-        # ids = df_bed.read_id.values.astype(str)
-        bgn = df_bed.start.values.astype(int)
-        end = df_bed.end.values.astype(int)
-        l = len(chs)
-
-        # Numpy checks, more effective than pandas:
-        dct = {}
-        for k in ["start_left", "start_right", "end_left", "end_right"]:
-            dct[k] = np.full(l, -1).astype(int)
-
-        for ch in rsited_dct.keys():
-            rs = np.concatenate(
-                [[-1e10], rsited_dct[ch]["start"], [1e10]]
-            )
-            mask = chs == ch
-
-            idx = np.digitize(bgn[mask], rs)
-            bgns = rs[idx - 1]
-            ends = rs[idx]
-            dct["start_left"][mask] = bgns - bgn[mask]
-            dct["start_right"][mask] = ends - bgn[mask]
-
-            idx = np.digitize(end[mask], rs)
-            bgns = rs[idx - 1]
-            ends = rs[idx]
-            dct["end_left"][mask] = bgns - end[mask]
-            dct["end_right"][mask] = ends - end[mask]
-
-        # Write the results for a chunk:
-        dump = pd.DataFrame(dct)
-        dump = dump.loc[:, ["start_left", "start_right", "end_left", "end_right"]]  # preserve order
-        dump = dump.astype(int)  # preserve data type
-
-        if output_columns:  # Add ned names of columns:
-            dump.columns = output_columns
-
-        # Writing for the first time:
-        if mode == 'w':
-            writer, s = utils.write_chunk(dump, output_file, out_format, mode='w')
-            mode = 'a'
-
-        # Appending:
-        else:
-            writer, s = utils.write_chunk(dump, output_file, out_format, writer, s, mode='a')
+        rsites = rsites.loc[rsites.strand == strand, :]
 
-    return 0
+    return sites.SitesIndex.from_sites(rsites.chrom.values, rsites.start.values)
@@ -10,9 +10,16 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
+from ...lib import tables
+
+import itertools
+import os
+import os.path as op
+import tempfile
 
 # Loading the data:
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import h5py
 import pandas as pd
@@ -93,19 +100,48 @@ import numpy as np
 @click.option(
     '-c',
     "--chunksize",
-    help="Chunksize for loading (not supported for HDF5 and PARQUET for now).",
+    help="Chunksize for loading.",
     default=10_000,
     type=int,
     show_default=True,
 )
 @click.option(
-    '-c',
     "--chunksize-writer",
     help="Chunksize for writing.",
     default=100_000,
     type=int,
     show_default=True,
 )
+@click.option(
+    "--assume-sorted",
+    help="Input rows follow the order of reference, possibly with gaps. "
+    "Align in a single streaming pass over chunks of both tables, "
+    "with memory bounded by the chunk size. Fails on the rows out of order.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--out-of-core/--in-memory",
+    help="Partition input and reference tables by key hash into spill files "
+    "and align the partitions one by one. For tables larger than RAM. "
+    "With --in-memory, the whole input table is loaded into memory.",
+    default=False,
+    show_default=True,
+)
+@click.option(
+    "--memory-limit",
+    help="Memory budget for the out-of-core mode, for example: 500M, 4G. "
+    "Number of partitions is estimated from the size of the input files.",
+    default="2G",
+    type=str,
+    show_default=True,
+)
+@click.option(
+    "--tmp-dir",
+    help="Directory for spill files of the out-of-core mode. System default if not set.",
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+)
 def align(
     input_file,
     reference_file,
@@ -121,114 +157,496 @@ def align(
     ref_header,
     drop_key,
     chunksize,
-    chunksize_writer
+    chunksize_writer,
+    assume_sorted,
+    out_of_core,
+    memory_limit,
+    tmp_dir,
 ):
     """
     Align the INPUT_TABLE by the key-column to the REFERENCE_TABLE by the ref-column.
     Fill in the values and retain the format of the input columns.
     The format of key-column and ref-column is assumed to be string by default.
+
+    Keys are matched with a hash join of the key columns, and the input columns
+    are gathered for the whole chunks of reference keys at once.
+    By default (--in-memory), all the columns of input table and the reference keys
+    are loaded into memory, as the rows are gathered from the whole input.
+    With --out-of-core, both tables are partitioned by key hash into spill files
+    in --tmp-dir, partitions are aligned independently and merged back in the order
+    of reference, so that only a partition has to fit into --memory-limit.
+    With --assume-sorted, input is merged with reference in a single pass
+    over the chunks of both tables.
     """
 
-    # columns reporing mode:
-    fill_values = fill_values.split(',')
-    if new_colnames:
-        new_colnames = new_colnames.split(',')
+    # Guess format if not specified:
+    if in_format.upper() == "AUTO":
+        in_format = utils.guess_format(input_file)
+    if ref_format.upper() == "AUTO":
+        ref_format = utils.guess_format(reference_file)
 
     # output format:
     if out_format.upper() == "AUTO":
         out_format = in_format
 
+    # columns reporing mode:
+    fill_values = fill_values.split(',')
+    if new_colnames:
+        new_colnames = new_colnames.split(',')
+
     # column names for input and reference:
     key_column = int(key_column) if key_column.isdigit() else key_column
     ref_column = int(ref_column) if ref_column.isdigit() else ref_column
 
-    # Pre-load input_stream keys:
-    input_stream_keys = utils.load_table(input_file,
-                                    in_format,
-                                    chunksize=chunksize,
-                                    usecols=[key_column],
-                                    header=0 if input_header else None)
-    l = map(lambda x: list(x[key_column].values), input_stream_keys)
-    input_ids = set([y for x in list(l) for y in x])
-
-    # Define input stream:
-    input_stream = utils.load_table(input_file,
-                                    in_format,
-                                    chunksize=chunksize,
-                                    header=0 if input_header else None)
-
-    # Define reference stream:
-    reference_stream = utils.load_table(reference_file,
-                                    ref_format,
-                                    usecols=[ref_column],
-                                    chunksize=chunksize,
-                                    header=0 if ref_header else None)
-    lst_ref = [y for x in reference_stream for y in x[ref_column].tolist()][::-1]
-
-    # Define input for reader/writer:
-    dct_input, colnames, dtypes = utils.update_df_chunk(input_stream, {}, key=key_column)
-    if new_colnames:
-        dct_rename = dict(zip(colnames, new_colnames))
-    keys_loaded = set(dct_input.keys()) # loaded input keys for fast search
-    empty_input = dict(zip(colnames, fill_values))
-
-    k = lst_ref.pop()
-    mode = 'w'
-    dumped = []
-    finish = False # flag for finishing the iteration over reference keys
-
-    print("Start iterations...")
-    while True: # iterate over reference keys
-
-        if k in keys_loaded: # check loaded keys
-            # Pop written entries from dct_input and store:
-            dumped.append(dct_input.pop(k))
-            if len(lst_ref)>0:
-                k = lst_ref.pop()
-            else:
-                finish = True
-
-        elif k not in input_ids: # check all possible keys of input
-            # Store empty new line:
-            empty_input[key_column] = k
-            dumped.append(dict(empty_input))
-            if len(lst_ref)>0:
-                k = lst_ref.pop()
-            else:
-                finish = True
-
-        else: # not found in loaded yet available from input, read next input piece:
-            # Parse next input chunk:
-            try:
-                utils.update_df_chunk(input_stream, dct_input, key=key_column)
-                keys_loaded = set(dct_input.keys())
-            except Exception as e:
-                raise ValueError(f"Key {k} not found in {in_path}")
+    input_stream = _iter_tables(
+        input_file, in_format, chunksize=chunksize, header=0 if input_header else None
+    )
+    reference_stream = _iter_tables(
+        reference_file,
+        ref_format,
+        chunksize=chunksize,
+        header=0 if ref_header else None,
+        usecols=[ref_column],
+    )
+
+    if assume_sorted and out_of_core:
+        raise ValueError("Use either --assume-sorted or --out-of-core, not both.")
 
-        # Write output:
-        if len(dumped) >= chunksize_writer or finish:
-            dumped = pd.DataFrame(dumped)
-            dumped = dumped.loc[:, colnames] # preserve order
-            dumped = dumped.astype(dtypes) # preserve data types
+    if assume_sorted:
+        aligned = _align_sorted(
+            input_stream, reference_stream, key_column, fill_values, chunksize_writer
+        )
+    elif out_of_core:
+        n_partitions = int(
+            np.ceil(
+                (os.path.getsize(input_file) + os.path.getsize(reference_file))
+                / _parse_size(memory_limit)
+            )
+        )
+        logger.info(f"Aligning {max(n_partitions, 1)} partitions out of core...")
+        aligned = _align_out_of_core(
+            input_stream,
+            reference_stream,
+            key_column,
+            fill_values,
+            chunksize_writer,
+            n_partitions=max(n_partitions, 1),
+            tmp_dir=tmp_dir,
+        )
+    else:
+        aligned = _align_in_memory(
+            input_stream, reference_stream, key_column, fill_values, chunksize_writer
+        )
+
+    with tables.TableWriter(output_file, out_format) as writer:
+        for dumped, colnames in aligned:
+            # New names are given for the columns including the key:
+            renamed = dict(zip(colnames, new_colnames)) if new_colnames else {}
 
             if drop_key: # Drop original key, if needed:
-                dumped = dumped.drop(key_column, axis=1)
+                position = colnames.index(key_column)
+                dumped = dumped.remove_column(position)
+                colnames = colnames[:position] + colnames[position + 1 :]
+
+            # Add new names of columns:
+            colnames = [str(renamed.get(x, x)) for x in colnames]
+            writer.write(dumped.rename_columns(colnames))
+
+    return 0
+
+
+def _iter_tables(in_path, in_format, chunksize, header, usecols=None):
+    """
+    Iterate over the chunks of the table converted to pyarrow tables
+    with string column names.
+
+    Returns
+    -------
+    iterator with (pa.Table, list of original column names) tuples
+    """
+    for table in tables.read_batches(
+        in_path, in_format, chunksize=chunksize, columns=usecols, header=header
+    ):
+        # Columns of text tables without header are referred to by position:
+        colnames = table.column_names
+        if header is None and in_format.upper() in ["TSV", "CSV"]:
+            colnames = [int(x) for x in colnames]
+        yield table, colnames
+
+
+def _concat_tables(stream, name):
+    """Concatenate the stream of (pa.Table, colnames) into single table."""
+    chunks = []
+    colnames = None
+    for table, colnames in stream:
+        chunks.append(table)
+    if colnames is None:
+        raise ValueError(f"No data in {name} table")
+    return tables.concat_tables(chunks).combine_chunks(), colnames
+
+
+def _parse_size(value):
+    """Parse memory size with optional K, M, G or T suffix into bytes."""
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _align_in_memory(input_stream, reference_stream, key_column, fill_values, chunksize):
+    """
+    Align input to reference with all the data in memory: all the columns of input
+    (the rows are gathered by the index of reference keys) and the reference keys.
+
+    Returns
+    -------
+    iterator with (aligned pa.Table, list of original column names) tuples
+    """
+    ref_keys = _concat_tables(reference_stream, "reference")[0].column(0)
+    input_table, colnames = _concat_tables(input_stream, "input")
+    if key_column not in colnames:
+        raise ValueError(f"Key column {key_column} is not found in input table")
+    key_position = colnames.index(key_column)
+    fill_values = _parse_fill_values(fill_values, input_table.schema)
+
+    # Position of each reference key in the input table:
+    index = _take_index(input_table.column(key_position), ref_keys)
+
+    logger.info(
+        f"Found {len(index) - index.null_count} of {len(index)} reference keys in input."
+    )
+
+    for start in range(0, max(len(ref_keys), 1), chunksize):
+        aligned = _gather(
+            input_table,
+            index.slice(start, chunksize),
+            ref_keys.slice(start, chunksize),
+            key_position,
+            fill_values,
+        )
+        yield aligned, colnames
+
+
+def _align_sorted(input_stream, reference_stream, key_column, fill_values, chunksize):
+    """
+    Align input to reference with the same order of keys by a streaming merge.
+    Each chunk of reference keys can only be matched by the next rows of input,
+    so only the chunk of input is kept in memory.
+
+    Returns
+    -------
+    iterator with (aligned pa.Table, list of original column names) tuples
+    """
+    first = next(input_stream, None)
+    if first is None:
+        raise ValueError("No data in input table")
+    buffer, colnames = first
+    if key_column not in colnames:
+        raise ValueError(f"Key column {key_column} is not found in input table")
+    key_position = colnames.index(key_column)
+    fill_values = _parse_fill_values(fill_values, buffer.schema)
+
+    n_found = 0
+    n_rows = 0
+    for reference, _ in reference_stream:
+        for start in range(0, reference.num_rows, chunksize):
+            ref_keys = reference.column(0).slice(start, chunksize).combine_chunks()
+
+            # Matching input rows are within the next len(ref_keys) rows of input:
+            while buffer.num_rows < len(ref_keys):
+                table = next(input_stream, None)
+                if table is None:
+                    break
+                buffer = tables.concat_tables([buffer, table[0]])
+            candidates = buffer.slice(0, len(ref_keys))
 
-            if new_colnames: # Add ned names of columns:
-                dumped = dumped.rename(dct_rename, axis=1)
+            index = _take_index(
+                candidates.column(key_position).combine_chunks(), ref_keys
+            )
+            found = index.drop_null().to_numpy()
+            if not np.array_equal(found, np.arange(len(found))):
+                offset = int(np.argmax(found != np.arange(len(found))))
+                raise ValueError(
+                    f"Input is not in the order of reference: row {n_found + offset} "
+                    f"of input (key {candidates.column(key_position)[offset]}) "
+                    "is out of order. Align without --assume-sorted."
+                )
 
-            # Writing for the first time:
-            if mode == 'w':
-                writer, s = utils.write_chunk(dumped, output_file, out_format, mode='w')
-                mode = 'a'
+            aligned = _gather(candidates, index, ref_keys, key_position, fill_values)
+            yield aligned, colnames
 
-            # Appending:
-            else:
-                writer, s = utils.write_chunk(dumped, output_file, out_format, writer, s, mode='a')
+            buffer = buffer.slice(len(found))
+            n_found += len(found)
+            n_rows += len(ref_keys)
 
-            dumped = []
+    if buffer.num_rows > 0 or next(input_stream, None) is not None:
+        raise ValueError(
+            f"Input is not in the order of reference: row {n_found} of input "
+            f"(key {buffer.column(key_position)[0] if buffer.num_rows else None}) "
+            "is out of order or missing from reference. Align without --assume-sorted."
+        )
 
-        if finish: # Last reference id checked
-            break
+    logger.info(f"Found {n_found} of {n_rows} reference keys in input.")
 
-    return 0
\ No newline at end of file
+
+def _partition(keys, n_partitions):
+    """Partition number for each key, by hash of its string representation."""
+    keys = keys.cast(pa.string()).to_numpy(zero_copy_only=False)
+    return (pd.util.hash_array(keys) % n_partitions).astype(np.int64)
+
+
+def _split(table, partitions, n_partitions):
+    """Split table into the list of tables for each partition."""
+    order = np.argsort(partitions, kind="stable")
+    table = table.take(order)
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(partitions, minlength=n_partitions))])
+    return [table.slice(bounds[i], bounds[i + 1] - bounds[i]) for i in range(n_partitions)]
+
+
+def _spill(stream, key_position, n_partitions, prefix, positions=False):
+    """
+    Write the chunks of the stream into spill files, one file per key hash partition.
+
+    Parameters
+    ----------
+    stream: iterator with (pa.Table, colnames) tuples
+    key_position: index of the key column
+    n_partitions: number of partitions
+    prefix: prefix of the spill files
+    positions: add column with the row number in the stream
+
+    Returns
+    -------
+    (list of spill files, list of original column names) tuple
+    """
+    paths = [f"{prefix}.{i}.arrow" for i in range(n_partitions)]
+    writers = None
+    colnames = None
+    n_rows = 0
+    for table, colnames in stream:
+        if positions:
+            table = table.append_column(
+                _position_column,
+                pa.array(np.arange(n_rows, n_rows + table.num_rows, dtype=np.int64)),
+            )
+        n_rows += table.num_rows
+        if writers is None:
+            schema = table.schema
+            writers = [pa.ipc.new_file(path, schema) for path in paths]
+        elif not table.schema.equals(schema):
+            writers, table = _promote_spill(writers, paths, schema, table)
+            schema = table.schema
+        partitions = _partition(table.column(key_position), n_partitions)
+        for writer, part in zip(writers, _split(table, partitions, n_partitions)):
+            writer.write_table(part)
+    if writers is None:
+        raise ValueError(f"No data in {prefix} table")
+    for writer in writers:
+        writer.close()
+    return paths, colnames
+
+
+def _promote_spill(writers, paths, schema, table):
+    """
+    Promote the types of spill files by the chunk that does not fit them (text tables),
+    the partitions are kept, as the keys are partitioned by their string representation.
+
+    Returns
+    -------
+    (list of spill writers, chunk cast to the types of spill files) tuple
+    """
+    try:
+        return writers, table.cast(schema)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+    for writer in writers:
+        writer.close()
+    spilled = [_read_spill(path) for path in paths]
+    table = tables.concat_tables([x.slice(0, 0) for x in spilled] + [table])
+    writers = [pa.ipc.new_file(path, table.schema) for path in paths]
+    for writer, part in zip(writers, spilled):
+        writer.write_table(part.cast(table.schema))
+    return writers, table
+
+
+def _read_spill(path):
+    """Read spill file into memory."""
+    with pa.ipc.open_file(path) as reader:
+        return reader.read_all().combine_chunks()
+
+
+def _iter_spill(path):
+    """Iterate over record batches of spill file."""
+    with pa.ipc.open_file(path) as reader:
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+class _SpillCursor:
+    """Cursor over spill file with rows sorted by position column."""
+
+    def __init__(self, path):
+        self.batches = _iter_spill(path)
+        self.buffer = []
+
+    def take_until(self, limit):
+        """Take the rows with position smaller than limit."""
+        taken = []
+        while True:
+            if not self.buffer:
+                batch = next(self.batches, None)
+                if batch is None:
+                    break
+                self.buffer = [batch]
+            batch = self.buffer[0]
+            if batch.num_rows == 0:
+                self.buffer = []
+                continue
+            n = int(
+                np.searchsorted(
+                    batch.column(_position_column).to_numpy(), limit, side="left"
+                )
+            )
+            taken.append(batch.slice(0, n))
+            if n < batch.num_rows:
+                self.buffer = [batch.slice(n)]
+                break
+            self.buffer = []
+        return taken
+
+
+_position_column = "__position__"
+
+
+def _align_out_of_core(
+    input_stream,
+    reference_stream,
+    key_column,
+    fill_values,
+    chunksize,
+    n_partitions,
+    tmp_dir=None,
+):
+    """
+    Align input to reference partitioned by key hash with spill files on disk.
+    The result is identical to _align_in_memory.
+
+    Returns
+    -------
+    iterator with (aligned pa.Table, list of original column names) tuples
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir, prefix="rnadnatools_align_") as tmp:
+        reference_paths, _ = _spill(
+            reference_stream, 0, n_partitions, op.join(tmp, "reference"), positions=True
+        )
+
+        # Peek at the first chunk of input to get the key column:
+        first = next(input_stream, None)
+        if first is None:
+            raise ValueError("No data in input table")
+        colnames = first[1]
+        if key_column not in colnames:
+            raise ValueError(f"Key column {key_column} is not found in input table")
+        key_position = colnames.index(key_column)
+        fill_values = _parse_fill_values(fill_values, first[0].schema)
+        input_paths, _ = _spill(
+            itertools.chain([first], input_stream),
+            key_position,
+            n_partitions,
+            op.join(tmp, "input"),
+        )
+
+        # Align each partition, keeping the order of reference:
+        aligned_paths = []
+        n_found = 0
+        n_rows = 0
+        for i, (input_path, reference_path) in enumerate(zip(input_paths, reference_paths)):
+            input_table = _read_spill(input_path)
+            reference = _read_spill(reference_path)
+            os.remove(input_path)
+            os.remove(reference_path)
+
+            ref_keys = reference.column(0)
+            index = _take_index(input_table.column(key_position), ref_keys)
+            n_found += len(index) - index.null_count
+            n_rows += len(index)
+            aligned = _gather(input_table, index, ref_keys, key_position, fill_values)
+            aligned = aligned.append_column(
+                _position_column, reference.column(_position_column)
+            )
+            del input_table, reference, index
+
+            aligned_paths.append(op.join(tmp, f"aligned.{i}.arrow"))
+            with pa.ipc.new_file(aligned_paths[-1], aligned.schema) as writer:
+                writer.write_table(aligned, max_chunksize=chunksize)
+
+        logger.info(f"Found {n_found} of {n_rows} reference keys in input.")
+
+        # Merge the partitions in the order of reference:
+        cursors = [_SpillCursor(path) for path in aligned_paths]
+        for start in range(0, max(n_rows, 1), chunksize):
+            batches = [x for cursor in cursors for x in cursor.take_until(start + chunksize)]
+            merged = pa.Table.from_batches(batches, schema=aligned.schema)
+            order = pc.sort_indices(merged.column(_position_column))
+            yield merged.take(order).drop_columns([_position_column]), colnames
+
+
+def _parse_fill_values(fill_values, schema):
+    """Convert the fill values (one per column or single for all) to types of schema."""
+    if len(fill_values) == 1:
+        fill_values = fill_values * len(schema)
+    if len(fill_values) != len(schema):
+        raise ValueError(
+            f"Provide single fill value or one value per input column ({len(schema)}), "
+            f"not: {fill_values}"
+        )
+    try:
+        return [pa.scalar(x).cast(t) for x, t in zip(fill_values, schema.types)]
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise ValueError(f"Fill values {fill_values} do not match the input columns: {e}")
+
+
+def _common_keys(keys, ref_keys):
+    """Cast keys and reference keys to the same type (string, if they differ)."""
+    if keys.type != ref_keys.type:
+        keys, ref_keys = keys.cast(pa.string()), ref_keys.cast(pa.string())
+    return keys, ref_keys
+
+
+def _take_index(keys, ref_keys):
+    """
+    Find position of each reference key in input keys with a hash join.
+
+    Returns
+    -------
+    pa.Array with indices of the rows of input for each reference key,
+    null for missing keys
+    """
+    keys, ref_keys = _common_keys(keys, ref_keys)
+    return pc.index_in(ref_keys, value_set=keys)
+
+
+def _gather(table, index, ref_keys, key_position, fill_values):
+    """
+    Take rows of the table by index, filling the rows missing in the table.
+    Key column of missing rows is filled with the reference keys.
+    """
+    taken = table.take(index)
+    missing = pc.is_null(index)
+    columns = []
+    for i, column in enumerate(taken.columns):
+        if i == key_position:
+            try:
+                fill = ref_keys.cast(column.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise ValueError(
+                    f"Reference keys cannot be stored in key column of type {column.type}: {e}"
+                )
+        else:
+            # Types of text input can be promoted after the fill values are parsed:
+            fill = fill_values[i]
+            if fill.type != column.type:
+                fill = fill.cast(column.type)
+        columns.append(pc.if_else(missing, fill, column))
+    return pa.Table.from_arrays(columns, schema=table.schema)
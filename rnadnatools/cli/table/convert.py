@@ -10,15 +10,7 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
-
-# Parse the expressions:
-import ast
-
-# Loading the data:
-import pyarrow as pa
-import pyarrow.parquet as pq
-import h5py
-import pandas as pd
+from ...lib import tables
 
 # Read the arguments:
 @table.command()
@@ -41,7 +33,7 @@ import pandas as pd
 )
 @click.option(
     "--chunksize",
-    help="Chunksize for tables loading. Supported for TSV/CSV and HDF5 input for now.",
+    help="Chunksize for tables loading.",
     default=1_000_000,
     type=int,
     show_default=True,
@@ -56,108 +48,32 @@ import pandas as pd
 )
 def convert(input_file, output_file, in_format, out_format, chunksize, col_modifier):
     """
-    Convert tables between formats, optionally modifying column names in the tables
+    Convert tables between formats, optionally modifying column names in the tables.
+    Tables of all formats are converted chunk by chunk.
     """
 
     # Guess format if not specified:
     if in_format.upper() == "AUTO":
         in_format = utils.guess_format(input_file)
 
-    if in_format == out_format:
+    if in_format.upper() == out_format.upper():
         logger.info(
             "in_format is same as out_format. Nothing to be done. Consider using cp instead."
         )
         return 0
 
-    # Read PARQUET, no chunking:
-    if in_format.upper() == "PARQUET":
-        logger.warn("Reading PARQUET for conversion, no chunking!")
-        # Read:
-        df = pd.read_parquet(input_file)
-        # Write:
-        if out_format.upper() == "CSV" or out_format.upper() == "TSV":
-            df.to_csv(output_file, sep="\t" if out_format.upper() == "TSV" else ",")
-        elif out_format.upper() == "HDF5":
-            output_file = h5py.File(output_file, "a")
-            for column_name, result in df.to_dict(orient="list").items():
-                output_file.create_dataset(column_name, data=result)
-            output_file.close()
-        return 0
-
-    # Write HDF5, no chunking for now:
-    if out_format.upper() == "HDF5" or in_format.upper() == "HDF5":
-        logger.warn("Reading or writing HDF5 for conversion, no chunking!")
-
-        # Read:
-        if in_format.upper() == "TSV" or in_format.upper() == "CSV":
-            df = pd.read_csv(
-                input_file,
-                sep="\t" if in_format.upper() == "TSV" else ",",
-                index_col=False,
-            )
-            dct = df.to_dict(orient="list")
-            del df
-        elif in_format.upper() == "HDF5":
-            h = h5py.File(input_file, "r")
-            dct = {k: h[k][()] for k in h.keys()}
-            h.close()
-
-        # Write:
-        if out_format.upper() == "HDF5":
-            output_file = h5py.File(output_file, "a")
-            for column_name, result in dct.items():
-                output_file.create_dataset(column_name, data=result)
-            output_file.close()
-        elif out_format.upper() == "CSV" or out_format.upper() == "TSV":
-            df = pd.DataFrame(dct)
-            df.to_csv(
-                output_file,
-                sep="\t" if out_format.upper() == "TSV" else ",",
-                index=False,
-            )
-        return 0
-
-    # Read other formats:
-    if in_format.upper() == "TSV" or in_format.upper() == "CSV":
-        instream = pd.read_csv(
-            input_file,
-            sep="\t" if in_format.upper() == "TSV" else ",",
-            chunksize=chunksize,
-            low_memory=True,
-        )
-
-    if out_format.upper() == "PARQUET":
-        for i, chunk in enumerate(instream):
-            if i == 0:
-                if col_modifier is None:
-                    columns = {x: x.replace("#", "") for x in chunk.columns}
-                else:
-                    columns = {
-                        x: col_modifier.format(colname=x.replace("#", ""))
-                        for x in chunk.columns
-                    }
-                frame = pa.Table.from_pandas(df=chunk.rename(columns=columns))
-                parquet_schema = frame.schema
-                parquet_writer = pq.ParquetWriter(
-                    output_file, parquet_schema, compression="snappy"
-                )
-            table = pa.Table.from_pandas(
-                chunk.rename(columns=columns), schema=parquet_schema
-            )
-            parquet_writer.write_table(table)
-
-        parquet_writer.close()
-
-    elif out_format.upper() == "CSV" or out_format.upper() == "TSV":
-        header = True
-        for i, chunk in enumerate(instream):
-            chunk.to_csv(
-                output_file,
-                sep="\t" if out_format.upper() == "TSV" else ",",
-                header=header,
-                mode="a" if i != 0 else "w",
-                index=False,
-            )
-            header = False
+    names = None
+    with tables.TableWriter(output_file, out_format) as writer:
+        for chunk in tables.read_batches(input_file, in_format, chunksize):
+            if names is None:
+                names = chunk.column_names
+                if out_format.upper() == "PARQUET":
+                    names = [
+                        x.replace("#", "")
+                        if col_modifier is None
+                        else col_modifier.format(colname=x.replace("#", ""))
+                        for x in names
+                    ]
+            writer.write(chunk.rename_columns(names))
 
     return 0
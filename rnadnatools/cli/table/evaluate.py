@@ -10,15 +10,12 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
+from ...lib import tables
 
-# Parse the expressions:
-import ast
-import builtins
+from ...lib import expressions
 
 # Loading the data:
-import pyarrow as pa
 import pyarrow.parquet as pq
-import h5py
 import pandas as pd
 
 # Read the arguments:
@@ -42,7 +39,52 @@ import pandas as pd
     required=False,
     default="auto",
 )
-def evaluate(column_schema, output_file, in_paths, in_format, out_format):
+@click.option(
+    "-c",
+    "--chunksize",
+    help="Number of rows evaluated at once. Bounds the memory usage by the chunk size. "
+    "If not set, the whole input tables are evaluated in a single shot.",
+    default=None,
+    type=int,
+)
+@click.option(
+    "--columns",
+    help="Comma-separated list of evaluated columns to write to the output. "
+    "Other columns are treated as intermediate and freed once they are not needed. "
+    "If None (default), all evaluated columns are written.",
+    type=str,
+    required=False,
+    default=None,
+)
+@click.option(
+    "-p",
+    "--threads",
+    help="Number of independent expressions evaluated concurrently.",
+    default=1,
+    type=int,
+    show_default=True,
+)
+@click.option(
+    "-b",
+    "--backend",
+    help="Backend for evaluation of expressions: Python eval over numpy arrays "
+    "or translation into multithreaded pyarrow.compute expressions "
+    "(with fallback to numpy for unsupported expressions).",
+    type=click.Choice(expressions.backends, case_sensitive=False),
+    default="numpy",
+    show_default=True,
+)
+def evaluate(
+    column_schema,
+    output_file,
+    in_paths,
+    in_format,
+    out_format,
+    chunksize,
+    columns,
+    threads,
+    backend,
+):
     """Create new columns according to the input expression.
     The result of evaluation will be a vector of type column_format with the number of
     entries equal to the input size of array columns.
@@ -55,15 +97,16 @@ def evaluate(column_schema, output_file, in_paths, in_format, out_format):
     list comprehensions, and can use only column names from input parquets as variables,
     built-in functions and numpy for their evaluation.
     **Column format** is one of the following: str, int, int8, int16, int32, bool.
-    """
 
-    import numpy as np  # Import is within the function to guarantee the visibility in vars()
+    The schema is compiled into a dependency graph before reading the data:
+    only the referenced input columns are loaded, the columns omitted from
+    --columns are freed after their last use and independent expressions
+    can be evaluated concurrently (--threads).
 
-    prohibited_symbols = [":", ".", "-", "/", "!", "?", "&", "|", "'", "%", "@"]
-    match = utils.match # define matcher; this now can be used as "match(col, expr)" in the evaluation scheme
-    pick_positions = utils.pick_positions
-    pick_smallest = utils.pick_smallest
-    pick_largest = utils.pick_largest
+    With --chunksize, the input tables are read by chunks (parquet row groups,
+    HDF5 slices or TSV/CSV chunks), the whole schema is evaluated for each chunk
+    and the result is appended to the output file.
+    """
 
     # Guess format if not specified:
     if in_format.upper() == "AUTO":
@@ -71,115 +114,44 @@ def evaluate(column_schema, output_file, in_paths, in_format, out_format):
     if out_format.upper() == "AUTO":
         out_format = in_format
 
-    input_tables = utils.load_tables(in_paths, in_format)
-
-    if out_format.upper() == "HDF5":
-        h = h5py.File(output_file, "w")
-
-    loaded_arrays = {}
-    n_evaluated = 0
-    with open(column_schema, "r") as input_file:
-        # Iterate over each expression:
-        for line in input_file.readlines():
-            column_name, column_format, column_expression = line.strip().split("\t")
-
-            assert np.all(
-                [x not in column_name for x in prohibited_symbols]
-            ), "Check the column name. It cannot contain " + ",".join(
-                prohibited_symbols
-            )
-
-            # Load dataset keys as variables:
-            loaded_ids = []
-            syntax_tree = ast.parse(column_expression)
-            for node in ast.walk(syntax_tree):
-                if type(node) is ast.Name:
-                    # The element is not loaded yet and is not a builtin name:
-                    if not (
-                        (node.id in list(vars().keys())) or (node.id in dir(builtins))
-                    ):
-                        # Element is already loaded:
-                        if node.id in loaded_arrays.keys():
-                            if in_format.upper() == "PARQUET":
-                                if loaded_arrays[node.id].type == pa.bool_():
-                                    vars()[node.id] = loaded_arrays[node.id].to_numpy(
-                                        zero_copy_only=False
-                                    )
-                                else:
-                                    vars()[node.id] = loaded_arrays[node.id].to_numpy()
-                            elif in_format.upper() == "HDF5":
-                                vars()[node.id] = loaded_arrays[node.id][()]
-                            else:
-                                vars()[node.id] = loaded_arrays[node.id]
-
-                            loaded_ids.append(str(node.id))
-
-                        # Element is not loaded, check the input tables:
-                        else:
-                            is_found = False
-                            for table in input_tables:
-                                if in_format.upper() == "PARQUET":
-                                    if node.id in table.column_names:
-                                        vars()[node.id] = table[node.id].to_numpy()
-                                        is_found = True
-                                elif in_format.upper() == "HDF5":
-                                    if node.id in table.keys():
-                                        vars()[node.id] = table[node.id][()]
-                                        is_found = True
-                                else:
-                                    if node.id in table.columns:
-                                        vars()[node.id] = table.loc[:, node.id]
-                                        is_found = True
-                                if is_found:
-                                    loaded_ids.append(str(node.id))
-                                    break
-
-                            if not is_found:
-                                if in_format.upper() == "PARQUET":
-                                    avail_colnames = [
-                                        list(table.column_names)
-                                        for table in input_tables
-                                    ] + [list(loaded_arrays.keys())]
-                                elif in_format.upper() == "HDF5":
-                                    avail_colnames = [
-                                        list(table.keys()) for table in input_tables
-                                    ] + [list(loaded_arrays.keys())]
-                                else:
-                                    avail_colnames = [
-                                        list(table.columns) for table in input_tables
-                                    ] + [list(loaded_arrays.keys())]
-                                raise ValueError(
-                                    f"Variable {node.id} is not available from input/created pyarrow file. "
-                                    f"List of variables that can be loaded:\n{ str( avail_colnames ) }"
-                                )
-
-            # Evaluate expression:
-            logger.debug(
-                f"Evaluating column: {column_name}, expression: {column_expression} "
-            )
-            result = eval(column_expression)
-
-            # Remove unused variables:
-            for v in loaded_ids:
-                del vars()[v]
-
-            loaded_arrays.update(
-                utils.dump_columns(result, in_format, column_format, column_name)
-            )
-            n_evaluated += 1
-
-    if n_evaluated > 0:
-        logger.info(
-            f"Evaluated {n_evaluated} expressions, including columns: {', '.join(loaded_arrays.keys())}"
-        )
-
-        utils.dump_arrays(
-            loaded_arrays, out_format, h if in_format.upper() == "HDF5" else output_file
-        )
-
-    else:
+    schema = expressions.read_schema(column_schema)
+    if len(schema) == 0:
         logger.info(
             "No evaluated expression. Is the input table with expressions empty?"
         )
+        return 0
+
+    # Compile the schema before reading any data:
+    input_colnames = [utils.get_colnames(x, in_format) for x in in_paths]
+    graph = expressions.SchemaGraph(
+        schema,
+        [x for colnames in input_colnames for x in colnames],
+        output_columns=columns.split(",") if columns else None,
+    )
+
+    # Load each referenced column from the first table containing it:
+    chunks = utils.iter_columns(
+        in_paths,
+        in_format,
+        chunksize,
+        utils.project_columns(input_colnames, graph.input_columns),
+    )
+
+    with tables.TableWriter(output_file, out_format) as writer:
+        for loaded in chunks:
+            loaded_arrays = graph.evaluate(
+                loaded.__getitem__,
+                # Chunks of any format are arrow tables, columns are dumped as arrow:
+                "PARQUET",
+                threads=threads,
+                backend=backend.lower(),
+            )
+            writer.write(loaded_arrays)
+
+    logger.info(
+        f"Evaluated {len(schema)} expressions, including columns: "
+        f"{', '.join(graph.columns[i][0] for i in graph.outputs)}"
+    )
 
     return 0
+
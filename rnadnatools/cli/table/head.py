@@ -10,15 +10,10 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
+from ...lib import tables
 
 import sys
 
-# Loading the data:
-import pyarrow as pa
-import pyarrow.parquet as pq
-import h5py
-import pandas as pd
-
 # Read the arguments:
 @table.command()
 @click.argument("input_file", type=click.Path(exists=True))
@@ -47,23 +42,9 @@ def head(input_file, in_format, nrows):
     if in_format.upper() == "AUTO":
         in_format = utils.guess_format(input_file)
 
-    # Read PARQUET:
-    if in_format.upper() == "PARQUET":
-        df = pd.read_parquet(input_file)
-        print(df.head(nrows), file=sys.stdout)
-
-    if in_format.upper() == "TSV" or in_format.upper() == "CSV":
-        df = pd.read_csv(
-            input_file, sep="\t" if in_format.upper() == "TSV" else ",", nrows=nrows
-        )
-        print(df, file=sys.stdout)
-
-    elif in_format.upper() == "HDF5":
-        h = h5py.File(input_file, "r")
-        dct = {k: h[k][:nrows] for k in h.keys()}
-        h.close()
-
-        df = pd.DataFrame.from_dict(dct)
-        print(df, file=sys.stdout)
+    # Only the first chunk is read:
+    for chunk in tables.read_batches(input_file, in_format, chunksize=nrows):
+        print(chunk.to_pandas(), file=sys.stdout)
+        break
 
     return 0
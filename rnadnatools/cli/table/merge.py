@@ -10,15 +10,10 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
-
-# Parse the expressions:
-import ast
+from ...lib import tables
 
 # Loading the data:
 import pyarrow as pa
-import pyarrow.parquet as pq
-import h5py
-import pandas as pd
 
 # Read the arguments:
 @table.command()
@@ -42,14 +37,14 @@ import pandas as pd
     show_default=True,
     default="PARQUET",
 )
-# @click.option(
-#     '-c',
-#     "--chunksize",
-#     help="Chunksize for tables loading. Supported for TSV/CSV and HDF5 input for now.",
-#     default=1_000_000,
-#     type=int,
-#     show_default=True,
-# )
+@click.option(
+    '-c',
+    "--chunksize",
+    help="Chunksize for tables loading.",
+    default=1_000_000,
+    type=int,
+    show_default=True,
+)
 @click.option(
     "-m",
     "--col-modifiers",
@@ -58,9 +53,10 @@ import pandas as pd
     default=None,
     required=False,
 )
-def merge(output_file, in_paths, in_format, out_format, col_modifiers):
+def merge(output_file, in_paths, in_format, out_format, chunksize, col_modifiers):
     """
-    Merge multiple tables into single file. Supports only PARQUET input and output
+    Merge multiple tables of the same length into single file (column-wise).
+    The tables are read and written chunk by chunk.
     """
 
     if col_modifiers is not None:
@@ -69,31 +65,16 @@ def merge(output_file, in_paths, in_format, out_format, col_modifiers):
             col_modifiers
         ), "Please, provide the modifiers for all input tables"
 
-    if in_format.upper() == "PARQUET" and out_format.upper() == "PARQUET":
-
-        input_tables = utils.load_tables(in_paths, in_format)
-
-        columns = []
-        schema = []
-        for i, table in enumerate(input_tables):
-            if col_modifiers is not None:
-                table = table.rename_columns(
-                    [col_modifiers[i].format(col_name=x) for x in table.column_names]
-                )
-            columns += table.columns
-            schema.append(table.schema)
-
-        parquet_schema = pa.unify_schemas(schema)
-        pq_merged = pa.Table.from_arrays(columns, schema=parquet_schema)
-        parquet_writer = pq.ParquetWriter(
-            output_file, parquet_schema, compression="snappy"
-        )
-        parquet_writer.write_table(pq_merged)
-        parquet_writer.close()
-
-    else:
-        raise NotImplementedError(
-            f"in_format {in_format} and out_format {out_format} are not supported yet."
-        )
+    with tables.TableWriter(output_file, out_format) as writer:
+        for chunks in utils.iter_chunks(in_paths, in_format, chunksize):
+            columns = []
+            names = []
+            for i, chunk in enumerate(chunks):
+                columns += chunk.columns
+                if col_modifiers is not None:
+                    names += [col_modifiers[i].format(col_name=x) for x in chunk.column_names]
+                else:
+                    names += chunk.column_names
+            writer.write(pa.Table.from_arrays(columns, names=names))
 
     return 0
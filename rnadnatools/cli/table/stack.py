@@ -10,12 +10,7 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
-
-# Loading the data:
-import pyarrow as pa
-import pyarrow.parquet as pq
-import h5py
-import pandas as pd
+from ...lib import tables
 
 # Read the arguments:
 @table.command()
@@ -50,9 +45,16 @@ import pandas as pd
     "If --no-validate-columns, the stack has the minimal overlap of columns.",
     default=True,
 )
-def stack(output_file, in_paths, in_format, out_format, columns, validate_columns):
+@click.option(
+    "--chunksize",
+    help="Chunksize for tables loading.",
+    default=1_000_000,
+    type=int,
+    show_default=True,
+)
+def stack(output_file, in_paths, in_format, out_format, columns, validate_columns, chunksize):
     """
-    Vertical stack of tables.
+    Vertical stack of tables. The tables are read and written chunk by chunk.
     """
 
     # Guess format if not specified:
@@ -61,14 +63,7 @@ def stack(output_file, in_paths, in_format, out_format, columns, validate_column
     if out_format.upper() == "AUTO":
         out_format = in_format
 
-    input_tables = utils.load_tables(in_paths, in_format)
-
-    if in_format == "HDF5":
-        columns_all = [table.keys() for table in input_tables]
-    elif in_format == "PARQUET":
-        columns_all = [table.column_names for table in input_tables]
-    else:
-        columns_all = [list(table.columns.values) for table in input_tables]
+    columns_all = [utils.get_colnames(x, in_format) for x in in_paths]
 
     columns_overlap = set.intersection(*map(set, columns_all))
     if validate_columns and len(columns_overlap) != len(columns_all[0]):
@@ -85,63 +80,13 @@ def stack(output_file, in_paths, in_format, out_format, columns, validate_column
         except Execption as e:
             raise ValueError(f"Columns {columns} are not available, available: {columns_selected}")
 
-    if out_format.upper() == "PARQUET":
-        for i, chunk in enumerate(input_tables):
-            if i == 0:
-                frame = chunk.select(columns_selected)
-                parquet_schema = frame.schema
-                parquet_writer = pq.ParquetWriter(
-                    output_file, parquet_schema, compression="snappy"
-                )
-            parquet_writer.write_table(chunk.select(columns_selected))
-
-        parquet_writer.close()
-
-    elif out_format.upper() == "CSV" or out_format.upper() == "TSV":
-        header = True
-        for i, chunk in enumerate(input_tables):
-            if in_format.upper() == "PARQUET":
-                chunk_converted = chunk.select(columns_selected).to_pandas()
-            elif in_format.upper() == "HDF5":
-                raise ValueError("not implemented")
-            else:
-                chunk_converted = chunk
-            chunk_converted.loc[:, columns_selected].to_csv(
-                output_file,
-                sep="," if out_format.upper() == "CSV" else "\t",
-                header=header,
-                mode="a" if i != 0 else "w",
-                index=False,
-            )
-            header = False
-
-    elif out_format.upper() == "HDF5":
-        if in_format.upper()!="HDF5":
-            raise ValueError("not implemented")
-        h = h5py.File(output_file, "w")
-        s = 0
-        for i, chunk in enumerate(input_tables):
-            if i == 0:
-                for col in columns_selected:
-                    if pd.api.types.is_object_dtype(chunk[col]):
-                        h.create_dataset(
-                            col,
-                            data=chunk[col].astype("S100"),
-                            maxshape=(None,),
-                            chunks=True,
-                        )
-                    else:
-                        h.create_dataset(
-                            col, data=chunk[col], maxshape=(None,), chunks=True
-                        )
-                s += len(chunk[col]) # Columns are guaranteed to have at least one element due to non-zero check
-            else:
-                for col in columns_selected:
-                    h[col].resize((s + len(chunk[col]),))
-                    if pd.api.types.is_object_dtype(chunk[col]):
-                        h[col][s : s + len(chunk[col])] = chunk[col].astype("S100")
-                    else:
-                        h[col][s : s + len(chunk[col])] = chunk[col]
-                s += len(chunk[col])
+    # Types that differ between the files (e.g. integer and string chromosomes)
+    # are promoted by the writer, converting the rows of the previous files:
+    with tables.TableWriter(output_file, out_format) as writer:
+        for in_path in in_paths:
+            for chunk in tables.read_batches(
+                in_path, in_format, chunksize, columns=columns_selected
+            ):
+                writer.write(chunk.select(columns_selected))
 
     return 0
@@ -10,11 +10,9 @@ logger = get_logger(__name__)
 from . import table
 
 from ...lib import utils
+from ...lib import tables
 
 # Loading the data:
-import pyarrow as pa
-import pyarrow.parquet as pq
-import h5py
 import pandas as pd
 import numpy as np
 
@@ -41,7 +39,7 @@ import numpy as np
 )
 @click.option(
     "--chunksize",
-    help="Chunksize for tables loading. Supported for TSV/CSV and HDF5 input for now.",
+    help="Chunksize for tables loading.",
     default=1_000_000,
     type=int,
     show_default=True,
@@ -61,56 +59,16 @@ def stats(input_file, output_file, in_format, columns, chunksize):
     if in_format.upper() == "AUTO":
         in_format = utils.guess_format(input_file)
 
-    # Read PARQUET, no chunking:
-    if in_format.upper() == "PARQUET":
-        # Read:
-        df = pd.read_parquet(input_file)
-
-        # Filter rows and select columns:
-        if columns is None:
-            columns = list(df.columns.values)
-
-        output = pd.DataFrame(
-            {col: [np.sum(df.loc[:, col] != False)] for col in columns}
-        ).T
-
-    # Write HDF5, no chunking for now:
-    elif in_format.upper() == "HDF5":  # TODO: check
-        logger.warn("Reading HDF5 for conversion, no chunking!")
-
-        h = h5py.File(input_file, "r")
-
-        # Filter rows and select columns:
+    counts = None
+    for chunk in tables.read_batches(input_file, in_format, chunksize, columns=columns):
         if columns is None:
-            columns = list(h.keys())
-
-        output = pd.DataFrame({col: [np.sum(h[col][()] != False)] for col in columns}).T
-
-        h.close()
-
-    # Read:
-    elif in_format.upper() == "TSV" or in_format.upper() == "CSV":
-
-        instream = pd.read_csv(
-            input_file,
-            sep="\t" if in_format.upper() == "TSV" else ",",
-            chunksize=chunksize,
-            low_memory=True,
-        )
-
-        for i, chunk in enumerate(instream):
-
-            if i == 0:
-                if columns is None:
-                    columns = list(chunk.columns.values)
-                output = {col: np.sum(chunk.loc[:, col] != False) for col in columns}
-            else:
-                output = {
-                    col: output[col] + np.sum(chunk.loc[:, col] != False)
-                    for col in columns
-                }
+            columns = chunk.column_names
+        if counts is None:
+            counts = {col: 0 for col in columns}
+        for col in columns:
+            counts[col] += np.sum(chunk[col].to_numpy() != False)
 
-        output = pd.DataFrame({col: [output[col]] for col in columns}).T
+    output = pd.DataFrame({col: [counts[col]] for col in counts or {}}).T
 
     output.to_csv(output_file, sep="\t", header=None)
 
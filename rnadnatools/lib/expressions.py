@@ -0,0 +1,435 @@
+# Manage logging
+from . import get_logger
+
+logger = get_logger(__name__)
+
+from . import utils
+
+# Parse the expressions:
+import ast
+import builtins
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+# Functions available in the column expressions, in addition to builtins:
+namespace = {
+    "np": np,
+    "match": utils.match,  # can be used as "match(col, expr)" in the evaluation scheme
+    "pick_positions": utils.pick_positions,
+    "pick_smallest": utils.pick_smallest,
+    "pick_largest": utils.pick_largest,
+}
+
+prohibited_symbols = [":", ".", "-", "/", "!", "?", "&", "|", "'", "%", "@"]
+
+# Backends for evaluation of the expressions:
+backends = ["numpy", "arrow"]
+
+# Number of rows in the batches evaluated in parallel by arrow backend:
+arrow_batchsize = 65_536
+
+
+def read_schema(column_schema):
+    """
+    Read column schema file with tab-separated column_name, column_format
+    and column_expression, one column per line.
+
+    Returns
+    -------
+    list of (column_name, column_format, column_expression) tuples
+    """
+    schema = []
+    with open(column_schema, "r") as input_file:
+        for line in input_file.readlines():
+            column_name, column_format, column_expression = line.strip().split("\t")
+
+            assert np.all(
+                [x not in column_name for x in prohibited_symbols]
+            ), "Check the column name. It cannot contain " + ",".join(
+                prohibited_symbols
+            )
+            schema.append((column_name, column_format, column_expression))
+    return schema
+
+
+def get_variables(expression):
+    """
+    List variables of the expression, i.e. the names that are neither builtins
+    nor the functions available for evaluation (see namespace).
+    """
+    syntax_tree = ast.parse(expression)
+    variables = []
+    for node in ast.walk(syntax_tree):
+        if type(node) is ast.Name:
+            if not ((node.id in namespace) or (node.id in dir(builtins))):
+                if node.id not in variables:
+                    variables.append(node.id)
+    return variables
+
+
+class SchemaGraph:
+    """
+    Column schema compiled into the dependency graph of expressions.
+
+    Each variable of an expression refers either to the column created by
+    the closest previous line of the schema or, if there is no such line,
+    to the input column. Only the referenced input columns have to be loaded,
+    and the evaluated columns that are not written to the output are freed
+    as soon as their last consumer is evaluated.
+
+    Attributes
+    ----------
+    columns: list of (column_name, column_format, column_expression) tuples
+    bindings: for each column, dictionary mapping variables to either input
+        column name (str) or index of the evaluated column (int)
+    input_columns: list of referenced input columns
+    outputs: indices of the columns written to the output, in the output order
+    """
+
+    def __init__(self, schema, available_columns, output_columns=None):
+        """
+        Parameters
+        ----------
+        schema: list of (column_name, column_format, column_expression) tuples
+        available_columns: column names of the input tables
+        output_columns: names of the evaluated columns to write to the output,
+            all evaluated columns if None
+        """
+        self.columns = list(schema)
+        self.bindings = []
+        self.input_columns = []
+
+        defined = {}  # column name -> index of the last line defining it
+        for i, (column_name, _, column_expression) in enumerate(self.columns):
+            try:
+                variables = get_variables(column_expression)
+            except SyntaxError as e:
+                raise ValueError(
+                    f"Cannot parse expression for column {column_name}: {column_expression}"
+                ) from e
+            binding = {}
+            for v in variables:
+                if v in defined:
+                    binding[v] = defined[v]
+                elif v in available_columns:
+                    binding[v] = v
+                    if v not in self.input_columns:
+                        self.input_columns.append(v)
+                else:
+                    raise ValueError(
+                        f"Variable {v} is not available from input/created pyarrow file. "
+                        f"List of variables that can be loaded:\n"
+                        f"{str([list(available_columns), list(defined.keys())])}"
+                    )
+            self.bindings.append(binding)
+            defined[column_name] = i
+
+        if output_columns is None:
+            output_columns = defined.keys()
+        for column_name in output_columns:
+            if column_name not in defined:
+                raise ValueError(
+                    f"Output column {column_name} is not defined in the column schema."
+                )
+        # Order of first definitions, as in the dictionary of evaluated columns:
+        order = list(dict.fromkeys(x[0] for x in self.columns))
+        self.outputs = [
+            defined[x] for x in sorted(output_columns, key=lambda x: order.index(x))
+        ]
+
+        # Number of consumers of each input column and evaluated column:
+        self._consumers = {}
+        for binding in self.bindings:
+            for key in binding.values():
+                self._consumers[key] = self._consumers.get(key, 0) + 1
+
+    def evaluate(self, get_input, in_format, threads=1, backend="numpy"):
+        """
+        Evaluate the graph.
+
+        Parameters
+        ----------
+        get_input: function returning input column by name (pyarrow array,
+            numpy array or pd.Series)
+        in_format: Type of input. Can be either "TSV", "CSV", "PARQUET", "HDF5"
+        threads: number of independent expressions evaluated concurrently
+        backend: "numpy" for Python eval over numpy arrays or "arrow" for
+            translation into pyarrow.compute expressions (see evaluate_expression)
+
+        Returns
+        -------
+        dictionary with output columns, see utils.dump_columns
+        """
+        remaining = dict(self._consumers)
+        values = {}
+
+        def run(i, variables):
+            column_name, column_format, column_expression = self.columns[i]
+            logger.debug(
+                f"Evaluating column: {column_name}, expression: {column_expression} "
+            )
+            result = evaluate_expression(column_expression, variables, backend=backend)
+            return utils.dump_columns(result, in_format, column_format, column_name)[
+                column_name
+            ]
+
+        def bind(i):
+            variables = {}
+            for v, key in self.bindings[i].items():
+                if key not in values:  # input column, load on the first use:
+                    values[key] = get_input(key)
+                variables[v] = values[key]
+            return variables
+
+        def release(i):
+            for key in self.bindings[i].values():
+                remaining[key] -= 1
+                if remaining[key] == 0 and key not in self.outputs:
+                    del values[key]
+
+        submitted = set()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {}
+            while len(submitted) < len(self.columns) or futures:
+                for i, binding in enumerate(self.bindings):
+                    ready = all(
+                        (key in values) or isinstance(key, str) for key in binding.values()
+                    )
+                    if i not in submitted and ready:
+                        futures[executor.submit(run, i, bind(i))] = i
+                        submitted.add(i)
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = futures.pop(future)
+                    values[i] = future.result()
+                    release(i)
+                    if remaining.get(i, 0) == 0 and i not in self.outputs:
+                        del values[i]
+
+        return {self.columns[i][0]: values[i] for i in self.outputs}
+
+
+def _as_array(column):
+    """Convert the column to array for evaluation with numpy."""
+    if isinstance(column, pa.ChunkedArray):
+        return column.to_numpy()
+    elif isinstance(column, pa.Array):
+        return column.to_numpy(zero_copy_only=False)
+    else:
+        return column
+
+
+def _as_arrow(column):
+    """Convert the column to pyarrow array for evaluation with pyarrow.compute."""
+    if isinstance(column, (pa.Array, pa.ChunkedArray)):
+        return column
+    elif isinstance(column, pd.Series):
+        return pa.Array.from_pandas(column)
+    else:
+        return pa.array(column)
+
+
+class _ArrowTranslator:
+    """
+    Translation of the expression syntax tree into pyarrow.compute expression.
+    Raises NotImplementedError for the nodes that have no arrow counterpart.
+    """
+
+    _binary = {
+        ast.Add: "add",
+        ast.Sub: "subtract",
+        ast.Mult: "multiply",
+        ast.Pow: "power",
+    }
+    # Bitwise operations are logical for boolean arrays in numpy:
+    _bitwise = {
+        ast.BitAnd: ("and_kleene", "bit_wise_and"),
+        ast.BitOr: ("or_kleene", "bit_wise_or"),
+        ast.BitXor: ("xor", "bit_wise_xor"),
+    }
+    _compare = {
+        ast.Eq: "equal",
+        ast.NotEq: "not_equal",
+        ast.Lt: "less",
+        ast.LtE: "less_equal",
+        ast.Gt: "greater",
+        ast.GtE: "greater_equal",
+    }
+    _numpy_functions = {
+        "abs": "abs",
+        "absolute": "abs",
+        "minimum": "min_element_wise",
+        "maximum": "max_element_wise",
+        "logical_and": "and_kleene",
+        "logical_or": "or_kleene",
+        "logical_xor": "xor",
+    }
+
+    def __init__(self, types):
+        """
+        Parameters
+        ----------
+        types: dictionary with pyarrow types of variables
+        """
+        self.types = types
+
+    def translate(self, node):
+        """
+        Translate the syntax tree node.
+
+        Returns
+        -------
+        (pyarrow.compute.Expression, is_boolean) tuple
+        """
+        if isinstance(node, ast.Expression):
+            return self.translate(node.body)
+        elif isinstance(node, ast.Name) and node.id in self.types:
+            return pc.field(node.id), pa.types.is_boolean(self.types[node.id])
+        elif isinstance(node, ast.Constant) and isinstance(
+            node.value, (bool, int, float, str)
+        ):
+            return pc.scalar(node.value), isinstance(node.value, bool)
+        elif isinstance(node, ast.BinOp) and type(node.op) in self._binary:
+            left, _ = self.translate(node.left)
+            right, _ = self.translate(node.right)
+            return getattr(pc, self._binary[type(node.op)])(left, right), False
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+            # True division, as in numpy:
+            left, _ = self.translate(node.left)
+            right, _ = self.translate(node.right)
+            return pc.divide(left.cast(pa.float64()), right.cast(pa.float64())), False
+        elif isinstance(node, ast.BinOp) and type(node.op) in self._bitwise:
+            left, left_bool = self.translate(node.left)
+            right, right_bool = self.translate(node.right)
+            is_bool = left_bool and right_bool
+            function = self._bitwise[type(node.op)][0 if is_bool else 1]
+            return getattr(pc, function)(left, right), is_bool
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand, _ = self.translate(node.operand)
+            return pc.negate(operand), False
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            operand, is_bool = self.translate(node.operand)
+            return (pc.invert(operand) if is_bool else pc.bit_wise_not(operand)), is_bool
+        elif (
+            isinstance(node, ast.Compare)
+            and len(node.ops) == 1
+            and type(node.ops[0]) in self._compare
+        ):
+            left, _ = self.translate(node.left)
+            right, _ = self.translate(node.comparators[0])
+            result = getattr(pc, self._compare[type(node.ops[0])])(left, right)
+            # Comparisons with nulls are False (True for !=), as with NaN in numpy:
+            return pc.coalesce(result, pc.scalar(isinstance(node.ops[0], ast.NotEq))), True
+        elif isinstance(node, ast.Call) and len(node.keywords) == 0:
+            return self._translate_call(node)
+        elif (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "pick_positions"
+            and [x.arg for x in node.keywords] == ["threshold"]
+        ):
+            node = ast.Call(
+                func=node.func, args=node.args + [node.keywords[0].value], keywords=[]
+            )
+            return self._translate_call(node)
+        raise NotImplementedError(f"Unsupported expression: {ast.dump(node)}")
+
+    def _translate_call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            if not (
+                isinstance(node.func.value, ast.Name)
+                and node.func.value.id == "np"
+                and node.func.attr in (list(self._numpy_functions) + ["where"])
+            ):
+                raise NotImplementedError(f"Unsupported function: {ast.dump(node.func)}")
+            name = node.func.attr
+        elif isinstance(node.func, ast.Name):
+            name = node.func.id
+        else:
+            raise NotImplementedError(f"Unsupported function: {ast.dump(node.func)}")
+
+        if name == "match":
+            if not (
+                len(node.args) == 2
+                and isinstance(node.args[1], ast.Constant)
+                and isinstance(node.args[1].value, str)
+            ):
+                raise NotImplementedError("match() requires constant regular expression")
+            column, _ = self.translate(node.args[0])
+            return utils.match(column, node.args[1].value), True
+
+        translated = [self.translate(x) for x in node.args]
+        args = [x[0] for x in translated]
+        is_bool = all(x[1] for x in translated)
+        if name == "where" and len(args) == 3:
+            return pc.if_else(*args), all(x[1] for x in translated[1:])
+        elif name == "pick_positions" and len(args) in [2, 3]:
+            threshold = args[2] if len(args) == 3 else pc.scalar(99999)
+            return pc.if_else(pc.less(args[0], threshold), args[0], args[1]), False
+        elif name == "pick_smallest" and len(args) > 0:
+            return pc.min_element_wise(*args), is_bool
+        elif name == "pick_largest" and len(args) > 0:
+            return pc.max_element_wise(*args), is_bool
+        elif name == "abs" or (
+            name in self._numpy_functions and isinstance(node.func, ast.Attribute)
+        ):
+            function = self._numpy_functions[name]
+            is_bool = function in ["and_kleene", "or_kleene", "xor"]
+            return getattr(pc, function)(*args), is_bool
+        raise NotImplementedError(f"Unsupported function: {name}")
+
+
+def evaluate_expression(expression, variables, backend="numpy", use_threads=True):
+    """
+    Evaluate the expression over the columns.
+
+    With numpy backend, the expression is evaluated by Python eval over numpy arrays.
+    With arrow backend, the syntax tree is translated into pyarrow.compute expression,
+    which is evaluated in parallel over the batches of variables without full-length
+    temporary arrays. Falls back to numpy if the expression cannot be translated
+    or evaluated with arrow.
+
+    Parameters
+    ----------
+    expression: string with the expression
+    variables: dictionary with the columns used in the expression
+    backend: "numpy" or "arrow"
+    use_threads: evaluate batches in parallel (arrow backend)
+
+    Returns
+    -------
+    pyarrow.ChunkedArray (arrow backend) or numpy array/pd.Series (numpy backend)
+    """
+    if backend == "arrow":
+        try:
+            if len(variables) == 0:
+                raise NotImplementedError("No variables in the expression")
+            table = pa.table({k: _as_arrow(v) for k, v in variables.items()})
+            if max(x.num_chunks for x in table.columns) > (
+                table.num_rows // arrow_batchsize + 1
+            ):
+                # Fragmented input, e.g. after concatenation of pandas chunks:
+                table = table.combine_chunks()
+            translator = _ArrowTranslator(
+                dict(zip(table.column_names, table.schema.types))
+            )
+            arrow_expression, _ = translator.translate(
+                ast.parse(expression, mode="eval")
+            )
+            dataset = ds.dataset(
+                table.to_batches(max_chunksize=arrow_batchsize), schema=table.schema
+            )
+            return dataset.to_table(
+                columns={"result": arrow_expression}, use_threads=use_threads
+            ).column("result")
+        except (NotImplementedError, pa.ArrowException) as e:
+            logger.debug(f"Evaluating {expression} with numpy: {e}")
+
+    return eval(
+        expression, dict(namespace, **{k: _as_array(v) for k, v in variables.items()})
+    )
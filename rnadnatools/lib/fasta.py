@@ -0,0 +1,209 @@
+"""
+Random access to the sequences of FASTA files through the memory map and
+samtools-compatible .fai index (name, length, offset, linebases, linewidth).
+The index is read from <fasta>.fai if present (see 'rnadnatools genome index'),
+or built by a single pass over the file.
+
+Example:
+    with FastaFile("hg38.fa") as genome:
+        seq = genome.fetch("chr1", 1_000_000, 1_000_100, upper=True).tobytes()
+"""
+
+import mmap
+import os
+from collections import namedtuple
+
+import numpy as np
+
+FaiRecord = namedtuple("FaiRecord", ["name", "length", "offset", "linebases", "linewidth"])
+
+# Translation of the sequence bytes to upper case:
+_upper_table = np.arange(256, dtype=np.uint8)
+_upper_table[ord("a") : ord("z") + 1] -= ord("a") - ord("A")
+
+
+def to_upper(seq):
+    """Convert the sequence bytes (np.uint8 array) to upper case."""
+    return _upper_table[seq]
+
+
+def read_fai(fai_path):
+    """
+    Read .fai index.
+
+    Returns
+    -------
+    list of FaiRecord, in the order of sequences in FASTA
+    """
+    records = []
+    with open(fai_path, "r") as infile:
+        for line in infile:
+            fields = line.rstrip("\n").split("\t")
+            records.append(FaiRecord(fields[0], *[int(x) for x in fields[1:5]]))
+    return records
+
+
+def build_fai(fasta_path):
+    """
+    Build .fai index of FASTA file. Lines of each sequence should have the same length
+    (except for the last one), as required by samtools faidx.
+
+    Returns
+    -------
+    list of FaiRecord, in the order of sequences in FASTA
+    """
+    records = []
+    record = None
+    last_line = False
+
+    def finish(record):
+        if record is not None:
+            name, length, offset, linebases, linewidth = record
+            records.append(
+                FaiRecord(name, length, offset, linebases or 0, linewidth or 0)
+            )
+
+    with open(fasta_path, "rb") as infile:
+        position = 0
+        for line in infile:
+            position += len(line)
+            if line.startswith(b">"):
+                finish(record)
+                name = line[1:].split(None, 1)[0].decode() if len(line) > 2 else ""
+                record = [name, 0, position, None, None]
+                last_line = False
+                continue
+            if record is None:
+                continue
+            bases = len(line.rstrip(b"\r\n"))
+            if bases == 0:
+                last_line = True
+                continue
+            if last_line:
+                raise ValueError(
+                    f"Different line length in sequence {record[0]} of {fasta_path}"
+                )
+            if record[3] is None:
+                record[3], record[4] = bases, len(line)
+            elif bases > record[3] or len(line) - bases != record[4] - record[3]:
+                raise ValueError(
+                    f"Different line length in sequence {record[0]} of {fasta_path}"
+                )
+            if bases < record[3]:
+                last_line = True
+            record[1] += bases
+        finish(record)
+    return records
+
+
+def write_fai(fai_path, records):
+    """Write .fai index."""
+    with open(fai_path, "w") as outfile:
+        for record in records:
+            outfile.write("\t".join(str(x) for x in record) + "\n")
+
+
+class FastaFile:
+    """
+    Memory-mapped FASTA file with the index of sequences.
+
+    Parameters
+    ----------
+    fasta_path: FASTA file (uncompressed)
+    fai_path: .fai index, <fasta_path>.fai by default. Built on the fly if it does not exist.
+    records: list of FaiRecord of the file, e.g. the records of the file opened
+        by another process, used instead of reading or building the index
+    """
+
+    def __init__(self, fasta_path, fai_path=None, records=None):
+        self.path = fasta_path
+        fai_path = fai_path or fasta_path + ".fai"
+        if records is not None:
+            self.records = list(records)
+        elif os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(
+            fasta_path
+        ):
+            self.records = read_fai(fai_path)
+        else:
+            self.records = build_fai(fasta_path)
+        self.index = {record.name: record for record in self.records}
+
+        self._file = open(fasta_path, "rb")
+        if os.path.getsize(fasta_path) > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b""
+
+    @property
+    def names(self):
+        """Names of sequences, in the order of FASTA."""
+        return [record.name for record in self.records]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_length(self, name):
+        """Length of the sequence."""
+        return self.index[name].length
+
+    def fetch(self, name, start=0, end=None, upper=False):
+        """
+        Get the sequence (or its slice) as numpy array of bytes (np.uint8),
+        without line breaks.
+
+        Parameters
+        ----------
+        name: name of the sequence
+        start, end: zero-based half-open coordinates of the slice,
+            the whole sequence by default. Clipped to the sequence length.
+        upper: convert the sequence to upper case
+
+        Returns
+        -------
+        np.array of np.uint8. Slices within a single line of FASTA are read-only
+        views of the memory map (no copy), other slices are gathered into new arrays.
+        """
+        record = self.index[name]
+        end = record.length if end is None else min(end, record.length)
+        start = max(start, 0)
+        if end <= start:
+            return np.empty(0, dtype=np.uint8)
+
+        buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        first_line, first_base = divmod(start, record.linebases)
+        last_line = (end - 1) // record.linebases
+        begin = record.offset + first_line * record.linewidth + first_base
+
+        if first_line == last_line or record.linewidth == record.linebases:
+            # No line breaks within the slice:
+            seq = buffer[begin : begin + end - start]
+        else:
+            # Whole lines covering the slice, with line breaks removed:
+            block = buffer[
+                record.offset + first_line * record.linewidth :
+                record.offset + (last_line + 1) * record.linewidth
+            ]
+            n_lines = last_line - first_line + 1
+            block = np.concatenate(
+                [block, np.zeros(n_lines * record.linewidth - len(block), np.uint8)]
+            )
+            block = block.reshape(n_lines, record.linewidth)[:, : record.linebases]
+            seq = block.ravel()[first_base : first_base + end - start]
+
+        if upper:
+            seq = to_upper(seq)
+        return seq
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,168 @@
+"""
+Bulk formatting and writing of FASTQ records.
+
+Sequences and qualities are sliced as arrow binary views over their data buffers
+(only the 16-byte views are built with numpy), and the records are assembled
+by arrow string kernels, without a Python loop over the records.
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from . import streams
+
+compressions = streams.compressions
+
+
+def _as_binary(column):
+    """Convert column (arrow, numpy or pandas) into arrow large binary array."""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    elif not isinstance(column, pa.Array):
+        column = pa.array(np.asarray(column))
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        column = column.cast(pa.large_string())
+    return column.cast(pa.large_binary())
+
+
+def _buffers(column):
+    """Offsets and data of arrow large binary array as numpy arrays."""
+    offsets = np.frombuffer(column.buffers()[1], dtype=np.int64)[
+        column.offset : column.offset + len(column) + 1
+    ]
+    data = column.buffers()[2]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, np.uint8)
+    return offsets, data
+
+
+def _slice_bounds(starts, ends, lengths):
+    """Normalize slice bounds as Python slicing value[start:end] does."""
+    starts = np.where(starts < 0, np.maximum(starts + lengths, 0), np.minimum(starts, lengths))
+    ends = np.where(ends < 0, np.maximum(ends + lengths, 0), np.minimum(ends, lengths))
+    return starts, np.maximum(ends, starts)
+
+
+def _unaligned(data, dtype):
+    """View of every position of bytes array as the start of an integer of dtype."""
+    dtype = np.dtype(dtype)
+    return np.ndarray(
+        (len(data) - dtype.itemsize + 1,), dtype=dtype, buffer=data, strides=(1,)
+    )
+
+
+def _low_bytes(values, count):
+    """Keep the first (little-endian) count bytes of unsigned integers, zero the rest."""
+    bits = values.dtype.itemsize * 8
+    count = np.clip(count, 0, values.dtype.itemsize).astype(values.dtype)
+    ones = np.iinfo(values.dtype).max
+    mask = np.where(count * 8 >= bits, ones, (values.dtype.type(1) << (count * 8)) - 1)
+    return values & mask.astype(values.dtype)
+
+
+def _slice(column, starts, ends):
+    """
+    Slice [start:end] of each value of arrow large binary array, without copying
+    the values: the slices are arrow binary views referencing the data buffer.
+    """
+    offsets, data = _buffers(column)
+    lengths = np.diff(offsets)
+    starts, ends = _slice_bounds(starts, ends, lengths)
+    positions = offsets[:-1] + starts
+    lengths = ends - starts
+
+    # Padding allows reading the fixed-size prefix at any position:
+    data = np.concatenate([data, np.zeros(16, dtype=np.uint8)])
+
+    # View (4 x uint32): length, then either inlined value (up to 12 bytes),
+    # or 4 bytes prefix, index of data buffer and offset in it.
+    views = np.zeros((len(column), 4), dtype="<u4")
+    views[:, 0] = lengths
+    views[:, 1] = _unaligned(data, "<u4")[positions]
+    short = lengths <= 12
+    views[~short, 3] = positions[~short]
+    views[short, 1] = _low_bytes(views[short, 1], lengths[short])
+    views[short, 2] = _low_bytes(_unaligned(data, "<u4")[positions[short] + 4], lengths[short] - 4)
+    views[short, 3] = _low_bytes(_unaligned(data, "<u4")[positions[short] + 8], lengths[short] - 8)
+
+    return pa.Array.from_buffers(
+        pa.binary_view(),
+        len(column),
+        [None, pa.py_buffer(views), pa.py_buffer(data)],
+    ).cast(pa.large_binary())
+
+
+def format_fastq(readids, seqs, quals, starts=None, ends=None):
+    """
+    Format FASTQ records with the slices [start:end] of sequences and qualities.
+
+    Parameters
+    ----------
+    readids, seqs, quals: columns of the records (arrow, numpy or pandas)
+    starts, ends: int arrays with the slices of sequences and qualities,
+        the whole sequences if None. Negative values are counted from the end,
+        as in Python slicing.
+
+    Returns
+    -------
+    pa.Buffer with the records
+    """
+    readids, seqs, quals = _as_binary(readids), _as_binary(seqs), _as_binary(quals)
+    n = len(readids)
+    starts = np.zeros(n, dtype=np.int64) if starts is None else np.asarray(starts, np.int64)
+    ends = np.full(n, np.iinfo(np.int32).max) if ends is None else np.asarray(ends, np.int64)
+
+    # Offsets of binary views are int32, split too large inputs:
+    if n > 1 and max(_buffers(seqs)[0][-1], _buffers(quals)[0][-1]) >= 2 ** 31:
+        half = n // 2
+        return pa.py_buffer(
+            format_fastq(readids[:half], seqs[:half], quals[:half], starts[:half], ends[:half]).to_pybytes()
+            + format_fastq(readids[half:], seqs[half:], quals[half:], starts[half:], ends[half:]).to_pybytes()
+        )
+
+    def scalar(value):
+        return pa.scalar(value, pa.large_binary())
+
+    records = pc.binary_join_element_wise(
+        pc.binary_join_element_wise(scalar(b"@"), readids, scalar(b"")),
+        _slice(seqs, starts, ends),
+        scalar(b"+"),
+        _slice(quals, starts, ends),
+        scalar(b""),
+        scalar(b"\n"),
+    )
+    offsets, _ = _buffers(records)
+    if n == 0:
+        return pa.py_buffer(b"")
+    return records.buffers()[2][offsets[0] : offsets[-1]]
+
+
+class FastqWriter:
+    """
+    Writer of the formatted FASTQ records into plain or compressed (gzip, bgzip, zstd) file.
+    Compression is done in background (see streams.CompressedWriter), so that the next records
+    are formatted while the previous ones are compressed.
+
+    Parameters
+    ----------
+    path: output file
+    compression: one of "none", "gzip", "bgzip", "zstd"
+    compresslevel: level of compression, 6 for gzip/bgzip and default of zstd if None
+    """
+
+    def __init__(self, path, compression="none", compresslevel=None):
+        self.compression = compression
+        self._stream = streams.CompressedWriter(path, compression, compresslevel)
+
+    def write(self, buffer):
+        """Write the buffer with formatted records (bytes or pa.Buffer)."""
+        self._stream.write(buffer)
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,212 @@
+"""
+Index of genomic sites (e.g. restriction sites) for the lookup of closest sites.
+
+All the sites are packed into a single array sorted by chromosome and start,
+chromosomes are factorized to integer codes and the sites of each chromosome
+are located by offsets. Lookup of the closest sites for any number of positions
+on any chromosomes is a single binary search with composite
+(chromosome code, position) keys.
+
+The index can be stored in a binary file with a JSON header followed by int64
+arrays of composite keys for each strand partition ("+", "-" and "b" for both
+strands). The arrays are memory-mapped on loading, so that the pages are shared
+by all the processes using the same index.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+
+# Positions are packed into the lower bits of composite keys:
+_position_bits = 32
+_position_mask = (1 << _position_bits) - 1
+
+# Distance reported when there is no site to the left or to the right:
+_missing_distance = 10 ** 10
+
+# Binary index file layout: magic, header size (uint64), JSON header, arrays.
+_magic = b"RNADNASITES\x01"
+_alignment = 8
+strands = ["+", "-", "b"]
+
+
+class SitesIndex:
+    """
+    Sorted sites of multiple chromosomes.
+
+    Parameters
+    ----------
+    chromosomes: names of chromosomes, in the order of their codes
+    keys: int64 array with composite (chromosome code, start) keys of sites, sorted
+    bounds: offsets of the chromosomes in keys, of length len(chromosomes)+1
+    """
+
+    def __init__(self, chromosomes, keys, bounds):
+        self.chromosomes = pd.Index(chromosomes, dtype=object)
+        self.keys = keys
+        self.bounds = np.asarray(bounds, dtype=np.int64)
+
+    @classmethod
+    def from_sites(cls, chrom, start):
+        """
+        Create index from the unsorted arrays of chromosomes and starts of sites.
+        """
+        codes, chromosomes = pd.factorize(np.asarray(chrom).astype(str), sort=True)
+        keys = np.sort(_composite_keys(codes, np.asarray(start).astype(np.int64)))
+        bounds = np.searchsorted(
+            keys >> _position_bits, np.arange(len(chromosomes) + 1)
+        )
+        return cls(chromosomes, keys, bounds)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def starts(self):
+        """Starts of the sites, sorted by chromosome code and start."""
+        return self.keys & _position_mask
+
+    def get_codes(self, chrom):
+        """Integer codes of chromosomes, -1 for chromosomes without sites."""
+        return self.chromosomes.get_indexer(np.asarray(chrom).astype(str))
+
+    def closest(self, codes, positions):
+        """
+        Find the closest sites to the left and to the right of the positions.
+
+        Parameters
+        ----------
+        codes: chromosome codes of the positions, see get_codes
+        positions: int array with positions
+
+        Returns
+        -------
+        (left, right) tuple of int64 arrays with distances from positions to the closest
+        site to the left (<= position) and to the right (> position).
+        If there is no such site on the chromosome, the distance is reported to
+        -1e10 or 1e10 coordinate, respectively. If the chromosome has no sites,
+        both distances are -1.
+        """
+        positions = np.asarray(positions).astype(np.int64)
+        if len(self.chromosomes) == 0:
+            return np.full(len(positions), -1), np.full(len(positions), -1)
+        found = codes >= 0
+        safe_codes = np.where(found, codes, 0)
+
+        idx = np.searchsorted(
+            self.keys, _composite_keys(safe_codes, positions), side="right"
+        )
+        has_left = idx > self.bounds[safe_codes]
+        has_right = idx < self.bounds[safe_codes + 1]
+
+        # Only the sites next to positions are read from the (memory-mapped) keys:
+        last = max(len(self.keys) - 1, 0)
+        keys = self.keys if len(self.keys) else np.zeros(1, dtype=np.int64)
+        left = np.where(
+            has_left, keys[np.clip(idx - 1, 0, last)] & _position_mask, -_missing_distance
+        ) - positions
+        right = np.where(
+            has_right, keys[np.clip(idx, 0, last)] & _position_mask, _missing_distance
+        ) - positions
+
+        left[~found] = -1
+        right[~found] = -1
+        return left, right
+
+
+def index_sites(chrom, start, strand):
+    """
+    Create the index for each strand partition.
+
+    Returns
+    -------
+    dict with strand ("+", "-", "b") as key and SitesIndex as value
+    """
+    chrom, start, strand = np.asarray(chrom), np.asarray(start), np.asarray(strand)
+    partitions = {}
+    for name in strands:
+        mask = np.full(len(chrom), True) if name == "b" else strand == name
+        partitions[name] = SitesIndex.from_sites(chrom[mask], start[mask])
+    return partitions
+
+
+def write_index(path, partitions):
+    """
+    Write the strand partitions of the index into binary file.
+
+    Parameters
+    ----------
+    path: output file
+    partitions: dict with strand as key and SitesIndex as value, see index_sites
+    """
+    header = {"version": 1, "partitions": {}}
+    offset = 0
+    for name, index in partitions.items():
+        header["partitions"][name] = {
+            "chromosomes": [str(x) for x in index.chromosomes],
+            "bounds": [int(x) for x in index.bounds],
+            "offset": offset,
+            "length": len(index),
+        }
+        offset += len(index) * 8
+
+    header = json.dumps(header).encode()
+    start = len(_magic) + 8 + len(header)
+    header += b" " * (-start % _alignment)
+
+    with open(path, "wb") as outfile:
+        outfile.write(_magic)
+        outfile.write(np.uint64(len(header)).tobytes())
+        outfile.write(header)
+        for index in partitions.values():
+            outfile.write(np.ascontiguousarray(index.keys, dtype="<i8").tobytes())
+
+
+def is_index(path):
+    """Check whether the file is a binary sites index."""
+    with open(path, "rb") as infile:
+        return infile.read(len(_magic)) == _magic
+
+
+def load_index(path, strand="b"):
+    """
+    Load the strand partition of the index from binary file, with memory-mapped keys.
+    """
+    with open(path, "rb") as infile:
+        if infile.read(len(_magic)) != _magic:
+            raise ValueError(f"File {path} is not a sites index.")
+        header_size = int(np.frombuffer(infile.read(8), dtype="<u8")[0])
+        header = json.loads(infile.read(header_size))
+    data_start = len(_magic) + 8 + header_size
+
+    if strand not in header["partitions"]:
+        raise ValueError(
+            f"Strand {strand} is not in sites index {path}, "
+            f"available: {', '.join(header['partitions'])}"
+        )
+    partition = header["partitions"][strand]
+    if partition["length"] > 0:
+        keys = np.memmap(
+            path,
+            dtype="<i8",
+            mode="r",
+            offset=data_start + partition["offset"],
+            shape=(partition["length"],),
+        )
+    else:
+        keys = np.empty(0, dtype=np.int64)
+    return SitesIndex(partition["chromosomes"], keys, partition["bounds"])
+
+
+def _composite_keys(codes, positions):
+    """Pack chromosome codes and positions into sortable int64 keys."""
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) and (
+        positions.min() < 0 or positions.max() >= 2 ** _position_bits
+    ):
+        raise ValueError(
+            f"Positions should be in the range [0, 2^{_position_bits}), "
+            f"got: [{positions.min()}, {positions.max()}]"
+        )
+    return (np.asarray(codes, dtype=np.int64) << _position_bits) | positions
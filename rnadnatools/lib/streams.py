@@ -0,0 +1,272 @@
+"""
+Compressed (gzip, bgzip, zstd) streams of text tables and FASTQ files.
+
+The compression of input is detected by the signature at the start of file
+(bgzip is read as gzip), and the compression of output by its extension
+(.gz, .bgz, .zst). Inputs are decompressed by arrow streams, optionally read ahead
+by a background thread, so that parsing does not wait for inflate.
+Outputs are compressed in background: gzip by a single thread (the stream is sequential),
+bgzip and zstd by a pool of threads compressing independent blocks
+(BGZF blocks and zstd frames) that are written in order.
+
+Example:
+    with open_output("output.tsv.zst") as outfile:
+        outfile.write(b"a\tb\n")
+"""
+
+import gzip
+import io
+import os
+import os.path as op
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+
+compressions = ["none", "gzip", "bgzip", "zstd"]
+extensions = {".gz": "gzip", ".bgz": "bgzip", ".zst": "zstd"}
+
+# Signatures of compressed files:
+signatures = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+# BGZF block header (with the length of the block appended) and end-of-file block,
+# as written by samtools and Bio.bgzf:
+_bgzf_header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+_bgzf_eof = _bgzf_header + b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+_bgzf_block_size = 65536
+
+
+def detect_compression(in_path):
+    """Compression of the file by its signature: "gzip" (also bgzip), "zstd" or "none"."""
+    with open(in_path, "rb") as infile:
+        head = infile.read(4)
+    return signatures.get(head[:2]) or signatures.get(head[:4]) or "none"
+
+
+def get_compression(path):
+    """Compression of the output file by its extension, "none" for other extensions."""
+    return extensions.get(op.splitext(path)[1].lower(), "none")
+
+
+def open_input(in_path, compression="auto", readahead=False):
+    """
+    Open the (compressed) file for binary reading.
+
+    Parameters
+    ----------
+    in_path: input file
+    compression: one of "none", "gzip", "bgzip", "zstd" or "auto" (detected by signature)
+    readahead: decompress the blocks ahead of reading by a background thread
+        (for python readers, e.g. pandas; arrow readers read ahead themselves)
+
+    Returns
+    -------
+    pyarrow input stream, or buffered reader with readahead
+    """
+    if compression == "auto":
+        compression = detect_compression(in_path)
+    if compression not in compressions:
+        raise ValueError(
+            f"Compression {compression} is not supported, use one of: {', '.join(compressions)}"
+        )
+    if compression == "none":
+        return pa.input_stream(in_path)
+    stream = pa.input_stream(
+        in_path, compression="gzip" if compression == "bgzip" else compression
+    )
+    if readahead:
+        return io.BufferedReader(_ReadaheadReader(stream))
+    return stream
+
+
+def open_output(path, compression="auto", **kwargs):
+    """
+    Open the file for binary writing, compressed in background.
+    Compression is guessed from the extension of path for "auto".
+    See CompressedWriter for the other parameters.
+    """
+    if compression == "auto":
+        compression = get_compression(path)
+    return CompressedWriter(path, compression, **kwargs)
+
+
+class _ReadaheadReader(io.RawIOBase):
+    """Raw reader of the stream with the blocks read ahead by a background thread."""
+
+    def __init__(self, stream, block_size=1 << 20, n_blocks=4):
+        self._stream = stream
+        self._queue = queue.Queue(maxsize=n_blocks)
+        self._stop = False
+        self._block = b""
+        self._offset = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, args=(block_size,), daemon=True)
+        self._thread.start()
+
+    def _run(self, block_size):
+        try:
+            while not self._stop:
+                block = self._stream.read(block_size)
+                self._queue.put(block)
+                if len(block) == 0:
+                    break
+        except Exception as e:
+            self._queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset >= len(self._block):
+            if self._eof:
+                return 0
+            block = self._queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if len(block) == 0:
+                self._eof = True
+                return 0
+            self._block, self._offset = memoryview(block), 0
+        n = min(len(b), len(self._block) - self._offset)
+        b[:n] = self._block[self._offset : self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            # Unblock and stop the background thread:
+            self._stop = True
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._stream.close()
+        super().close()
+
+
+def _compress_bgzf(data, compresslevel):
+    """Compress the data into BGZF blocks of 65536 bytes (the last block can be shorter)."""
+    blocks = []
+    for start in range(0, len(data), _bgzf_block_size):
+        block = data[start : start + _bgzf_block_size]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, 0)
+        compressed = compressor.compress(block) + compressor.flush()
+        blocks += [
+            _bgzf_header,
+            struct.pack("<H", len(compressed) + 25),
+            compressed,
+            struct.pack("<II", zlib.crc32(block) & 0xFFFFFFFF, len(block)),
+        ]
+    return b"".join(blocks)
+
+
+class CompressedWriter:
+    """
+    Writer of the binary data into plain or compressed file.
+    Compression is done in background, so that the next data are prepared
+    while the previous ones are compressed. bgzip and zstd data are split into
+    batches of batch_size bytes compressed in parallel by nthreads threads
+    (each batch is a sequence of BGZF blocks or a zstd frame).
+
+    Parameters
+    ----------
+    path: output file
+    compression: one of "none", "gzip", "bgzip", "zstd"
+    compresslevel: level of compression, 6 for gzip/bgzip and default of zstd if None
+    nthreads: number of threads compressing bgzip/zstd, number of CPUs if None
+    batch_size: number of bytes in a batch compressed by a thread
+    """
+
+    def __init__(
+        self, path, compression="none", compresslevel=None, nthreads=None, batch_size=1 << 20
+    ):
+        if compression not in compressions:
+            raise ValueError(
+                f"Compression {compression} is not supported, use one of: {', '.join(compressions)}"
+            )
+        self.compression = compression
+        self.batch_size = batch_size
+        if compression in ["gzip", "bgzip"] and compresslevel is None:
+            compresslevel = 6
+
+        self._pool = None
+        self._pending = deque()
+        self._buffer = bytearray()
+        if compression == "gzip":
+            self._file = gzip.open(path, "wb", compresslevel=compresslevel)
+            self._pool = ThreadPoolExecutor(1)
+            self._max_pending = 4
+        else:
+            self._file = open(path, "wb")
+        if compression in ["bgzip", "zstd"]:
+            nthreads = nthreads or os.cpu_count() or 1
+            self._pool = ThreadPoolExecutor(nthreads)
+            self._max_pending = 2 * nthreads
+        if compression == "bgzip":
+            # Batches are split at the borders of BGZF blocks:
+            self.batch_size = max(batch_size // _bgzf_block_size, 1) * _bgzf_block_size
+            self._compress = lambda data: _compress_bgzf(data, compresslevel)
+        elif compression == "zstd":
+            codec = pa.Codec("zstd", compression_level=compresslevel)
+            self._compress = lambda data: codec.compress(data, asbytes=True)
+
+    def write(self, data):
+        """Write the data (bytes or pa.Buffer)."""
+        if self.compression == "none":
+            self._file.write(data)
+        elif self.compression == "gzip":
+            # The data are referenced until written, bytearray and memoryview are copied:
+            if not isinstance(data, (bytes, pa.Buffer)):
+                data = bytes(data)
+            self._submit(self._file.write, data)
+        else:
+            self._buffer += data
+            if len(self._buffer) >= self.batch_size:
+                n_full = len(self._buffer) - len(self._buffer) % self.batch_size
+                for start in range(0, n_full, self.batch_size):
+                    self._submit(
+                        self._compress, bytes(self._buffer[start : start + self.batch_size])
+                    )
+                del self._buffer[:n_full]
+
+    def _submit(self, task, data):
+        self._pending.append(self._pool.submit(task, data))
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending):
+        """Wait for the oldest tasks and write the compressed batches in order."""
+        while len(self._pending) > max_pending:
+            result = self._pending.popleft().result()
+            # gzip data are written by the task itself:
+            if self.compression != "gzip":
+                self._file.write(result)
+
+    def close(self):
+        """Compress the rest of data and close the file."""
+        if self._pool is None:
+            self._file.close()
+            return
+        try:
+            if len(self._buffer) > 0:
+                self._submit(self._compress, bytes(self._buffer))
+                self._buffer = bytearray()
+            self._drain(0)
+            if self.compression == "bgzip":
+                self._file.write(_bgzf_eof)
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+            self._pool = None
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
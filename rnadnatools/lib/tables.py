@@ -0,0 +1,578 @@
+"""
+Arrow-native reading and writing of TSV/CSV, PARQUET and HDF5 tables.
+
+Tables of any format are read as the stream of pyarrow tables (read_batches),
+so that the commands operate on arrow columns regardless of the format.
+Numeric columns are passed between arrow and PARQUET/HDF5 without conversion
+(HDF5 datasets are wrapped by arrow arrays without copying), text columns
+of HDF5 are decoded to strings. TSV/CSV tables can be compressed (gzip, bgzip, zstd),
+detected by the signature of input and by the extension of output.
+TSV/CSV tables are parsed by blocks in parallel by arrow reader, converting
+only the selected columns, with pandas reader as the fallback.
+
+The types of TSV/CSV columns are inferred from the start of table, and promoted
+(to string, see _promote_schema) if a later chunk does not fit them.
+The output schema (column names and types) is fixed by the first written chunk,
+or given explicitly, and the following chunks are cast to it, so that the types
+do not drift between chunks. If a chunk cannot be cast to the inferred schema,
+the schema is promoted and the rows already written are converted.
+Parquet chunks are buffered into row groups of row_group_size rows.
+
+Example:
+    with TableWriter("output.pq", "PARQUET") as writer:
+        for chunk in read_batches("input.tsv", "TSV", chunksize=1_000_000):
+            writer.write(chunk)
+"""
+
+import csv
+import io
+import os
+import re
+from contextlib import nullcontext
+
+import h5py
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from . import get_logger
+from . import streams
+
+logger = get_logger(__name__)
+
+formats = ["TSV", "CSV", "PARQUET", "HDF5"]
+engines = ["auto", "arrow", "pandas"]
+
+# Type of text columns in HDF5 output (variable-length UTF-8 strings of any length):
+hdf5_text_dtype = h5py.string_dtype()
+
+
+def read_batches(
+    in_path,
+    in_format,
+    chunksize=None,
+    columns=None,
+    header="infer",
+    column_types=None,
+    engine="auto",
+):
+    """
+    Iterate over the table by chunks converted to arrow.
+
+    Parameters
+    ----------
+    in_path: input file
+    in_format: Type of input. Can be either "TSV", "CSV", "PARQUET", "HDF5"
+    chunksize: number of rows in each chunk, the whole table is read at once if None
+    columns: names (str) or positions (int) of the columns to read, all columns if None.
+        The absent columns are ignored, the columns are in the order of the table.
+    header: row number with the column names of TSV/CSV input (as in pandas),
+        None for the table without header (columns are named "0", "1", ...)
+    column_types: dict with pyarrow types of TSV/CSV columns by name,
+        the types of other columns are inferred
+    engine: parser of TSV/CSV input, one of "arrow", "pandas" or "auto"
+        (arrow, falling back to pandas if arrow fails to parse the first chunk)
+
+    Returns
+    -------
+    iterator with pa.Table chunks, with the types of the first chunk, except for TSV/CSV
+    columns promoted by later chunks (combine the chunks with concat_tables)
+    """
+    if in_format.upper() == "PARQUET":
+        return _read_parquet(in_path, chunksize, columns)
+    elif in_format.upper() == "HDF5":
+        return _read_hdf5(in_path, chunksize, columns)
+    elif in_format.upper() in ["TSV", "CSV"]:
+        return _read_text(in_path, in_format, chunksize, columns, header, column_types, engine)
+    else:
+        raise ValueError(
+            f"Format {in_format} is not supported, use one of: {', '.join(formats)}."
+        )
+
+
+def read_text_header(in_path, in_format, header="infer"):
+    """
+    Column names of TSV/CSV table (possibly compressed) from the header row,
+    "0", "1", ... for the table without header (header=None).
+    The names are kept as is, including '#' of the header line.
+    """
+    if header == "infer":
+        header = 0
+    with io.TextIOWrapper(streams.open_input(in_path), newline="") as infile:
+        lines = csv.reader(infile, delimiter="," if in_format.upper() == "CSV" else "\t")
+        for i, names in enumerate(lines):
+            if i == (header or 0):
+                break
+        else:
+            return []
+    if header is None:
+        return [str(x) for x in range(len(names))]
+    return names
+
+
+def count_rows(in_path, in_format):
+    """Number of rows in the table, from the metadata for PARQUET and HDF5."""
+    if in_format.upper() == "PARQUET":
+        return pq.ParquetFile(in_path).metadata.num_rows
+    elif in_format.upper() == "HDF5":
+        with h5py.File(in_path, "r") as h:
+            return _hdf5_length(h, list(h.keys()), in_path)
+    return sum(
+        x.num_rows for x in read_batches(in_path, in_format, 1_000_000, columns=[0])
+    )
+
+
+def concat_tables(tables):
+    """
+    Concatenate the tables with the same columns into single table,
+    promoting the types that differ between the tables (see _promote_schema).
+    """
+    schema = tables[0].schema
+    for table in tables[1:]:
+        schema = _promote_schema(schema, table.schema)
+    return pa.concat_tables(
+        [table if table.schema.equals(schema) else table.cast(schema) for table in tables]
+    )
+
+
+def _promote_schema(schema, other):
+    """
+    Common schema of two schemas with the same columns: null type is promoted to the other
+    type, integers to int64 or float64 (by floats), and the other different types to string.
+    """
+    fields = []
+    for field, other_field in zip(schema, other):
+        a, b = field.type, other_field.type
+        if a == b or pa.types.is_null(b):
+            promoted = a
+        elif pa.types.is_null(a):
+            promoted = b
+        elif pa.types.is_integer(a) and pa.types.is_integer(b):
+            promoted = pa.int64()
+        elif all(pa.types.is_integer(x) or pa.types.is_floating(x) for x in [a, b]):
+            promoted = pa.float64()
+        elif pa.types.is_large_string(a) or pa.types.is_large_string(b):
+            promoted = pa.large_string()
+        else:
+            promoted = pa.string()
+        fields.append(field.with_type(promoted))
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def _select_columns(names, columns):
+    """Names of the selected columns (names or positions), in the order of the table."""
+    if columns is None:
+        return list(names)
+    selected = set(
+        names[x] if isinstance(x, int) and x < len(names) else x for x in columns
+    )
+    return [x for x in names if x in selected]
+
+
+def _rebatch(batches, chunksize):
+    """
+    Regroup the stream of pyarrow record batches into tables of exactly chunksize rows
+    (except for the last one), or into single table if chunksize is None.
+    Row groups of different files are not aligned, so the batches of parquet readers
+    cannot be zipped directly.
+    """
+    buffer = []
+    buffered = 0
+    for batch in batches:
+        buffer.append(pa.Table.from_batches([batch]))
+        buffered += batch.num_rows
+        while chunksize is not None and buffered >= chunksize:
+            frame = concat_tables(buffer)
+            yield frame.slice(0, chunksize)
+            buffer = [frame.slice(chunksize)]
+            buffered -= chunksize
+    if buffered > 0 or (chunksize is None and buffer):
+        yield concat_tables(buffer)
+
+
+def _read_parquet(in_path, chunksize, columns):
+    parquet_file = pq.ParquetFile(in_path, memory_map=True)
+    columns = _select_columns(parquet_file.schema_arrow.names, columns)
+    if chunksize is None:
+        yield parquet_file.read(columns=columns)
+    else:
+        yield from _rebatch(
+            parquet_file.iter_batches(batch_size=chunksize, columns=columns), chunksize
+        )
+
+
+def _hdf5_length(h, keys, in_path):
+    lengths = set(h[k].len() for k in keys)
+    if len(lengths) > 1:
+        raise ValueError(f"Different number of rows in columns of {in_path}")
+    return lengths.pop() if len(lengths) > 0 else 0
+
+
+def _hdf5_to_arrow(values):
+    """Wrap the values of HDF5 dataset by arrow array, decoding text to strings."""
+    array = pa.array(values)
+    if pa.types.is_binary(array.type) or pa.types.is_fixed_size_binary(array.type):
+        try:
+            array = array.cast(pa.string())
+        except pa.ArrowInvalid:
+            pass
+    return array
+
+
+def _read_hdf5(in_path, chunksize, columns):
+    with h5py.File(in_path, "r") as h:
+        keys = _select_columns(list(h.keys()), columns)
+        n_rows = _hdf5_length(h, keys, in_path)
+        for start in range(0, n_rows, chunksize or max(n_rows, 1)):
+            stop = start + chunksize if chunksize else None
+            yield pa.table({k: _hdf5_to_arrow(h[k][start:stop]) for k in keys})
+
+
+def _read_text(in_path, in_format, chunksize, columns, header, column_types, engine):
+    if engine not in engines:
+        raise ValueError(f"Engine {engine} is not supported, use one of: {', '.join(engines)}.")
+    if engine != "pandas":
+        batches = _read_text_arrow(in_path, in_format, chunksize, columns, header, column_types)
+        try:
+            first = next(batches, None)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            if engine == "arrow":
+                raise
+            logger.warning(f"Arrow cannot parse {in_path}, falling back to pandas: {e}")
+        else:
+            if first is not None:
+                yield first
+            try:
+                yield from batches
+            except pa.ArrowInvalid as e:
+                raise ValueError(f"Parsing of {in_path} failed after the first chunk:\n{e}")
+            return
+    yield from _read_text_pandas(in_path, in_format, chunksize, columns, header, column_types)
+
+
+def _read_text_arrow(in_path, in_format, chunksize, columns, header, column_types):
+    """Read TSV/CSV table by the blocks parsed in parallel by arrow reader."""
+    names = read_text_header(in_path, in_format, header)
+    selected = _select_columns(names, columns)
+    if header == "infer":
+        header = 0
+    column_types = {k: v for k, v in (column_types or {}).items() if k in selected}
+    blocks = _iter_text_blocks(
+        in_path, in_format, names, selected, 0 if header is None else header + 1, column_types
+    )
+    yield from _rebatch(blocks, chunksize)
+
+
+def _iter_text_blocks(in_path, in_format, names, selected, skip_rows, column_types):
+    """
+    Record batches of TSV/CSV table parsed by arrow, with the types inferred from the first
+    block. If a later block does not fit the inferred type of a column (e.g. chromosome
+    "X" after "1"), the table is parsed again with the inferred types kept
+    and the failed column read as string, skipping the rows already read.
+    """
+    given = set(column_types)
+    n_read = 0
+    while True:
+        n_skip = n_read
+        with streams.open_input(in_path) as infile:
+            reader = pa_csv.open_csv(
+                infile,
+                read_options=pa_csv.ReadOptions(
+                    skip_rows=skip_rows,
+                    column_names=names,
+                    use_threads=True,
+                ),
+                parse_options=pa_csv.ParseOptions(
+                    delimiter="," if in_format.upper() == "CSV" else "\t"
+                ),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types=column_types,
+                    include_columns=selected,
+                    strings_can_be_null=True,
+                ),
+            )
+            try:
+                if n_read == 0:
+                    # Empty table is read with the columns and the types of header:
+                    yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+                for batch in reader:
+                    if n_skip >= batch.num_rows:
+                        n_skip -= batch.num_rows
+                        continue
+                    batch = batch.slice(n_skip)
+                    n_skip = 0
+                    n_read += batch.num_rows
+                    yield batch
+                return
+            except pa.ArrowInvalid as e:
+                failed = re.match(r"In CSV column #(\d+)", str(e))
+                name = names[int(failed.group(1))] if failed else None
+                if name is None or name in given or name not in reader.schema.names:
+                    raise
+                if reader.schema.field(name).type == pa.string():
+                    raise
+                logger.warning(
+                    f"Column {name} of {in_path} does not fit the type "
+                    f"{reader.schema.field(name).type} inferred from the start of table "
+                    f"after {n_read} rows, it is read as string: {e}"
+                )
+                column_types = dict(zip(reader.schema.names, reader.schema.types))
+                column_types[name] = pa.string()
+
+
+def _read_text_pandas(in_path, in_format, chunksize, columns, header, column_types):
+    """
+    Read TSV/CSV table by pandas chunks, cast to the types of the first chunk,
+    promoted if a later chunk does not fit them (see _promote_schema).
+    """
+    if columns is not None and all(isinstance(x, int) for x in columns):
+        usecols = list(columns)
+    elif columns is not None:
+        usecols = lambda x: x in columns
+    else:
+        usecols = None
+    # Compressed input is decompressed ahead of parsing by a background thread:
+    if streams.detect_compression(in_path) != "none":
+        source = streams.open_input(in_path, readahead=True)
+    else:
+        source = nullcontext(in_path)
+    with source as infile:
+        # Types are inferred from the whole chunk, not mixed by the blocks of parser:
+        stream = pd.read_csv(
+            infile,
+            sep="," if in_format.upper() == "CSV" else "\t",
+            header=header,
+            chunksize=chunksize,
+            usecols=usecols,
+            low_memory=False,
+        )
+        if chunksize is None:
+            stream = [stream]
+        schema = None
+        for chunk in stream:
+            chunk.columns = [str(x) for x in chunk.columns]
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            for name, column_type in (column_types or {}).items():
+                if name in table.column_names:
+                    i = table.column_names.index(name)
+                    table = table.set_column(i, name, table[name].cast(column_type))
+            # Chunks of text tables should retain the types of the first chunk:
+            if schema is None:
+                schema = table.schema
+            elif not table.schema.equals(schema):
+                try:
+                    table = table.cast(schema)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    schema = _promote_schema(schema, table.schema)
+                    table = table.cast(schema)
+            yield table
+
+
+class TableWriter:
+    """
+    Writer of the table chunk by chunk, closed deterministically as a context manager.
+    If the body of the context raises, the partial output is removed.
+    Chunks are converted to arrow and cast to the output schema for all formats.
+
+    Parameters
+    ----------
+    path: output file, TSV/CSV output is compressed by the extension (.gz, .bgz, .zst)
+    out_format: one of "TSV", "CSV", "PARQUET", "HDF5"
+    schema: pa.Schema of the output, taken from the first chunk if None.
+        The schema of the first chunk is promoted by the chunks that do not fit it
+        (e.g. integer column of text table with strings in later chunks),
+        the given schema is fixed.
+    row_group_size: number of rows in the row groups of PARQUET output
+    compression: compression of PARQUET output
+    use_dictionary: dictionary encoding of PARQUET output,
+        True/False for all columns or list of column names
+    """
+
+    def __init__(
+        self,
+        path,
+        out_format,
+        schema=None,
+        row_group_size=1_000_000,
+        compression="snappy",
+        use_dictionary=True,
+    ):
+        if out_format.upper() not in formats:
+            raise ValueError(
+                f"Format {out_format} is not supported, use one of: {', '.join(formats)}."
+            )
+        self.path = path
+        self.out_format = out_format.upper()
+        self.schema = schema
+        self.fixed_schema = schema is not None
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.use_dictionary = use_dictionary
+        self.n_rows = 0
+
+        self._writer = None
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, chunk):
+        """
+        Write the chunk: pa.Table, pa.RecordBatch, dict of arrays or pd.DataFrame
+        with the columns of the schema.
+        """
+        table = self._conform(_as_table(chunk))
+        if self.out_format == "PARQUET":
+            self._buffer.append(table)
+            self._buffered += table.num_rows
+            if self._buffered >= self.row_group_size:
+                self._flush(final=False)
+        elif self.out_format == "HDF5":
+            self._write_hdf5(table)
+        else:
+            self._write_text(table)
+        self.n_rows += table.num_rows
+
+    def _conform(self, table):
+        """Cast the table to the schema, or fix the schema by the first table."""
+        if self.schema is None:
+            self.schema = table.schema
+            return table
+        if table.schema.names != self.schema.names:
+            raise ValueError(
+                f"Columns of the chunk {table.schema.names} differ "
+                f"from the columns of the output {self.schema.names}"
+            )
+        if table.schema.equals(self.schema):
+            return table
+        try:
+            return table.cast(self.schema)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            if self.fixed_schema:
+                raise ValueError(
+                    f"Chunk cannot be written with the schema of the output:\n{self.schema}\n{e}"
+                )
+        self._promote(_promote_schema(self.schema, table.schema))
+        return table.cast(self.schema)
+
+    def _promote(self, schema):
+        """Promote the output to the schema, converting the rows already written."""
+        logger.warning(f"Types of {self.path} are promoted by the chunk, to:\n{schema}")
+        if self.out_format == "PARQUET" and self._writer is not None:
+            # Parquet file cannot change the types, it is rewritten:
+            self._writer.close()
+            written = pq.read_table(self.path).cast(schema)
+            self._writer = self._open_parquet(schema)
+            self._writer.write_table(written, row_group_size=self.row_group_size)
+        elif self.out_format == "HDF5" and self._writer is not None:
+            for field, written in zip(schema, self.schema):
+                if field.type != written.type:
+                    values = _hdf5_to_arrow(self._writer[field.name][:]).cast(field.type)
+                    del self._writer[field.name]
+                    self._create_dataset(field.name, values)
+        self._buffer = [table.cast(schema) for table in self._buffer]
+        self.schema = schema
+
+    def _open_parquet(self, schema):
+        return pq.ParquetWriter(
+            self.path,
+            schema,
+            compression=self.compression,
+            use_dictionary=self.use_dictionary,
+        )
+
+    def _flush(self, final):
+        """Write the buffered tables as full row groups, and the remainder if final."""
+        if self._writer is None:
+            self._writer = self._open_parquet(self.schema)
+        table = pa.concat_tables(self._buffer) if self._buffer else self.schema.empty_table()
+        n_full = table.num_rows - table.num_rows % self.row_group_size
+        if final:
+            n_full = table.num_rows
+        if n_full > 0:
+            self._writer.write_table(
+                table.slice(0, n_full), row_group_size=self.row_group_size
+            )
+        self._buffer = [table.slice(n_full)] if n_full < table.num_rows else []
+        self._buffered = table.num_rows - n_full
+
+    def _write_hdf5(self, table):
+        if self._writer is None:
+            self._writer = h5py.File(self.path, "w")
+            for name, column in zip(table.column_names, table.columns):
+                self._create_dataset(name, column)
+        else:
+            for name, column in zip(table.column_names, table.columns):
+                dataset = self._writer[name]
+                dataset.resize((self.n_rows + table.num_rows,))
+                dataset[self.n_rows :] = _hdf5_values(column)
+
+    def _create_dataset(self, name, column):
+        values = _hdf5_values(column)
+        self._writer.create_dataset(
+            name, data=values, dtype=values.dtype, maxshape=(None,), chunks=True
+        )
+
+    def _write_text(self, table):
+        # Text is formatted by pandas, as in the tables written by the previous versions,
+        # and compressed in background by the extension of path (.gz, .bgz, .zst):
+        header = self._writer is None
+        if header:
+            self._writer = streams.open_output(self.path)
+        text = table.to_pandas().to_csv(
+            sep="," if self.out_format == "CSV" else "\t",
+            header=header,
+            index=False,
+        )
+        self._writer.write(text.encode())
+
+    def close(self):
+        """Write the buffered rows and close the file."""
+        if self.out_format == "PARQUET":
+            if self._buffer or (self._writer is None and self.schema is not None):
+                self._flush(final=True)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self):
+        """Close the file without writing the buffered rows and remove the partial output."""
+        self._buffer = []
+        self._buffered = 0
+        try:
+            if self._writer is not None:
+                self._writer.close()
+        finally:
+            self._writer = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def _as_table(chunk):
+    """Convert the chunk into pa.Table."""
+    if isinstance(chunk, pa.Table):
+        return chunk
+    elif isinstance(chunk, pa.RecordBatch):
+        return pa.Table.from_batches([chunk])
+    elif isinstance(chunk, pd.DataFrame):
+        chunk = chunk.rename(columns=str)
+        return pa.Table.from_pandas(chunk, preserve_index=False)
+    else:
+        return pa.Table.from_pydict({str(k): v for k, v in chunk.items()})
+
+
+def _hdf5_values(column):
+    """Values of arrow column for HDF5 dataset, text is stored as variable-length strings."""
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        # Missing values are stored as empty strings:
+        return column.fill_null("").to_numpy(zero_copy_only=False).astype(hdf5_text_dtype)
+    return np.asarray(column.to_numpy(zero_copy_only=False))
@@ -9,14 +9,56 @@ import h5py
 import pandas as pd
 import numpy as np
 import csv
+import io
+import os
+from functools import lru_cache
+from itertools import zip_longest
+from collections import deque
+
+from . import streams
+from . import tables
 
 #### Define specific functions for evaluation:
 import re
+import pyarrow.compute as pc
+
+
 def match(v, expr):
-    r = re.compile(expr)
-    matcher = np.vectorize(lambda x:bool(r.match(x)))
+    """
+    Check whether the strings of v match the regular expression expr
+    at their beginning (as re.match does). Null entries do not match.
+
+    The matching is done by pyarrow regex kernel over the whole column.
+    Pyarrow arrays (or compute expressions) are matched without conversion
+    and the result is pyarrow boolean array, numpy arrays and pd.Series are
+    converted to arrow and the result is numpy boolean array.
+    Expressions not supported by arrow (RE2 syntax) are matched with Python re.
+    """
+    pattern = f"^(?:{expr})"
+
+    if isinstance(v, pc.Expression):
+        return pc.coalesce(
+            pc.match_substring_regex(v, pattern=pattern), pc.scalar(False)
+        )
+
+    is_arrow = isinstance(v, (pa.Array, pa.ChunkedArray))
+    if is_arrow:
+        values = v
+    elif isinstance(v, pd.Series):
+        values = pa.Array.from_pandas(v)
+    else:
+        values = pa.array(np.asarray(v, dtype=object), from_pandas=True)
+
+    try:
+        result = pc.match_substring_regex(values, pattern=pattern).fill_null(False)
+    except pa.ArrowInvalid:
+        r = re.compile(expr)
+        matcher = np.vectorize(lambda x: x is not None and bool(r.match(x)), otypes=[bool])
+        result = pa.array(matcher(values.to_numpy(zero_copy_only=False)))
 
-    return matcher(v)
+    if is_arrow:
+        return result
+    return result.to_numpy(zero_copy_only=False)
 
 def pick_positions(v1, v2, threshold=99999):
     """
@@ -43,215 +85,226 @@ def pick_largest(*vectors):
     return vectors.max(axis=0)
 
 #### File management utilities:
-def guess_format(in_path):
-    """Guess the file format of in_path."""
-
-    if h5py.is_hdf5(in_path):
-        return "hdf5"
-    else:
-        try:
-            file = open(in_path, "r")
-            sample = file.read(1024)
-            dialect = csv.Sniffer().sniff(sample, delimiters=[","])
-            file.seek(0)
-            return "csv"
-        except Exception as e:
-            try:
-                file = open(in_path, "r")
-                sample = file.read(1024)
-                dialect = csv.Sniffer().sniff(sample, delimiters=["\t", " "])
-                file.seek(0)
-                return "tsv"
-            except Exception as e:
-                try:
-                    pq.read_table(in_path)
-                    return "parquet"
-                except Exception as e:
-                    return None
-
-def update_df_chunk(input_stream, dct, key=3):
-    """
-    Update chunk read from instream into dct dictionary.
+# Signatures of binary formats:
+_hdf5_magic = b"\x89HDF\r\n\x1a\n"
+_parquet_magic = b"PAR1"
+_text_extensions = {".csv": "csv", ".tsv": "tsv", ".txt": "tsv", ".bed": "tsv"}
 
-    Parameters
-    ----------
-    input_stream: stream of dataframes from file
-    dct: output dictionary
-    key: column of input stream dataframes that will be used as dict keys
-
-    Returns
-    -------
 
+def guess_format(in_path):
     """
+    Guess the file format of in_path: "parquet", "hdf5", "csv", "tsv" or None.
 
-    try:
-        df = next(input_stream)
-    except StopIteration as e:
-        raise StopIteration("Update impossible")
-
-    l = len(df)
-    dct_tmp = df.to_dict(orient='list')
-    dct_tmp = {dct_tmp[key][i]: {k: dct_tmp[k][i] for k in dct_tmp.keys()} for i in range(l)}
+    Binary formats are detected by the signatures at the start (and the end) of file,
+    text tables by the extension (compression extensions are skipped)
+    or by sniffing the delimiter of the first lines. Only a few bytes are read,
+    and the result is cached for the path until the file is modified.
+    """
+    stat = os.stat(in_path)
+    return _guess_format(os.path.abspath(in_path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=None)
+def _guess_format(in_path, mtime, size):
+    """Guess the format of the file with the modification time and size, see guess_format."""
+    with open(in_path, "rb") as infile:
+        head = infile.read(8)
+        if size >= 12:
+            infile.seek(-4, os.SEEK_END)
+            tail = infile.read(4)
+        else:
+            tail = b""
 
-    dct.update(dct_tmp)
+    if head.startswith(_hdf5_magic):
+        return "hdf5"
+    if head.startswith(_parquet_magic) and tail == _parquet_magic:
+        return "parquet"
+
+    # Text table, possibly compressed:
+    root, extension = os.path.splitext(in_path)
+    compression = streams.signatures.get(head[:2]) or streams.signatures.get(head[:4])
+    if extension.lower() in streams.extensions:
+        extension = os.path.splitext(root)[1]
+    if extension.lower() in _text_extensions:
+        return _text_extensions[extension.lower()]
+
+    # HDF5 file with user block (signature at 512, 1024, ... bytes):
+    if compression is None and h5py.is_hdf5(in_path):
+        return "hdf5"
 
-    return dct, df.columns, dict(df.dtypes)
+    try:
+        with io.TextIOWrapper(streams.open_input(in_path, compression or "none")) as infile:
+            sample = infile.read(1024)
+        dialect = csv.Sniffer().sniff(sample, delimiters=[",", "\t", " "])
+    except Exception:
+        return None
+    return "csv" if dialect.delimiter == "," else "tsv"
 
 
-def write_chunk(chunk, output_file, out_format, writer=None, s=None, mode='w'):
+def load_table(in_path,
+               in_format="AUTO",
+               chunksize=None,
+               usecols=None,
+               header=None,
+               column_types=None,
+               engine="auto"):
     """
-    Write chunk table into output file in a desired format.
-    hdf5 not tested yet.
+    Iterate over the table by chunks of chunksize rows. PARQUET chunks are read
+    by batches of row groups and HDF5 chunks by slices of datasets, only the columns
+    in usecols are loaded, so that only a chunk is kept in memory for any format.
 
     Parameters
     ----------
-    chunk
-    output_file
-    out_format
-    writer: writer (for hdf5 and parquet)
-    s: length of written objects (for hdf5)
-    mode: 'w' for writing or 'a' for appending
+    in_path: input file
+    in_format: Type of input. Can be either "TSV", "CSV", "PARQUET", "HDF5", "AUTO"
+    chunksize: number of rows in each chunk, the whole table in a single chunk if None
+    usecols: names or positions of the columns to load, all columns if None
+    header: row number with the column names of TSV/CSV input, None for no header
+    column_types: dict with pyarrow types of TSV/CSV columns by name
+    engine: parser of TSV/CSV input: "arrow" (multithreaded, only usecols are converted),
+        "pandas" or "auto" (arrow with pandas fallback), see tables.read_batches
 
     Returns
     -------
-    (writer, s) tuples, will be None if absent
+    iterator with chunked input tables (pd.DataFrame)
     """
-    if out_format.upper() == "PARQUET":
-
-        pq_table_output = pa.Table.from_pandas(chunk)
-
-        # Write the output to the same input file:
-        parquet_schema = pq_table_output.schema
-
-        if mode == 'w':
-            parquet_writer = pq.ParquetWriter(
-                output_file, parquet_schema, compression="snappy"
-            )
-        else:
-            parquet_writer = writer
-
-        parquet_writer.write_table(pq_table_output)
-
-        return parquet_writer, None
-
 
-    elif out_format.upper() == "HDF5":
+    if in_format.upper() == "AUTO":
+        in_format = guess_format(in_path)
 
-        if mode == 'w':
-            h = h5py.File(output_file, mode=mode)
-        else:
-            h = writer
-
-        if mode == 'w':
-            s = 0
-            for col in chunk.columns:
-                if pd.api.types.is_object_dtype(chunk[col]):
-                    h.create_dataset(
-                        col,
-                        data=chunk[col].astype('S100').values,
-                        dtype='S100',
-                        maxshape=(None,),
-                        chunks=True,
-                    )
-                else:
-                    h.create_dataset(
-                        col,
-                        data=chunk[col].values,
-                        dtype=chunk[col].dtype.type,
-                        maxshape=(None,),
-                        chunks=True
-                    )
-            s += len(chunk[col])
-        else:
-            for col in chunk.columns:
-                h[col].resize((s + len(chunk[col]),))
-                if pd.api.types.is_object_dtype(chunk[col]):
-                    h[col][s: s + len(chunk[col])] = chunk[col].astype("S100")
-                else:
-                    h[col][s: s + len(chunk[col])] = chunk[col]
-            s += len(chunk[col])
+    for chunk in tables.read_batches(
+        in_path,
+        in_format,
+        chunksize=chunksize,
+        columns=usecols,
+        header=header,
+        column_types=column_types,
+        engine=engine,
+    ):
+        df = chunk.to_pandas()
+        # Columns of text tables without header are referred to by position:
+        if header is None and in_format.upper() in ["TSV", "CSV"]:
+            df.columns = [int(x) for x in df.columns]
+        yield df
+
+def get_colnames(in_path, in_format="AUTO"):
+    """Get the column names of the table without loading the data."""
 
-        return h, s
+    if in_format.upper() == "AUTO":
+        in_format = guess_format(in_path)
 
+    if in_format.upper() == "PARQUET":
+        return pq.read_schema(in_path).names
+    elif in_format.upper() == "HDF5":
+        with h5py.File(in_path, "r") as h:
+            return list(h.keys())
+    elif in_format.upper() in ["TSV", "CSV"]:
+        return tables.read_text_header(in_path, in_format)
     else:
-
-        chunk.to_csv(
-            output_file,
-            sep="," if out_format.upper() == "CSV" else "\t",
-            header=True if mode == 'w' else None,
-            mode=mode,
-            index=False,
+        raise ValueError(
+            f"Format {in_format} is not supported, use one of: TSV, CSV, HDF5, PARQUET."
         )
 
-        return None, None
-
 
-def load_table(in_path,
-               in_format="AUTO",
-               chunksize=None,
-               usecols=None,
-               header=None):
+def iter_chunks(in_paths, in_format, chunksize, columns=None):
     """
+    Iterate over multiple tables of the same length simultaneously, chunk by chunk.
+    Only chunksize rows of each table are kept in memory at a time.
 
     Parameters
     ----------
-    in_path: input file
-    in_format: Type of input. Can be either "TSV", "CSV", "PARQUET", "HDF5", "AUTO"
+    in_paths: input files
+    in_format: Type of input. Can be either "TSV", "CSV", "PARQUET", "HDF5"
+    chunksize: number of rows in each chunk, the whole tables are loaded if None
+    columns: columns to load (the absent ones are ignored), all columns if None.
+        Can be also a list with separate columns for each of in_paths.
 
     Returns
     -------
-    iterator with chunked input tables
+    iterator with lists of chunks (one pa.Table per input table) of the same length,
+    see tables.read_batches.
+    """
+    if columns is None or all(isinstance(x, str) for x in columns):
+        columns = [columns] * len(in_paths)
+    batches = [
+        tables.read_batches(in_path, in_format, chunksize, cols)
+        for in_path, cols in zip(in_paths, columns)
+    ]
+    for chunks in zip_longest(*batches):
+        if any(chunk is None for chunk in chunks) or (
+            len(set(chunk.num_rows for chunk in chunks)) > 1
+        ):
+            raise ValueError("Input tables have different number of rows.")
+        yield list(chunks)
+
+
+def project_columns(input_colnames, columns):
     """
+    Assign each column to the first of the tables containing it,
+    so that every column is loaded only once from multiple input tables.
 
-    if in_format.upper() == "AUTO":
-        in_format = guess_format(in_path)
+    Parameters
+    ----------
+    input_colnames: list with the column names of each input table
+    columns: names of the columns to load
 
-    # Read input file:
-    if in_format.upper() == "PARQUET":
-        stream = [pd.read_parquet(in_path, columns=usecols)]
-    elif in_format.upper() in ["TSV", "CSV"]:
-        stream = pd.read_csv(in_path, sep="," if in_format.upper()=="CSV" else "\t",
-                             header=header,
-                             chunksize=chunksize,
-                             usecols=usecols)
-    elif in_format.upper() == "HDF5":
-        h = h5py.File(in_path, "r")
-        keys = usecols if usecols else h.keys()
-        dct = {k: h[k][()] for k in keys}
-        h.close()
-        stream = [pd.DataFrame.from_dict(dct)]
+    Returns
+    -------
+    list with the columns to load from each table (empty for unused tables)
+    """
+    projection = [[] for _ in input_colnames]
+    missing = []
+    for column in dict.fromkeys(columns):
+        found = [column in colnames for colnames in input_colnames]
+        if any(found):
+            projection[found.index(True)].append(column)
+        else:
+            missing.append(column)
+    if missing:
+        raise ValueError(
+            f"Columns {missing} were not found in input tables. "
+            f"Available columns:\n{input_colnames}"
+        )
+    return projection
 
-    return stream
 
-def load_tables(in_paths, in_format):
+def iter_columns(in_paths, in_format, chunksize, projection):
     """
-    Load multiple tables in a single list.
-    TSV/CSV will be stored in memory and passed as pd.DataFrame objects,
-    PARQUET and HDF5 will be passed as handlers.
+    Iterate over the projected columns of multiple tables of the same length, chunk by chunk.
+    Only the tables with projected columns are read, see project_columns and iter_chunks.
+
+    Returns
+    -------
+    iterator with dicts of columns (pa.ChunkedArray) by name
     """
-    input_tables = []
-    for input_table in in_paths:
-        if in_format.upper() == "PARQUET":
-            input_tables.append(pa.parquet.read_table(input_table, memory_map=True))
-        elif in_format.upper() == "HDF5":
-            input_tables.append(h5py.File(input_table, "r"))
-        elif in_format.upper() == "TSV":
-            logger.warning(
-                "Loading multiple TSV tables into memory, "
-                "might result in RAM overload!"
-            )
-            input_tables.append(pd.read_csv(input_table, sep="\t"))
-        elif in_format.upper() == "CSV":
-            logger.warning(
-                "Loading multiple CSV tables into memory, "
-                "might result in RAM overload!"
-            )
-            input_tables.append(pd.read_csv(input_table, sep=","))
-        else:
-            raise ValueError(
-                f"Format {in_format} is not supported, use one of: TSV, CSV, HDF5, PARQUET."
-            )
-    return input_tables
+    selected = [i for i, cols in enumerate(projection) if len(cols) > 0]
+    chunks = iter_chunks(
+        [in_paths[i] for i in selected],
+        in_format,
+        chunksize,
+        columns=[projection[i] for i in selected],
+    )
+    for input_tables in chunks:
+        yield {
+            column: table[column]
+            for i, table in zip(selected, input_tables)
+            for column in projection[i]
+        }
+
+
+def imap_ordered(executor, func, iterable, max_pending):
+    """
+    Map func over iterable with concurrent.futures executor, yielding the results
+    in the order of iterable. At most max_pending items are submitted at once,
+    so that the iterable is consumed (e.g. read from disk) as the results are taken.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def dump_columns(result, in_format, column_format, column_name):
@@ -259,6 +312,12 @@ def dump_columns(result, in_format, column_format, column_name):
 
     loaded_arrays = {}
 
+    # Result of evaluation with arrow backend:
+    if isinstance(result, pa.ChunkedArray):
+        result = result.combine_chunks()
+    if isinstance(result, pa.Array) and in_format.upper() != "PARQUET":
+        result = result.to_numpy(zero_copy_only=False)
+
     """ Dump columns into dictionary storing in appropriate formats. """
     if in_format.upper() == "PARQUET":
         if column_format.lower() == "str":
@@ -276,7 +335,10 @@ def dump_columns(result, in_format, column_format, column_name):
         else:
             raise ValueError("Supported formats: str, int and bool for now.")
 
-        loaded_arrays[column_name] = pa.array(result, type=pyarrow_format)
+        # Types are converted by cast, e.g. numeric expressions to str columns:
+        if not isinstance(result, pa.Array):
+            result = pa.array(result)
+        loaded_arrays[column_name] = result.cast(pyarrow_format)
 
     elif in_format.upper() == "HDF5":
         loaded_arrays[column_name] = result.copy()
@@ -285,28 +347,3 @@ def dump_columns(result, in_format, column_format, column_name):
         loaded_arrays[column_name] = pd.Series(result, dtype=column_format.lower())
 
     return loaded_arrays
-
-
-def dump_arrays(loaded_arrays, out_format, output_file):
-    if out_format.upper() == "PARQUET":
-        pq_table_output = pa.Table.from_pydict(loaded_arrays)
-        # Write the output to the same input file:
-        parquet_schema = pq_table_output.schema
-        parquet_writer = pq.ParquetWriter(
-            output_file, parquet_schema, compression="snappy"
-        )
-        parquet_writer.write_table(pq_table_output)
-        parquet_writer.close()
-
-    elif out_format.upper() == "HDF5":
-        for column_name, result in loaded_arrays.iteritems():
-            output_file.create_dataset(column_name, data=result)
-        # Everything was stored already, just close the file handler:
-        output_file.close()
-    else:
-        df = pd.DataFrame(loaded_arrays)
-        df.to_csv(
-            output_file,
-            sep="\t" if out_format.upper() == "TSV" else ",",
-            index=False,
-        )
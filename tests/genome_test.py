@@ -0,0 +1,125 @@
+from click.testing import CliRunner
+from rnadnatools.cli import cli
+
+import os.path as op
+import numpy as np
+import pandas as pd
+
+
+def _write_genome(genome_file):
+    """Write random test genome."""
+    rng = np.random.default_rng(0)
+    with open(genome_file, "w") as outf:
+        for chrom, length in [("chr2", 5000), ("chr1", 3000), ("chrM", 1000)]:
+            seq = "".join(rng.choice(list("ACGT"), length))
+            outf.write(f">{chrom}\n")
+            outf.write("\n".join(seq[i : i + 60] for i in range(0, length, 60)) + "\n")
+
+
+def test_renzymes_recsites(request, tmpdir):
+
+    genome_file = op.join(tmpdir, "genome.fa")
+    _write_genome(genome_file)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["genome", "renzymes-recsites", "--nproc", 2, genome_file, "DpnII,BsaI"]
+        + [op.join(tmpdir, "{enzyme}.multi.bed")],
+    )
+    assert result.exit_code == 0, result.output
+
+    for enzyme in ["DpnII", "BsaI"]:
+        outfile = op.join(tmpdir, f"{enzyme}.bed")
+        result = runner.invoke(
+            cli, ["genome", "renzymes-recsites", genome_file, enzyme, outfile]
+        )
+        assert result.exit_code == 0, result.output
+
+        df = pd.read_csv(outfile, sep="\t", header=None)
+        assert len(df) > 0
+        assert list(df[0]) == sorted(df[0])
+        assert (df[3] == [f"{enzyme}_{i+1}" for i in range(len(df))]).all()
+        with open(outfile) as single, open(
+            op.join(tmpdir, f"{enzyme}.multi.bed")
+        ) as multi:
+            assert single.read() == multi.read()
+
+
+
+def test_renzymes_recsites_index_once(request, tmpdir, monkeypatch):
+
+    from rnadnatools.lib import fasta
+    from rnadnatools.cli.genome import renzymes_recsites
+
+    genome_file = op.join(tmpdir, "genome.fa")
+    _write_genome(genome_file)
+
+    # FASTA without .fai is indexed by the main process only:
+    calls = []
+    build_fai = fasta.build_fai
+    monkeypatch.setattr(fasta, "build_fai", lambda path: calls.append(path) or build_fai(path))
+    monkeypatch.setattr(renzymes_recsites, "_fasta_files", {})
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["genome", "renzymes-recsites", genome_file, "DpnII", op.join(tmpdir, "out.bed")]
+    )
+    assert result.exit_code == 0, result.output
+    assert calls == [genome_file]
+
+def test_renzymes_fast_search(request, tmpdir):
+    import Bio.Restriction as biorst
+    from Bio.Seq import Seq
+    from Bio.SeqIO import parse
+    from rnadnatools.cli.genome import renzymes_recsites
+    from rnadnatools.lib import fasta
+
+    genome_file = op.join(tmpdir, "genome.fa")
+    _write_genome(genome_file)
+
+    with fasta.FastaFile(genome_file) as fasta_file:
+        for record in parse(genome_file, "fasta"):
+            seq = fasta_file.fetch(record.id)
+            assert seq.tobytes().decode() == str(record.seq)
+
+            # Soft-masked sequence:
+            seq[::7] = fasta.to_upper(seq[::7]) + (ord("a") - ord("A"))
+            for enzyme in ["DpnII", "BsaI", "HinfI", "BglI", "EcoRI"]:
+                enzyme = getattr(biorst, enzyme)
+                assert renzymes_recsites._is_simple(enzyme)
+                fast = renzymes_recsites._search_fast(fasta.to_upper(seq), enzyme)
+                expected = renzymes_recsites._search_biopython(Seq(seq.tobytes()), enzyme)
+                assert np.array_equal(fast[0], expected[0])
+                assert np.array_equal(fast[1], expected[1])
+
+
+def test_genome_index(request, tmpdir):
+    from Bio.SeqIO import parse
+    from rnadnatools.lib import fasta
+
+    genome_file = op.join(tmpdir, "genome.fa")
+    _write_genome(genome_file)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["genome", "index", genome_file])
+    assert result.exit_code == 0, result.output
+
+    records = fasta.read_fai(genome_file + ".fai")
+    assert [(x.name, x.length, x.linebases, x.linewidth) for x in records] == [
+        ("chr2", 5000, 60, 61),
+        ("chr1", 3000, 60, 61),
+        ("chrM", 1000, 60, 61),
+    ]
+
+    rng = np.random.default_rng(1)
+    with fasta.FastaFile(genome_file) as genome:
+        for record in parse(genome_file, "fasta"):
+            seq = str(record.seq)
+            assert genome.get_length(record.id) == len(seq)
+            for start, end in [(0, None), (59, 61), (10, 20), (len(seq) - 5, len(seq) + 5)]:
+                expected = seq[start:end]
+                assert genome.fetch(record.id, start, end).tobytes().decode() == expected
+            for start in rng.integers(0, len(seq), 20):
+                end = start + rng.integers(0, 300)
+                assert genome.fetch(record.id, start, end).tobytes().decode() == seq[start:end]
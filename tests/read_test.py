@@ -37,3 +37,127 @@ def test_read_cli(request, tmpdir):
     df = pd.read_csv(outfile, sep="\t")
     assert np.sum(df.loc[:, "oligo_GA_at_35"] == 1) > 0
     assert np.sum(df.loc[:, "oligo_GA_at_35"] == 0) > 0
+
+
+def test_check_nucleotides_chunks(request, tmpdir):
+
+    outfile = op.join(tmpdir, "tmp.tsv")
+    input_seqtable = op.join(request.fspath.dirname, "data/test-sample.table.tsv")
+    input_postable = op.join(request.fspath.dirname, "data/test-sample.oligos.tsv")
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["read", "check-nucleotides", "--oligo", "GA", "--shift", 35, "--chunksize", 7]
+        + ["--readid-colname", "readID", "--seq-colname", "R1"]
+        + ["--ref-colname", "start_hit__bridge_forward_R1"]
+        + [input_seqtable, input_postable, outfile],
+    )
+    assert result.exit_code == 0, result.output
+
+    seqs = pd.read_csv(input_seqtable, sep="\t").loc[:, "R1"]
+    starts = pd.read_csv(input_postable, sep="\t").loc[:, "start_hit__bridge_forward_R1"]
+    expected = [
+        int(0 <= start + 35 and seq[start + 35 : start + 37] == "GA")
+        for seq, start in zip(seqs, starts)
+    ]
+
+    df = pd.read_csv(outfile, sep="\t")
+    assert len(df) == len(seqs)
+    assert list(df.loc[:, "oligo_GA_at_35"]) == expected
+
+
+def test_check_nucleotides_different_lengths(request, tmpdir):
+
+    outfile = op.join(tmpdir, "tmp.tsv")
+    input_seqtable = op.join(request.fspath.dirname, "data/test-sample.table.tsv")
+    input_postable = op.join(request.fspath.dirname, "data/test-sample.oligos.tsv")
+
+    # Reference table shorter by whole chunks, and the sequence table shorter by a few rows:
+    short_postable = op.join(tmpdir, "short.oligos.tsv")
+    pd.read_csv(input_postable, sep="\t").head(40).to_csv(short_postable, sep="\t", index=False)
+    short_seqtable = op.join(tmpdir, "short.table.tsv")
+    pd.read_csv(input_seqtable, sep="\t").head(95).to_csv(short_seqtable, sep="\t", index=False)
+
+    runner = CliRunner()
+    command = ["read", "check-nucleotides", "--oligo", "GA", "--shift", 35, "--chunksize", 20]
+    command += ["--readid-colname", "readID", "--seq-colname", "R1"]
+    command += ["--ref-colname", "start_hit__bridge_forward_R1"]
+    for seqtable, postable in [(input_seqtable, short_postable), (short_seqtable, input_postable)]:
+        result = runner.invoke(cli, command + [seqtable, postable, outfile])
+        assert result.exit_code != 0
+        assert "different number of rows" in str(result.exception)
+
+
+def test_check_nucleotides_spec_file(request, tmpdir):
+
+    input_seqtable = op.join(request.fspath.dirname, "data/test-sample.table.tsv")
+    input_postable = op.join(request.fspath.dirname, "data/test-sample.oligos.tsv")
+    spec_file = op.join(tmpdir, "specs.tsv")
+    with open(spec_file, "w") as outf:
+        outf.write("GA\tbridge\tstart_hit__bridge_forward_R1\t35\n")
+        outf.write("CT\tadaptor\tstart_hit__adaptor_forward_R1\t0\n")
+
+    runner = CliRunner()
+    command = ["read", "check-nucleotides", "--readid-colname", "readID"]
+    command += ["--seq-colname", "R1", "--chunksize", 30]
+
+    outfile = op.join(tmpdir, "tmp.tsv")
+    result = runner.invoke(
+        cli, command + ["--spec-file", spec_file, input_seqtable, input_postable, outfile]
+    )
+    assert result.exit_code == 0, result.output
+    df = pd.read_csv(outfile, sep="\t")
+    assert list(df.columns) == ["#entry_index", "oligo_bridge_at_35", "oligo_adaptor_at_0"]
+
+    # Each column is the same as for a separate run:
+    for oligo, name, column, shift in [
+        ("GA", "bridge", "start_hit__bridge_forward_R1", 35),
+        ("CT", "adaptor", "start_hit__adaptor_forward_R1", 0),
+    ]:
+        single = op.join(tmpdir, f"{name}.tsv")
+        result = runner.invoke(
+            cli,
+            command
+            + ["--oligo", oligo, "--oligo-name", name, "--ref-colname", column]
+            + ["--shift", shift, input_seqtable, input_postable, single],
+        )
+        assert result.exit_code == 0, result.output
+        expected = pd.read_csv(single, sep="\t").loc[:, f"oligo_{name}_at_{shift}"]
+        assert df.loc[:, f"oligo_{name}_at_{shift}"].equals(expected)
+
+
+def test_check_nucleotides_parquet(request, tmpdir):
+
+    input_seqtable = op.join(request.fspath.dirname, "data/test-sample.table.tsv")
+    input_postable = op.join(request.fspath.dirname, "data/test-sample.oligos.tsv")
+
+    # Convert test tables to parquet:
+    tables = []
+    for path in [input_seqtable, input_postable]:
+        df = pd.read_csv(path, sep="\t")
+        df.columns = [x.lstrip("#") for x in df.columns]
+        tables.append(op.join(tmpdir, op.basename(path) + ".pq"))
+        df.to_parquet(tables[-1], row_group_size=30)
+
+    runner = CliRunner()
+    command = ["read", "check-nucleotides", "--oligo", "GA", "--shift", 35]
+    command += ["--readid-colname", "readID", "--seq-colname", "R1"]
+    command += ["--ref-colname", "start_hit__bridge_forward_R1", "--chunksize", 40]
+
+    outfile_tsv = op.join(tmpdir, "tmp.tsv")
+    result = runner.invoke(cli, command + [input_seqtable, input_postable, outfile_tsv])
+    assert result.exit_code == 0, result.output
+
+    outfile_pq = op.join(tmpdir, "tmp.pq")
+    result = runner.invoke(cli, command + ["-i", "PARQUET"] + tables + [outfile_pq])
+    assert result.exit_code == 0, result.output
+
+    # PARQUET output is the same as TSV output, with '#' stripped from the header:
+    expected = pd.read_csv(outfile_tsv, sep="\t")
+    expected.columns = [x.lstrip("#") for x in expected.columns]
+    df = pd.read_parquet(outfile_pq)
+    assert df.oligo_GA_at_35.dtype == np.int8
+    assert list(df.columns) == list(expected.columns)
+    for column in df.columns:
+        assert list(df[column]) == list(expected[column])
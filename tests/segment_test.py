@@ -0,0 +1,194 @@
+from click.testing import CliRunner
+from rnadnatools.cli import cli
+
+import gzip
+import os.path as op
+import pandas as pd
+
+
+def _write_sites(input_table, reference_table):
+    """Write test BED input and restriction sites."""
+    pd.DataFrame(
+        {
+            "chrom": ["chr1", "chr2", "chr1", "chrX", "chr1"],
+            "start": [15, 5, 0, 10, 35],
+            "end": [25, 30, 10, 20, 40],
+        }
+    ).to_csv(input_table, sep="\t", index=False)
+    pd.DataFrame(
+        {
+            "chrom": ["chr2", "chr1", "chr1", "chr1"],
+            "start": [10, 30, 10, 20],
+            "end": [10, 30, 10, 20],
+            "name": ".",
+            "score": ".",
+            "strand": ["+", "+", "-", "+"],
+        }
+    ).to_csv(reference_table, sep="\t", index=False, header=False)
+
+
+def test_get_closest_sites(request, tmpdir):
+
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "rsites.bed")
+    outfile = op.join(tmpdir, "tmp.tsv")
+    _write_sites(input_table, reference_table)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["segment", "get-closest-sites", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+        + ["--ref-columns", "0,1,5", "--no-ref-header", "--chunksize", 2]
+        + [input_table, reference_table, outfile],
+    )
+    assert result.exit_code == 0, result.output
+
+    df = pd.read_csv(outfile, sep="\t", header=0)
+    df.columns = ["start_left", "start_right", "end_left", "end_right"]
+    assert list(df.start_left) == [-5, -10 ** 10 - 5, -10 ** 10, -1, -5]
+    assert list(df.start_right) == [5, 5, 10, -1, 10 ** 10 - 35]
+    assert list(df.end_left) == [-5, -20, 0, -1, -10]
+    assert list(df.end_right) == [5, 10 ** 10 - 30, 10, -1, 10 ** 10 - 40]
+
+
+def test_index_sites(request, tmpdir):
+
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "rsites.bed")
+    index_file = op.join(tmpdir, "rsites.idx")
+    _write_sites(input_table, reference_table)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["genome", "index-sites", reference_table, index_file]
+    )
+    assert result.exit_code == 0, result.output
+
+    for strand in ["+", "-", "b"]:
+        outputs = []
+        for reference in [reference_table, index_file]:
+            outfile = op.join(tmpdir, f"tmp{len(outputs)}.tsv")
+            result = runner.invoke(
+                cli,
+                ["segment", "get-closest-sites", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+                + ["--ref-columns", "0,1,5", "--no-ref-header", "-s", strand]
+                + [input_table, reference, outfile],
+            )
+            assert result.exit_code == 0, result.output
+            outputs.append(pd.read_csv(outfile, sep="\t"))
+        assert outputs[0].equals(outputs[1])
+
+
+def test_get_closest_sites_nproc(request, tmpdir):
+
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "rsites.bed")
+    _write_sites(input_table, reference_table)
+
+    runner = CliRunner()
+    outputs = []
+    for nproc in [1, 2]:
+        outfile = op.join(tmpdir, f"tmp{nproc}.tsv")
+        result = runner.invoke(
+            cli,
+            ["segment", "get-closest-sites", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+            + ["--ref-columns", "0,1,5", "--no-ref-header", "--chunksize", 1]
+            + ["--nproc", nproc, input_table, reference_table, outfile],
+        )
+        assert result.exit_code == 0, result.output
+        outputs.append(pd.read_csv(outfile, sep="\t"))
+    assert len(outputs[1]) == 5
+    assert outputs[0].equals(outputs[1])
+
+
+def test_extract_fastq(request, tmpdir):
+
+    input_table = op.join(tmpdir, "fragments.pq")
+    pd.DataFrame(
+        {
+            "readID": ["read1", "read2", "read3", "read4"],
+            "R1": ["ACGTACGTAC", "GGGGCCCCAAAATTTT", "ACG", "TTTTTTTTTTTTTTTTTTTTGA"],
+            "Q1": ["ABCDEFGHIJ", "FFFFFFFFFFFFFFFF", "III", "#" * 22],
+            "dna_start": [2, 0, 1, 5],
+            "dna_end": [8, 16, 10, 21],
+        }
+    ).to_parquet(input_table)
+    expected = (
+        "@read1\nGTACGT\n+\nCDEFGH\n"
+        "@read2\nGGGGCCCCAAAATTTT\n+\nFFFFFFFFFFFFFFFF\n"
+        "@read3\nCG\n+\nII\n"
+        "@read4\nTTTTTTTTTTTTTTTG\n+\n################\n"
+    )
+
+    runner = CliRunner()
+    for outfile in ["tmp.fq", "tmp.fq.gz"]:
+        outfile = op.join(tmpdir, outfile)
+        result = runner.invoke(
+            cli,
+            ["segment", "extract-fastq", "-s", "dna_end-dna_start>5", "--chunksize", 2]
+            + [outfile, input_table],
+        )
+        assert result.exit_code == 0, result.output
+        opener = gzip.open if outfile.endswith(".gz") else open
+        with opener(outfile, "rt") as infile:
+            assert infile.read() == expected
+
+
+def test_extract_fastq_segments(request, tmpdir):
+
+    input_table = op.join(tmpdir, "fragments.pq")
+    pd.DataFrame(
+        {
+            "readID": ["read1", "read2", "read3"],
+            "R1": ["ACGTACGTAC", "GGGGCCCCAA", "TTTTTGGGGG"],
+            "Q1": ["ABCDEFGHIJ", "KLMNOPQRST", "abcdefghij"],
+            "rna_start": [0, 0, 0],
+            "rna_end": [4, 2, 5],
+            "dna_start": [4, 2, 5],
+            "dna_end": [10, 10, 10],
+        }
+    ).to_parquet(input_table)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["segment", "extract-fastq", "--chunksize", 2, "-n", 2]
+        + ["--segment", "rna:rna_start,rna_end,R1,Q1"]
+        + ["--segment", "dna:dna_start,dna_end,R1,Q1"]
+        + [op.join(tmpdir, "{segment}.{shard}.fq"), input_table],
+    )
+    assert result.exit_code == 0, result.output
+
+    def read(name):
+        with open(op.join(tmpdir, name), "r") as infile:
+            return infile.read()
+
+    assert read("rna.0.fq") == "@read1\nACGT\n+\nABCD\n@read3\nTTTTT\n+\nabcde\n"
+    assert read("rna.1.fq") == "@read2\nGG\n+\nKL\n"
+    assert read("dna.0.fq") == "@read1\nACGTAC\n+\nEFGHIJ\n@read3\nGGGGG\n+\nfghij\n"
+    assert read("dna.1.fq") == "@read2\nGGCCCCAA\n+\nMNOPQRST\n"
+
+
+def test_extract_fastq_braces_in_path(request, tmpdir):
+
+    input_table = op.join(tmpdir, "fragments.pq")
+    pd.DataFrame(
+        {
+            "readID": ["read1", "read2"],
+            "R1": ["ACGTACGTAC", "GGGGCCCCAA"],
+            "Q1": ["ABCDEFGHIJ", "KLMNOPQRST"],
+        }
+    ).to_parquet(input_table)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["segment", "extract-fastq", "-n", 2, "--segment", "reads:,,R1,Q1"]
+        + [op.join(tmpdir, "{sample}.{shard}.fq"), input_table],
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(op.join(tmpdir, "{sample}.0.fq"), "r") as infile:
+        assert infile.read() == "@read1\nACGTACGTAC\n+\nABCDEFGHIJ\n"
+    with open(op.join(tmpdir, "{sample}.1.fq"), "r") as infile:
+        assert infile.read() == "@read2\nGGGGCCCCAA\n+\nKLMNOPQRST\n"
@@ -1,6 +1,7 @@
 from click.testing import CliRunner
 from rnadnatools.cli import cli
 import os.path as op
+import h5py
 import pandas as pd
 import numpy as np
 
@@ -33,3 +34,283 @@ def test_table_cli(request, tmpdir):
         df.loc[:, "eq_start"].values, np.array([False, True, False])
     )  # See tests/data/test_table.tsv
     assert np.allclose(df.loc[:, "flipped_dna_start"].values, np.array([100, 10, 0]))
+
+
+def test_evaluate_chunked(request, tmpdir):
+
+    input_scheme = op.join(request.fspath.dirname, "data/test_evaluation_scheme.tsv")
+    input_table = op.join(request.fspath.dirname, "data/test_table.tsv")
+
+    runner = CliRunner()
+    outputs = []
+    for chunksize in [None, 1, 2]:
+        outfile = op.join(tmpdir, f"tmp.{chunksize}.tsv")
+        options = ["-c", chunksize] if chunksize else []
+        result = runner.invoke(
+            cli,
+            ["table", "evaluate", "-i", "TSV", "-o", "TSV"]
+            + options
+            + [input_scheme, outfile, input_table],
+        )
+        assert result.exit_code == 0, result.output
+        outputs.append(open(outfile).read())
+
+    # Chunked evaluation should produce exactly the same output:
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_evaluate_schema_graph(request, tmpdir):
+
+    input_scheme = op.join(tmpdir, "scheme.tsv")
+    input_table = op.join(request.fspath.dirname, "data/test_table.tsv")
+    outfile = op.join(tmpdir, "tmp.tsv")
+
+    with open(input_scheme, "w") as outf:
+        outf.write("len_dna\tint\tdna_end-dna_start\n")
+        outf.write("len_rna\tint\trna_end-rna_start\n")
+        outf.write("is_long\tbool\t(len_dna>5)&(len_rna>5)\n")
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["table", "evaluate", "-i", "TSV", "--columns", "is_long", "-p", 2]
+        + [input_scheme, outfile, input_table],
+    )
+    assert result.exit_code == 0, result.output
+
+    # Intermediate columns are not written:
+    df = pd.read_csv(outfile, sep="\t")
+    assert list(df.columns) == ["is_long"]
+    assert np.all(df.loc[:, "is_long"].values)
+
+    # Missing variables are reported before reading the data:
+    with open(input_scheme, "a") as outf:
+        outf.write("missing\tint\tunknown_column+1\n")
+    result = runner.invoke(
+        cli, ["table", "evaluate", "-i", "TSV", input_scheme, outfile, input_table]
+    )
+    assert result.exit_code != 0
+    assert "unknown_column" in str(result.exception)
+
+
+def test_evaluate_str_column(request, tmpdir):
+
+    input_scheme = op.join(tmpdir, "scheme.tsv")
+    input_table = op.join(request.fspath.dirname, "data/test_table.tsv")
+
+    with open(input_scheme, "w") as outf:
+        outf.write("len_dna\tstr\tdna_end-dna_start\n")
+
+    runner = CliRunner()
+    for out_format in ["TSV", "HDF5"]:
+        outfile = op.join(tmpdir, f"tmp.{out_format.lower()}")
+        result = runner.invoke(
+            cli,
+            ["table", "evaluate", "-i", "TSV", "-o", out_format]
+            + [input_scheme, outfile, input_table],
+        )
+        assert result.exit_code == 0, result.output
+
+    # String column computed from the numeric expression:
+    df = pd.read_csv(op.join(tmpdir, "tmp.tsv"), sep="\t", dtype=str)
+    assert list(df["len_dna"]) == ["100", "10", "10"]
+    with h5py.File(op.join(tmpdir, "tmp.hdf5"), "r") as h:
+        assert list(h["len_dna"][()]) == [b"100", b"10", b"10"]
+
+
+def test_evaluate_backends(request, tmpdir):
+
+    input_scheme = op.join(request.fspath.dirname, "data/test_evaluation_scheme.tsv")
+    input_table = op.join(request.fspath.dirname, "data/test_table.tsv")
+
+    runner = CliRunner()
+    outputs = []
+    for backend in ["numpy", "arrow"]:
+        outfile = op.join(tmpdir, f"tmp.{backend}.tsv")
+        result = runner.invoke(
+            cli,
+            ["table", "evaluate", "-i", "TSV", "-o", "TSV", "-b", backend]
+            + [input_scheme, outfile, input_table],
+        )
+        assert result.exit_code == 0, result.output
+        outputs.append(open(outfile).read())
+
+    assert outputs[0] == outputs[1]
+
+
+def test_merge_different_lengths(request, tmpdir):
+
+    input_tables = [op.join(tmpdir, "a.pq"), op.join(tmpdir, "b.pq")]
+    pd.DataFrame({"a": np.arange(25)}).to_parquet(input_tables[0])
+    pd.DataFrame({"b": np.arange(10)}).to_parquet(input_tables[1])
+
+    runner = CliRunner()
+    for out_format, extension in [("PARQUET", "pq"), ("TSV", "tsv"), ("HDF5", "h5")]:
+        outfile = op.join(tmpdir, f"merged.{extension}")
+        result = runner.invoke(
+            cli,
+            ["table", "merge", "-c", 7, "-o", out_format, outfile] + input_tables,
+        )
+        assert result.exit_code != 0
+        assert "different number of rows" in str(result.exception)
+        # Failed merge leaves no partial output:
+        assert not op.exists(outfile)
+
+
+def test_align(request, tmpdir):
+
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "reference.tsv")
+    outfile = op.join(tmpdir, "tmp.tsv")
+
+    pd.DataFrame(
+        {"readID": ["r3", "r0", "r2"], "start": [3, 0, 2], "chrom": ["c3", "c0", "c2"]}
+    ).to_csv(input_table, sep="\t", index=False)
+    pd.DataFrame({"readID": [f"r{i}" for i in range(5)]}).to_csv(
+        reference_table, sep="\t", index=False
+    )
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["table", "align", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+        + ["--key-column", "readID", "--ref-column", "readID"]
+        + ["--fill-values", "NA,-1,chrN", "--no-drop-key", "--chunksize-writer", 2]
+        + [input_table, reference_table, outfile],
+    )
+    assert result.exit_code == 0, result.output
+
+    df = pd.read_csv(outfile, sep="\t")
+    assert list(df.readID) == ["r0", "r1", "r2", "r3", "r4"]
+    assert list(df.start) == [0, -1, 2, 3, -1]
+    assert list(df.chrom) == ["c0", "chrN", "c2", "c3", "chrN"]
+
+
+def test_align_out_of_core(request, tmpdir):
+
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "reference.tsv")
+
+    n = 200
+    pd.DataFrame(
+        {"readID": [f"r{i}" for i in range(0, n, 2)][::-1], "start": range(0, n, 2)}
+    ).to_csv(input_table, sep="\t", index=False)
+    pd.DataFrame({"readID": [f"r{i}" for i in range(n)]}).to_csv(
+        reference_table, sep="\t", index=False
+    )
+
+    runner = CliRunner()
+    outputs = []
+    for mode in [["--in-memory"], ["--out-of-core", "--memory-limit", "500"]]:
+        outfile = op.join(tmpdir, f"tmp{len(outputs)}.tsv")
+        result = runner.invoke(
+            cli,
+            ["table", "align", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+            + ["--key-column", "readID", "--ref-column", "readID"]
+            + ["--fill-values", "NA,-1", "--no-drop-key"]
+            + ["--chunksize", 30, "--chunksize-writer", 17, "--tmp-dir", str(tmpdir)]
+            + mode
+            + [input_table, reference_table, outfile],
+        )
+        assert result.exit_code == 0, result.output
+        outputs.append(pd.read_csv(outfile, sep="\t"))
+
+    assert list(outputs[1].readID) == [f"r{i}" for i in range(n)]
+    assert outputs[0].equals(outputs[1])
+
+
+def test_align_assume_sorted(request, tmpdir):
+
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "reference.tsv")
+    outfile = op.join(tmpdir, "tmp.tsv")
+
+    n = 100
+    df = pd.DataFrame(
+        {"readID": [f"r{i}" for i in range(0, n, 3)], "start": range(0, n, 3)}
+    )
+    df.to_csv(input_table, sep="\t", index=False)
+    pd.DataFrame({"readID": [f"r{i}" for i in range(n)]}).to_csv(
+        reference_table, sep="\t", index=False
+    )
+
+    runner = CliRunner()
+    command = (
+        ["table", "align", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+        + ["--key-column", "readID", "--ref-column", "readID"]
+        + ["--fill-values", "NA,-1", "--no-drop-key", "--assume-sorted"]
+        + ["--chunksize", 7, "--chunksize-writer", 10]
+        + [input_table, reference_table, outfile]
+    )
+    result = runner.invoke(cli, command)
+    assert result.exit_code == 0, result.output
+
+    aligned = pd.read_csv(outfile, sep="\t")
+    assert list(aligned.readID) == [f"r{i}" for i in range(n)]
+    assert list(aligned.start) == [i if i % 3 == 0 else -1 for i in range(n)]
+
+    # Rows out of the order of reference:
+    df.iloc[::-1].to_csv(input_table, sep="\t", index=False)
+    result = runner.invoke(cli, command)
+    assert result.exit_code != 0
+    assert "not in the order of reference" in str(result.exception)
+
+
+def test_type_change(request, tmpdir):
+
+    # Chromosome inferred as integer from the start of table:
+    n = 300_000
+    input_table = op.join(tmpdir, "input.tsv")
+    reference_table = op.join(tmpdir, "reference.tsv")
+    with open(input_table, "w") as outfile:
+        outfile.write("readID\tchrom\n")
+        outfile.write("".join(f"r{i}\t1\n" for i in range(n)))
+        outfile.write(f"r{n}\tX\n")
+    pd.DataFrame({"readID": [f"r{n}", "r0", "r-1"]}).to_csv(
+        reference_table, sep="\t", index=False
+    )
+
+    runner = CliRunner()
+    outfile = op.join(tmpdir, "tmp.pq")
+    result = runner.invoke(
+        cli,
+        ["table", "convert", "-i", "TSV", "-o", "PARQUET", "--chunksize", 100_000]
+        + [input_table, outfile],
+    )
+    assert result.exit_code == 0, result.output
+    df = pd.read_parquet(outfile)
+    assert len(df) == n + 1
+    assert list(df.chrom.iloc[[0, -1]]) == ["1", "X"]
+
+    outfile = op.join(tmpdir, "tmp.tsv")
+    result = runner.invoke(
+        cli,
+        ["table", "align", "-i", "TSV", "-r", "TSV", "-o", "TSV"]
+        + ["--key-column", "readID", "--ref-column", "readID"]
+        + ["--fill-values", "NA,chrN", "--no-drop-key"]
+        + [input_table, reference_table, outfile],
+    )
+    assert result.exit_code == 0, result.output
+    df = pd.read_csv(outfile, sep="\t", dtype=str)
+    assert list(df.chrom) == ["X", "1", "chrN"]
+
+
+def test_stack_different_types(request, tmpdir):
+
+    input_tables = [op.join(tmpdir, "input1.pq"), op.join(tmpdir, "input2.pq")]
+    pd.DataFrame({"readID": ["r0", "r1"], "chrom": [1, 2]}).to_parquet(input_tables[0])
+    pd.DataFrame({"readID": ["r2"], "chrom": ["X"]}).to_parquet(input_tables[1])
+
+    runner = CliRunner()
+    for out_format in ["PARQUET", "HDF5", "TSV"]:
+        outfile = op.join(tmpdir, f"tmp.{out_format.lower()}")
+        result = runner.invoke(
+            cli, ["table", "stack", "-o", out_format, outfile] + input_tables
+        )
+        assert result.exit_code == 0, result.output
+
+    assert list(pd.read_parquet(op.join(tmpdir, "tmp.parquet")).chrom) == ["1", "2", "X"]
+    with h5py.File(op.join(tmpdir, "tmp.hdf5"), "r") as h:
+        assert list(h["chrom"][()]) == [b"1", b"2", b"X"]
+    df = pd.read_csv(op.join(tmpdir, "tmp.tsv"), sep="\t", dtype=str)
+    assert list(df.chrom) == ["1", "2", "X"]
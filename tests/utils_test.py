@@ -0,0 +1,227 @@
+from rnadnatools.lib import utils
+from rnadnatools.lib import expressions
+from rnadnatools.lib import streams
+from rnadnatools.lib import tables
+import os
+import os.path as op
+import h5py
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+
+def test_match():
+
+    values = np.array(["chr1", "chrX", "xchr1", None], dtype=object)
+
+    # Numpy input, nulls do not match:
+    result = utils.match(values, "chr[0-9]")
+    assert isinstance(result, np.ndarray)
+    assert list(result) == [True, False, False, False]
+
+    # Arrow input is matched without conversion:
+    result = utils.match(pa.array(values), "chr")
+    assert isinstance(result, pa.Array)
+    assert result.to_pylist() == [True, True, False, False]
+
+    # Python-only regex syntax falls back to re:
+    result = utils.match(values, r"(c)h\1|chrX")
+    assert list(result) == [False, True, False, False]
+
+
+def test_evaluate_backends_nulls():
+
+    variables = {"a": pa.array([1, None, 3, None]), "b": pa.array([0, 2, None, None])}
+    for expression in [
+        "a > b",
+        "a != b",
+        "~(a <= b)",
+        "(a > b) | (b == 2)",
+        "np.where(a < b, 1, 0)",
+    ]:
+        numpy_result = expressions.evaluate_expression(expression, variables, "numpy")
+        arrow_result = expressions.evaluate_expression(expression, variables, "arrow")
+        assert isinstance(arrow_result, pa.ChunkedArray)
+        assert arrow_result.null_count == 0
+        assert arrow_result.to_pylist() == list(numpy_result), expression
+
+def test_table_writer(tmpdir):
+
+    output_file = op.join(tmpdir, "output.pq")
+    with tables.TableWriter(output_file, "PARQUET", row_group_size=4) as writer:
+        writer.write(pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]}))
+        # Types of the following chunks are cast to the schema of the first one:
+        writer.write({"a": np.array([4.0, 5.0]), "b": ["u", "v"]})
+        writer.write(pa.table({"a": pa.array([6], pa.int32()), "b": ["w"]}))
+
+    parquet_file = pq.ParquetFile(output_file)
+    assert [parquet_file.metadata.row_group(i).num_rows for i in range(2)] == [4, 2]
+    table = parquet_file.read()
+    assert table.schema.field("a").type == pa.int64()
+    assert table["a"].to_pylist() == [1, 2, 3, 4, 5, 6]
+
+    with pytest.raises(ValueError):
+        with tables.TableWriter(op.join(tmpdir, "other.pq"), "PARQUET") as writer:
+            writer.write({"a": [1]})
+            writer.write({"b": [1]})
+
+    output_file = op.join(tmpdir, "output.h5")
+    with tables.TableWriter(output_file, "HDF5") as writer:
+        writer.write({"a": [1, 2], "b": ["x", "y"]})
+        writer.write({"a": [3], "b": ["z"]})
+        # Text is not truncated:
+        writer.write({"a": [4], "b": ["ACGT" * 50]})
+    with h5py.File(output_file, "r") as h:
+        assert list(h["a"][()]) == [1, 2, 3, 4]
+        assert list(h["b"][()]) == [b"x", b"y", b"z", b"ACGT" * 50]
+    (table,) = tables.read_batches(output_file, "HDF5")
+    assert table["b"].to_pylist() == ["x", "y", "z", "ACGT" * 50]
+
+
+def test_read_batches(tmpdir):
+
+    df = pd.DataFrame({"a": np.arange(5), "b": list("vwxyz"), "c": np.arange(5) / 2})
+    df.to_csv(op.join(tmpdir, "input.tsv"), sep="\t", index=False)
+    df.to_parquet(op.join(tmpdir, "input.pq"), row_group_size=2)
+    with tables.TableWriter(op.join(tmpdir, "input.h5"), "HDF5") as writer:
+        writer.write(df)
+
+    for in_path, in_format in [
+        ("input.tsv", "TSV"),
+        ("input.pq", "PARQUET"),
+        ("input.h5", "HDF5"),
+    ]:
+        chunks = list(
+            tables.read_batches(
+                op.join(tmpdir, in_path), in_format, chunksize=3, columns=["c", "b"]
+            )
+        )
+        assert [x.num_rows for x in chunks] == [3, 2]
+        table = pa.concat_tables(chunks)
+        assert table.column_names == ["b", "c"]
+        assert table["b"].to_pylist() == list("vwxyz")
+        assert table["c"].to_pylist() == [0.0, 0.5, 1.0, 1.5, 2.0]
+        assert tables.count_rows(op.join(tmpdir, in_path), in_format) == 5
+
+
+def test_load_table_chunks(tmpdir):
+
+    df = pd.DataFrame({"a": np.arange(5), "b": list("vwxyz")})
+    df.to_parquet(op.join(tmpdir, "input.pq"))
+    df.to_csv(op.join(tmpdir, "input.tsv"), sep="\t", index=False, header=False)
+
+    chunks = list(utils.load_table(op.join(tmpdir, "input.pq"), "PARQUET", 2, ["b"]))
+    assert [len(x) for x in chunks] == [2, 2, 1]
+    assert list(chunks[0].columns) == ["b"]
+
+    chunks = list(utils.load_table(op.join(tmpdir, "input.tsv"), "TSV", 3, [1]))
+    assert [len(x) for x in chunks] == [3, 2]
+    assert list(pd.concat(chunks)[1]) == list("vwxyz")
+
+
+def test_guess_format(tmpdir):
+
+    frame = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+    expected = {"table.pq": "parquet", "table.h5": "hdf5", "table.tsv": "tsv", "table.csv": "csv"}
+    for name, fmt in expected.items():
+        with tables.TableWriter(op.join(tmpdir, name), fmt.upper()) as writer:
+            writer.write(frame)
+        assert utils.guess_format(op.join(tmpdir, name)) == fmt
+
+    # Binary formats are recognized by signature, text tables by sniffing:
+    for name, fmt in expected.items():
+        os.rename(op.join(tmpdir, name), op.join(tmpdir, "table"))
+        assert utils.guess_format(op.join(tmpdir, "table")) == fmt
+
+
+def test_compressed_streams(tmpdir):
+
+    data = b"".join(b"read%d\tACGT\n" % i for i in range(100_000))
+    for compression, extension in [("none", ""), ("gzip", ".gz"), ("bgzip", ".bgz"), ("zstd", ".zst")]:
+        path = op.join(tmpdir, "data.tsv" + extension)
+        with streams.open_output(path, nthreads=2, batch_size=100_000) as outfile:
+            outfile.write(data[:1000])
+            outfile.write(pa.py_buffer(data[1000:]))
+        assert streams.detect_compression(path) == {"bgzip": "gzip"}.get(compression, compression)
+        with streams.open_input(path) as infile:
+            assert infile.read() == data
+        with streams.open_input(path, readahead=True) as infile:
+            assert infile.read() == data
+
+    # Text tables are compressed by the extension and decompressed by the signature:
+    output_file = op.join(tmpdir, "table.tsv.zst")
+    with tables.TableWriter(output_file, "TSV") as writer:
+        writer.write({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+    chunks = list(tables.read_batches(output_file, "TSV", chunksize=2))
+    assert [x.num_rows for x in chunks] == [2, 1]
+    assert utils.guess_format(output_file) == "tsv"
+
+
+def test_read_text_engines(tmpdir):
+
+    input_file = op.join(tmpdir, "table.tsv")
+    with open(input_file, "w") as outfile:
+        outfile.write("#readID\tstart\tscore\n")
+        outfile.write("".join(f"read{i}\t{i}\t{i / 4}\n" for i in range(10)))
+
+    for engine in ["arrow", "pandas"]:
+        chunks = list(
+            tables.read_batches(
+                input_file,
+                "TSV",
+                chunksize=4,
+                columns=["#readID", "score"],
+                column_types={"score": pa.float32()},
+                engine=engine,
+            )
+        )
+        assert [x.num_rows for x in chunks] == [4, 4, 2]
+        assert chunks[0].column_names == ["#readID", "score"]
+        assert chunks[0].schema.field("score").type == pa.float32()
+        assert chunks[-1]["#readID"].to_pylist() == ["read8", "read9"]
+
+    frame = next(utils.load_table(input_file, "TSV", usecols=[1], header=None))
+    assert list(frame.columns) == [1]
+    assert frame[1].tolist() == ["start"] + [str(x) for x in range(10)]
+
+    # Ragged table cannot be parsed by arrow, pandas skips the incomplete values:
+    with open(input_file, "a") as outfile:
+        outfile.write("read10\t10\n")
+    with pytest.raises(pa.ArrowInvalid):
+        list(tables.read_batches(input_file, "TSV", engine="arrow"))
+    (table,) = tables.read_batches(input_file, "TSV")
+    assert table.num_rows == 11
+
+
+def test_read_text_type_change(tmpdir):
+
+    # Chromosome inferred as integer from the first blocks (> 1 Mb) of arrow reader:
+    n = 300_000
+    input_file = op.join(tmpdir, "table.tsv")
+    with open(input_file, "w") as outfile:
+        outfile.write("readID\tchrom\tstart\n")
+        outfile.write("".join(f"read{i}\t1\t{i}\n" for i in range(n)))
+        outfile.write(f"read{n}\tX\t{n}\n")
+
+    for engine in ["arrow", "pandas"]:
+        (table,) = tables.read_batches(input_file, "TSV", engine=engine)
+        assert table.schema.field("chrom").type in [pa.string(), pa.large_string()]
+        assert table.schema.field("start").type == pa.int64()
+        assert table.num_rows == n + 1
+        assert table["chrom"][0].as_py() == "1"
+        assert table["chrom"][n].as_py() == "X"
+
+        chunks = list(tables.read_batches(input_file, "TSV", chunksize=100_000, engine=engine))
+        assert [x.num_rows for x in chunks] == [100_000] * 3 + [1]
+        assert tables.concat_tables(chunks).equals(table)
+
+        # Rows written before the promotion of types are converted:
+        for out_format in ["PARQUET", "HDF5"]:
+            output_file = op.join(tmpdir, f"table.{out_format.lower()}")
+            with tables.TableWriter(output_file, out_format, row_group_size=50_000) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+            (written,) = tables.read_batches(output_file, out_format)
+            assert written.select(table.column_names).to_pydict() == table.to_pydict()